@@ -15,10 +15,9 @@
 from pyramid.authentication import (
     SessionAuthenticationPolicy as _SessionAuthenticationPolicy
 )
-from armonaut.cache.http import add_vary_callback
 
 
 class SessionAuthenticationPolicy(_SessionAuthenticationPolicy):
     def unauthenticated_userid(self, request):
-        request.add_response_callback(add_vary_callback('Cookie'))
+        request.response_vary.add('Cookie')
         return _SessionAuthenticationPolicy.unauthenticated_userid(self, request)
@@ -20,6 +20,7 @@ from armonaut.auth.interfaces import (
     IUserService, IOAuthService
 )
 from armonaut.auth.models import User
+from armonaut.redis import connection_pool
 from armonaut.utils import crypto
 from armonaut.project.tasks import synchronize_user
 
@@ -85,7 +86,7 @@ class DatabaseUserService:
 
             # Synchronize the user's projects if they are brand new.
             if new_user:
-                synchronize_user.delay(user)
+                request.task(synchronize_user).delay(user.id)
 
             return user
 
@@ -94,8 +95,11 @@ class DatabaseUserService:
 class RedisOAuthService:
     max_state_age = 5 * 60  # 5 minute expire time on state tokens.
 
-    def __init__(self, url, client_id, client_secret):
-        self.redis = redis.StrictRedis.from_url(url)
+    def __init__(self, url, client_id, client_secret, connection_pool=None):
+        if connection_pool is not None:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis.from_url(url)
         self._client_id = client_id
         self._client_secret = client_secret
 
@@ -105,12 +109,9 @@ class RedisOAuthService:
         return state
 
     def check_state(self, state):
-        key = self._redis_key(state)
-        found = self.redis.get(key)
-        if found is None:
-            return False
-        self.redis.delete(key)
-        return True
+        # DEL returns the number of keys removed so checking
+        # and consuming the state is a single atomic command.
+        return self.redis.delete(self._redis_key(state)) == 1
 
     def exchange_code_for_access_token(self, request, code, state):
         with request.http.post('https://github.com/login/oauth/access_token',
@@ -138,8 +139,10 @@ def database_login_factory(context, request):
 
 
 def oauth_factory(context, request):
+    url = request.registry.settings['oauth.state_storage_url']
     return RedisOAuthService(
-        request.registry.settings['oauth.state_storage_url'],
+        url,
         request.registry.settings['oauth.client_id'],
-        request.registry.settings['oauth.client_secret']
+        request.registry.settings['oauth.client_secret'],
+        connection_pool=connection_pool(request.registry, url)
     )
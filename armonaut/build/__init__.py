@@ -11,3 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+from armonaut.build.interfaces import IBuildScheduler
+from armonaut.build.services import build_scheduler_factory
+from armonaut.build.tasks import purge_expired_builds, schedule_jobs
+
+
+def includeme(config):
+    config.register_service_factory(build_scheduler_factory, IBuildScheduler)
+
+    # Start pending jobs every few seconds.
+    config.add_periodic_task(5, schedule_jobs)
+
+    # Delete builds older than builds.retention_days, if it's set.
+    config.add_periodic_task(3600, purge_expired_builds)
@@ -15,7 +15,7 @@
 import enum
 from armonaut.db import Model
 from sqlalchemy import (Column, String, DateTime,
-                        ForeignKey, Enum, BigInteger)
+                        ForeignKey, Enum, BigInteger, Index)
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy import sql
@@ -27,6 +27,7 @@ class Status(enum.Enum):
     success = 'success'
     failure = 'failure'
     error = 'error'
+    cancelled = 'cancelled'
 
 
 class Commit(Model):
@@ -45,6 +46,14 @@ class Commit(Model):
 
 class Build(Model):
     __tablename__ = 'builds'
+    __table_args__ = (
+        # A project's builds are listed newest first.
+        Index('ix_builds_project_id_started_at',
+              'project_id', sql.text('started_at DESC')),
+        # Finished builds are purged oldest first once they expire.
+        Index('ix_builds_started_at_finished', 'started_at',
+              postgresql_where=sql.text("status NOT IN ('pending', 'running')")),
+    )
 
     status = Column(Enum(Status),
                     default=Status.pending,
@@ -73,6 +82,12 @@ class Build(Model):
 
 class Job(Model):
     __tablename__ = 'jobs'
+    __table_args__ = (
+        # Pending jobs are started oldest first by the scheduler.
+        Index('ix_jobs_status_started_at', 'status', 'started_at'),
+        # A build's jobs are loaded, and cancelled, together.
+        Index('ix_jobs_build_id_status', 'build_id', 'status'),
+    )
 
     status = Column(Enum(Status),
                     default=Status.pending,
@@ -83,6 +98,9 @@ class Job(Model):
     finished_at = Column(DateTime, nullable=True, default=None)
     config = Column(JSON(none_as_null=True), nullable=False)
 
+    # Celery task that runs the job, revoked if the job is cancelled.
+    task_id = Column(String(36), nullable=True, default=None)
+
     build = relationship(
         'Build',
         back_populates='jobs'
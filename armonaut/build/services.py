@@ -0,0 +1,279 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from sqlalchemy import func
+from zope.interface import implementer
+from armonaut.build.interfaces import IBuildScheduler
+from armonaut.build.models import Build, Commit, Job, Status
+from armonaut.project.models import Project
+
+# Default number of jobs that may run at once for a single
+# project and for all of the projects of a single owner.
+MAX_JOBS_PER_PROJECT = 5
+MAX_JOBS_PER_OWNER = 10
+
+# Key of the advisory lock held by the running scheduling pass.
+SCHEDULER_LOCK = 0x61726d6f
+
+# Builds and jobs in these states can still be cancelled.
+UNFINISHED = (Status.pending, Status.running)
+
+Candidate = collections.namedtuple(
+    'Candidate', ['job_id', 'project_id', 'owner', 'started_at', 'rank']
+)
+
+
+def fair_order(candidates, running, limit, max_per_project, max_per_owner):
+    """
+    Chooses up to ``limit`` of the candidate jobs. Every project gets
+    its next job before any project gets another one, counting jobs
+    that are already running, and the oldest jobs go first within a
+    round. ``running`` maps (project_id, owner) to running jobs.
+    """
+    projects = collections.Counter()
+    owners = collections.Counter()
+    for (project_id, owner), count in running.items():
+        projects[project_id] += count
+        owners[owner] += count
+
+    # Ranks are only relative to the other candidates of a project so
+    # jobs that are already running push the project back in line.
+    ordered = sorted(
+        candidates,
+        key=lambda c: (projects[c.project_id] + c.rank, c.started_at, c.job_id)
+    )
+
+    chosen = []
+    for candidate in ordered:
+        if len(chosen) >= limit:
+            break
+        if (projects[candidate.project_id] >= max_per_project or
+                owners[candidate.owner] >= max_per_owner):
+            continue
+        projects[candidate.project_id] += 1
+        owners[candidate.owner] += 1
+        chosen.append(candidate)
+    return chosen
+
+
+@implementer(IBuildScheduler)
+class DatabaseBuildScheduler:
+    def __init__(self, db, max_per_project=MAX_JOBS_PER_PROJECT,
+                 max_per_owner=MAX_JOBS_PER_OWNER):
+        self.db = db
+        self.max_per_project = max_per_project
+        self.max_per_owner = max_per_owner
+
+    def schedule(self, limit):
+        # Only one scheduling pass runs at a time so that the limits
+        # are checked against the jobs the previous pass started.
+        if not self.db.query(func.pg_try_advisory_xact_lock(SCHEDULER_LOCK)).scalar():
+            return []
+
+        running = self._running()
+        chosen = fair_order(
+            self._candidates(limit), running, limit,
+            self.max_per_project, self.max_per_owner
+        )
+        if not chosen:
+            return []
+
+        # Another scheduler may have taken some of the jobs since
+        # they were read, those are skipped instead of waited on.
+        jobs = (
+            self.db.query(Job)
+            .filter(Job.id.in_([candidate.job_id for candidate in chosen]))
+            .filter(Job.status == Status.pending)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        order = {candidate.job_id: i for i, candidate in enumerate(chosen)}
+        jobs.sort(key=lambda job: order[job.id])
+
+        for job in jobs:
+            job.status = Status.running
+            job.started_at = func.now()
+        self.db.flush()
+        return jobs
+
+    def _running(self):
+        rows = (
+            self.db.query(Build.project_id, Project.owner, func.count(Job.id))
+            .join(Build, Job.build_id == Build.id)
+            .join(Project, Build.project_id == Project.id)
+            .filter(Job.status == Status.running)
+            .group_by(Build.project_id, Project.owner)
+        )
+        return {(project_id, owner): count for project_id, owner, count in rows}
+
+    def _candidates(self, limit):
+        """
+        Returns the oldest pending jobs of each project ranked within
+        the project, only as many per project and per owner as could
+        be started so that owners at their limit can't fill the list.
+        """
+        project_running = (
+            self.db.query(Build.project_id, func.count(Job.id).label('count'))
+            .join(Build, Job.build_id == Build.id)
+            .filter(Job.status == Status.running)
+            .group_by(Build.project_id)
+            .subquery()
+        )
+        owner_running = (
+            self.db.query(Project.owner, func.count(Job.id).label('count'))
+            .join(Build, Job.build_id == Build.id)
+            .join(Project, Build.project_id == Project.id)
+            .filter(Job.status == Status.running)
+            .group_by(Project.owner)
+            .subquery()
+        )
+        rank = func.row_number().over(
+            partition_by=Build.project_id,
+            order_by=(Job.started_at, Job.id)
+        ).label('rank')
+        pending = (
+            self.db.query(
+                Job.id.label('job_id'), Build.project_id, Project.owner,
+                Job.started_at, rank
+            )
+            .join(Build, Job.build_id == Build.id)
+            .join(Project, Build.project_id == Project.id)
+            .filter(Job.status == Status.pending)
+            .subquery()
+        )
+        slot = pending.c.rank + func.coalesce(project_running.c.count, 0)
+        eligible = (
+            self.db.query(pending, slot.label('slot'))
+            .outerjoin(project_running, project_running.c.project_id == pending.c.project_id)
+            .filter(slot <= self.max_per_project)
+            .subquery()
+        )
+
+        # Rank the jobs that fit within their project's limit again
+        # within the owner, in the order they'd be started, to only
+        # keep as many of them as the owner has room for.
+        owner_rank = func.row_number().over(
+            partition_by=eligible.c.owner,
+            order_by=(eligible.c.slot, eligible.c.started_at, eligible.c.job_id)
+        ).label('owner_rank')
+        ranked = self.db.query(eligible, owner_rank).subquery()
+        owner_slot = ranked.c.owner_rank + func.coalesce(owner_running.c.count, 0)
+        rows = (
+            self.db.query(
+                ranked.c.job_id, ranked.c.project_id, ranked.c.owner,
+                ranked.c.started_at, ranked.c.rank
+            )
+            .outerjoin(owner_running, owner_running.c.owner == ranked.c.owner)
+            .filter(owner_slot <= self.max_per_owner)
+            .order_by(ranked.c.slot, ranked.c.started_at)
+            .limit(limit * self.max_per_project)
+        )
+        return [Candidate(*row) for row in rows]
+
+
+def cancel_superseded(db, build, before):
+    """
+    Cancels the unfinished builds of the build's project for the same
+    ref whose commit is ``before``, the commit that the push which
+    created the build replaced, along with their jobs. Returns the
+    cancelled builds and the Celery task ids of their jobs.
+    """
+    # Webhooks are processed in whatever order their tasks run so
+    # which build is newer is decided by the push and not by ids.
+    if before is None:
+        return [], []
+
+    db.flush()
+    builds = (
+        db.query(Build)
+        .join(Commit, Build.commit_id == Commit.id)
+        .filter(Build.project_id == build.project_id)
+        .filter(Build.id != build.id)
+        .filter(Build.status.in_(UNFINISHED))
+        .filter(Commit.ref == build.commit.ref)
+        .filter(Commit.hexsha == before)
+        .with_for_update(of=Build)
+        .all()
+    )
+    if not builds:
+        return [], []
+
+    # Locking the jobs keeps the scheduler from starting any of them
+    # while they're being cancelled, it rechecks their status after.
+    jobs = (
+        db.query(Job)
+        .filter(Job.build_id.in_([superseded.id for superseded in builds]))
+        .filter(Job.status.in_(UNFINISHED))
+        .with_for_update()
+        .all()
+    )
+    for obj in builds + jobs:
+        obj.status = Status.cancelled
+        obj.finished_at = func.now()
+    db.flush()
+    return builds, [job.task_id for job in jobs if job.task_id is not None]
+
+
+def expired_builds(db, before, limit):
+    """
+    Returns a query for the ids and commit ids of up to ``limit`` of
+    the oldest finished builds that were started before ``before``.
+    """
+    # The filter matches ix_builds_started_at_finished so that finding
+    # out that nothing has expired doesn't have to scan every build.
+    return (
+        db.query(Build.id, Build.commit_id)
+        .filter(Build.started_at < before)
+        .filter(~Build.status.in_(UNFINISHED))
+        .order_by(Build.started_at)
+        .limit(limit)
+    )
+
+
+def purge_builds(db, before, limit):
+    """
+    Deletes up to ``limit`` of the finished builds that were started
+    before ``before`` along with their jobs and commits. Returns the
+    number of builds that were deleted.
+    """
+    rows = expired_builds(db, before, limit).with_for_update(skip_locked=True).all()
+    if not rows:
+        return 0
+
+    build_ids = [build_id for build_id, _ in rows]
+    commit_ids = [commit_id for _, commit_id in rows]
+    db.query(Job).filter(Job.build_id.in_(build_ids)).delete(
+        synchronize_session=False
+    )
+    db.query(Build).filter(Build.id.in_(build_ids)).delete(
+        synchronize_session=False
+    )
+    db.query(Commit).filter(Commit.id.in_(commit_ids)).delete(
+        synchronize_session=False
+    )
+    return len(rows)
+
+
+def build_scheduler_factory(context, request):
+    settings = request.registry.settings
+    return DatabaseBuildScheduler(
+        request.db,
+        max_per_project=settings.get(
+            'builds.max_jobs_per_project', MAX_JOBS_PER_PROJECT
+        ),
+        max_per_owner=settings.get(
+            'builds.max_jobs_per_owner', MAX_JOBS_PER_OWNER
+        )
+    )
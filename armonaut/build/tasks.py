@@ -0,0 +1,58 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+from sqlalchemy import func
+from armonaut import tasks
+from armonaut.build.interfaces import IBuildScheduler
+from armonaut.build.services import purge_builds
+
+# Number of jobs to start per scheduling pass.
+SCHEDULE_BATCH_SIZE = 50
+
+# Builds deleted per batch and batches per run of the retention task.
+RETENTION_BATCH_SIZE = 5000
+RETENTION_MAX_BATCHES = 10
+
+
+@tasks.task(ignore_result=True)
+def schedule_jobs(request):
+    scheduler = request.find_service(IBuildScheduler, context=None)
+    jobs = scheduler.schedule(request.registry.settings.get(
+        'builds.schedule_batch_size', SCHEDULE_BATCH_SIZE
+    ))
+    if jobs:
+        request.log.info('Scheduled jobs', **{
+            'jobs.count': len(jobs)
+        })
+
+
+@tasks.task(ignore_result=True)
+def purge_expired_builds(request, batch=0):
+    days = request.registry.settings.get('builds.retention_days')
+    if not days:
+        return
+
+    before = func.now() - datetime.timedelta(days=days)
+    deleted = purge_builds(request.db, before, RETENTION_BATCH_SIZE)
+    if deleted:
+        request.log.info('Purged expired builds', **{
+            'builds.count': deleted,
+            'builds.batch': batch
+        })
+
+    # Each batch is deleted by its own task so that its transaction, and
+    # the locks on the deleted rows, are done with before the next one.
+    if deleted >= RETENTION_BATCH_SIZE and batch + 1 < RETENTION_MAX_BATCHES:
+        request.task(purge_expired_builds).delay(batch=batch + 1)
@@ -12,26 +12,89 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import collections
 import functools
+import hashlib
+import zlib
+from armonaut.cache.lru import LRUCache
 
 
 BUFFER_MAX = 1 * 1024 * 1024
 
+# Number of streamed responses to remember ETags for per worker.
+STREAMING_ETAGS_MAXSIZE = 1024
 
-def add_vary_callback(*varies):
-    def wrapped(request, response):
-        vary = set(response.vary if response.vary is not None else [])
-        vary |= set(varies)
-        response.vary = vary
-    return wrapped
+
+class _CRC32(object):
+    """Non-cryptographic checksum with the hashlib interface
+    for hashing large streamed responses as fast as possible.
+    """
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def digest(self):
+        return self._value.to_bytes(4, 'big')
+
+
+ETAG_HASHES = {
+    'md5': hashlib.md5,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=16),
+    'crc32': _CRC32
+}
+
+
+def _etag(digest):
+    return base64.b64encode(digest).decode('utf8').strip('=')
+
+
+class _HashingAppIter(object):
+    """Wraps a response's app_iter and hashes each chunk as it's sent.
+    Once the last chunk has been sent ``callback`` is called with the
+    resulting ETag. Streams which are closed early are never reported.
+    """
+    def __init__(self, app_iter, hash_factory, callback):
+        self.app_iter = app_iter
+        self.hash_factory = hash_factory
+        self.callback = callback
+
+    def __iter__(self):
+        digest = self.hash_factory()
+        for chunk in self.app_iter:
+            digest.update(chunk)
+            yield chunk
+        self.callback(_etag(digest.digest()))
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def _response_vary(request):
+    return set()
+
+
+def merge_vary(request, response):
+    """Adds the Vary values collected in request.response_vary to the
+    response's Vary header. Called once while finalizing the response
+    so the header is only parsed and serialized a single time.
+    """
+    varies = request.response_vary
+    if varies:
+        if response.vary is not None:
+            varies = varies.union(response.vary)
+        response.vary = sorted(varies)
 
 
 def add_vary(*varies):
     def wrapper(view):
         @functools.wraps(view)
         def wrapped(context, request):
-            request.add_response_callback(add_vary_callback(*varies))
+            request.response_vary.update(varies)
             return view(context, request)
         return wrapped
     return wrapper
@@ -66,6 +129,21 @@ def cache_control(seconds, public=True,
 
 
 def conditional_http_tween_factory(handler, registry):
+    settings = registry.settings
+    hash_name = settings.get('cache.etag_hash', 'md5')
+    hash_factory = ETAG_HASHES[hash_name]
+
+    # ETags of streamed responses can only be known once they've been
+    # sent so they're remembered for the next request of the resource.
+    # Entries are only kept for responses with a Last-Modified and only
+    # trusted while it and the Content-Length are unchanged, otherwise a
+    # stale ETag could answer If-None-Match with a 304 that would never
+    # be corrected. The Content-Length alone isn't a validator as the
+    # content could be replaced with different content of the same size.
+    streaming_etags = LRUCache(maxsize=settings.get(
+        'cache.streaming_etags_maxsize', STREAMING_ETAGS_MAXSIZE
+    ))
+
     def conditional_http_tween(request):
         response = handler(request)
 
@@ -84,10 +162,38 @@ def conditional_http_tween_factory(handler, registry):
                 streaming = False
             if not streaming:
                 response.conditional_response = True
-                response.md5_etag()
+                if hash_name == 'md5':
+                    response.md5_etag()
+                else:
+                    digest = hash_factory()
+                    digest.update(response.body)
+                    response.etag = _etag(digest.digest())
+            elif response.last_modified is not None:
+                _stream_etag(request, response)
         return response
+
+    def _stream_etag(request, response):
+        validators = (response.content_length, response.last_modified)
+        key = request.path_qs
+
+        entry = streaming_etags.get(key)
+        if entry is not None and entry[0] == validators:
+            response.etag = entry[1]
+            response.conditional_response = True
+
+        def remember(etag):
+            streaming_etags.set(key, (validators, etag))
+
+        # Assigning app_iter clears the Content-Length so restore it.
+        content_length = response.content_length
+        response.app_iter = _HashingAppIter(
+            response.app_iter, hash_factory, remember
+        )
+        response.content_length = content_length
+
     return conditional_http_tween
 
 
 def includeme(config):
+    config.add_request_method(_response_vary, 'response_vary', reify=True)
     config.add_tween('armonaut.cache.http.conditional_http_tween_factory')
@@ -0,0 +1,90 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """Thread-safe mapping bounded to maxsize entries which evicts
+    the least recently used entry first and counts hits and misses.
+    If maxweight is given the total weight of all entries, as passed
+    to set(), is bounded as well.
+    """
+    def __init__(self, maxsize=128, maxweight=None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, weight=0):
+        with self._lock:
+            if self.maxweight is not None and weight > self.maxweight:
+                return
+            self._remove(key)
+            self._data[key] = (value, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (
+                self.maxweight is not None and self.weight > self.maxweight
+            ):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.weight -= evicted
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'weight': self.weight,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def _remove(self, key, default=None):
+        try:
+            value, weight = self._data.pop(key)
+        except KeyError:
+            return default
+        self.weight -= weight
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -13,33 +13,177 @@
 # limitations under the License.
 
 import base64
+import functools
 import hashlib
+import struct
+import zlib
 from collections.abc import Sequence
+import brotli
+from armonaut.cache.lru import LRUCache
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+# Encodings in the order we prefer them when a client accepts several.
+ENCODINGS = ['br', 'zstd', 'gzip', 'identity']
+if zstandard is None:  # pragma: no cover
+    ENCODINGS.remove('zstd')
 
-ENCODINGS = ['gzip', 'identity']
 BUFFER_MAX = 1 * 1024 * 1024
 
+# Bodies which are served many times from the cache are worth compressing
+# with the highest levels, which they are the second time they're seen.
+# Bodies seen for the first time, large bodies and streams of unknown
+# length use levels that keep up with the rate data is sent.
+DEFAULT_LEVELS = {'br': 11, 'zstd': 19, 'gzip': 9}
+STREAMING_LEVELS = {'br': 5, 'zstd': 3, 'gzip': 6}
+STREAMING_SIZE = 64 * 1024
+
+# Compression levels used for each content type instead of DEFAULT_LEVELS.
+# JSON responses are rarely identical so they don't benefit from the cache.
+LEVELS = {
+    'application/json': {'br': 5, 'zstd': 3, 'gzip': 6}
+}
+
+# Maximum number of compressed bodies and bytes kept in memory per worker.
+CACHE_MAXSIZE = 1024
+CACHE_MAXBYTES = 32 * 1024 * 1024
+
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+
+
+def _gzip_app_iter(app_iter, level=DEFAULT_LEVELS['gzip']):
+    size = 0
+    crc = zlib.crc32(b'') & 0xffffffff
+    compress = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zlib.DEF_MEM_LEVEL, 0)
+
+    yield _GZIP_HEADER
+    for item in app_iter:
+        size += len(item)
+        crc = zlib.crc32(item, crc) & 0xffffffff
+
+        # The compressor buffers small inputs so may return nothing.
+        result = compress.compress(item)
+        if result:
+            yield result
+
+    result = compress.flush()
+    if result:
+        yield result
+    yield struct.pack('<2L', crc, size & 0xffffffff)
+
+
+def _brotli_app_iter(app_iter, level=DEFAULT_LEVELS['br']):
+    compress = brotli.Compressor(quality=level)
+    for item in app_iter:
+        result = compress.compress(item)
+        if result:
+            yield result
+
+    result = compress.finish()
+    if result:
+        yield result
+
+
+def _zstd_app_iter(app_iter, level=DEFAULT_LEVELS['zstd']):
+    compress = zstandard.ZstdCompressor(level=level).compressobj()
+    for item in app_iter:
+        result = compress.compress(item)
+        if result:
+            yield result
+
+    result = compress.flush()
+    if result:
+        yield result
+
+
+_ENCODERS = {
+    'br': _brotli_app_iter,
+    'zstd': _zstd_app_iter,
+    'gzip': _gzip_app_iter
+}
+
+
+def _level(encoding, content_type, size, levels):
+    """Chooses the compression level for a response body of ``size``
+    bytes or a stream of unknown length if ``size`` is ``None``.
+    """
+    if size is None or size > STREAMING_SIZE:
+        return STREAMING_LEVELS[encoding]
+    return levels.get(content_type, {}).get(
+        encoding, DEFAULT_LEVELS[encoding]
+    )
+
+
+def _md5_etag(body):
+    md5_digest = base64.b64encode(hashlib.md5(body).digest())
+    return md5_digest.replace(b'\n', b'').decode('utf8').strip('=')
+
+
+def _encode(body, encoding, level):
+    compressed = b''.join(_ENCODERS[encoding]([body], level))
+    if len(body) < len(compressed):
+        return None
+    return compressed, _md5_etag(compressed)
+
+
+def _compress(body, encoding, level, cache=None):
+    """Returns the compressed body and its ETag or ``None`` if
+    compressing doesn't make the body any shorter. Results are
+    stored in ``cache`` keyed by the body's hash. A body is only
+    compressed with ``level`` once it's found in the cache, until
+    then it's compressed with at most the streaming level.
+    """
+    fast_level = min(level, STREAMING_LEVELS[encoding])
+    if cache is None:
+        return _encode(body, encoding, fast_level)
+
+    key = (hashlib.blake2b(body).digest(), encoding, level)
+    result = cache.get(key)
+    if result is not None and result[1]:
+        return result[0]
+
+    if result is None:
+        compressed = _encode(body, encoding, fast_level)
+        final = compressed is None or fast_level == level
+    else:
+        compressed = _encode(body, encoding, level)
+        final = True
+
+    weight = len(compressed[0]) if compressed is not None else 0
+    cache.set(key, (compressed, final), weight=weight)
+    return compressed
 
-def _compressor(request, response):
+
+def _compressor(request, response, cache=None, levels=None):
 
     # Skip items with Vary: Cookie/Authorization for safety from CRIME.
-    if (response.vary is not None and
-            set(response.vary) & {'Cookie', 'Authorization'}):
+    vary = request.response_vary
+    if response.vary is not None:
+        vary = vary.union(response.vary)
+    if vary & {'Cookie', 'Authorization'}:
         return
 
     # Content is already compressed or encoded.
     if 'Content-Encoding' in response.headers:
         return
 
-    # Ensure that Accept-Encoding header gets added to the response.
-    vary = set(response.vary if response.vary is not None else [])
-    vary.add('Accept-Encoding')
-    response.vary = vary
+    # Ensure that Accept-Encoding header gets added to the response
+    # once the Vary header is merged in armonaut.headers.
+    request.response_vary.add('Accept-Encoding')
 
     target_encoding = request.accept_encoding.best_match(
         ENCODINGS, default_match='identity'
     )
+    if target_encoding == 'identity':
+        return
+
+    if levels is None:
+        levels = LEVELS
 
     streaming = not isinstance(response.app_iter, Sequence)
 
@@ -51,36 +195,57 @@ def _compressor(request, response):
         streaming = False
 
     if streaming:
-        response.encode_content(encoding=target_encoding, lazy=True)
+        level = _level(target_encoding, response.content_type, None, levels)
+        response.app_iter = _ENCODERS[target_encoding](
+            response.app_iter, level
+        )
+        response.content_encoding = target_encoding
         response.content_length = None
 
         # Recalculate the ETag header after encoding.
         if response.etag is not None:
-            md5_digest = hashlib.md5((response.etag + ';gzip').encode('utf8'))
-            md5_digest = md5_digest.digest()
-            md5_digest = base64.b64encode(md5_digest)
-            md5_digest = md5_digest.replace(b'\n', b'').decode('utf8')
-            response.etag = md5_digest.strip('=')
+            response.etag = _md5_etag(
+                (response.etag + ';' + target_encoding).encode('utf8')
+            )
     else:
-        original_length = len(response.body)
-        response.encode_content(encoding=target_encoding, lazy=False)
-
-        # Compression didn't make a shorter response so undo everything we did.
-        if original_length < len(response.body):
-            response.decode_content()
-
-        # Calculate an MD5 ETag header
-        if response.content_encoding is not None:
-            response.md5_etag()
-
+        body = response.body
+        level = _level(target_encoding, response.content_type,
+                       len(body), levels)
+        compressed = _compress(body, target_encoding, level, cache)
+
+        # Compression didn't make a shorter response so leave it as is.
+        if compressed is None:
+            return
+
+        response.body, etag = compressed
+        response.content_encoding = target_encoding
+
+        # Use an MD5 ETag header of the compressed body
+        response.etag = etag
+
+
+def compression_tween_factory(handler, registry):
+    settings = registry.settings
+
+    levels = {
+        content_type: dict(content_type_levels)
+        for content_type, content_type_levels in LEVELS.items()
+    }
+    for content_type, content_type_levels in settings.get(
+            'compression.levels', {}).items():
+        levels.setdefault(content_type, {}).update(content_type_levels)
+    cache = LRUCache(
+        maxsize=settings.get('compression.cache_maxsize', CACHE_MAXSIZE),
+        maxweight=settings.get('compression.cache_maxbytes', CACHE_MAXBYTES)
+    )
+    compressor = functools.partial(_compressor, cache=cache, levels=levels)
 
-def compression_tween_factory(handler, _):
     def compression_tween(request):
         response = handler(request)
 
         # Use add_response_callback so that we can be sure that all other
         # response callbacks have been called already to use Vary headers.
-        request.add_response_callback(_compressor)
+        request.add_response_callback(compressor)
         return response
 
     return compression_tween
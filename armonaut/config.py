@@ -84,19 +84,50 @@ def configure(settings=None) -> Configurator:
     maybe_set(settings, 'armonaut.secret', 'ARMONAUT_SECRET')
     maybe_set(settings, 'armonaut.domain', 'ARMONAUT_DOMAIN')
 
+    maybe_set(settings, 'redis.max_connections', 'REDIS_MAX_CONNECTIONS',
+              coercer=int, default=50)
+    maybe_set(settings, 'redis.pool_timeout', 'REDIS_POOL_TIMEOUT',
+              coercer=int, default=20)
+
     maybe_set(settings, 'celery.broker_url', 'REDIS_URL')
     maybe_set(settings, 'celery.result_url', 'REDIS_URL')
     maybe_set(settings, 'celery.scheduler_url', 'REDIS_URL')
     maybe_set(settings, 'database.url', 'DATABASE_URL')
+    maybe_set(settings, 'database.replica_urls', 'DATABASE_REPLICA_URLS',
+              coercer=lambda value: value.split())
+    maybe_set(settings, 'database.replica_selection',
+              'DATABASE_REPLICA_SELECTION', default='round_robin')
+    maybe_set(settings, 'database.replica_max_lag',
+              'DATABASE_REPLICA_MAX_LAG', coercer=float, default=5.0)
+    maybe_set(settings, 'database.repeated_statement_threshold',
+              'DATABASE_REPEATED_STATEMENT_THRESHOLD', coercer=int,
+              default=10)
     maybe_set(settings, 'ratelimit.url', 'REDIS_URL')
 
     maybe_set(settings, 'sessions.url', 'REDIS_URL')
     maybe_set(settings, 'sessions.secret', 'ARMONAUT_SECRET')
+    maybe_set(settings, 'sessions.backend', 'SESSIONS_BACKEND',
+              default='redis')
+    maybe_set(settings, 'sessions.cookie_max_size',
+              'SESSIONS_COOKIE_MAX_SIZE', coercer=int, default=2048)
+    maybe_set(settings, 'sessions.storage', 'SESSIONS_STORAGE',
+              default='string')
+    maybe_set(settings, 'sessions.touch_interval', 'SESSIONS_TOUCH_INTERVAL',
+              coercer=int, default=5 * 60)
+    maybe_set(settings, 'sessions.local_cache_size',
+              'SESSIONS_LOCAL_CACHE_SIZE', coercer=int, default=0)
+    maybe_set(settings, 'sessions.local_cache_bytes',
+              'SESSIONS_LOCAL_CACHE_BYTES', coercer=int,
+              default=16 * 1024 * 1024)
+    maybe_set(settings, 'sessions.local_cache_ttl',
+              'SESSIONS_LOCAL_CACHE_TTL', coercer=int, default=60)
 
     maybe_set(settings, 'oauth.state_storage_url', 'REDIS_URL')
     maybe_set(settings, 'oauth.client_id', 'GITHUB_OAUTH_ID')
     maybe_set(settings, 'oauth.client_secret', 'GITHUB_OAUTH_SECRET')
 
+    maybe_set(settings, 'github.cache_url', 'REDIS_URL')
+
     maybe_set(settings, 'logging.level', 'LOGGING_LEVEL')
 
     maybe_set(settings, 'sentry.dsn', 'SENTRY_DSN')
@@ -111,6 +142,19 @@ def configure(settings=None) -> Configurator:
     maybe_set(settings, 'pusher.api_secret', 'PUSHER_API_SECRET')
     maybe_set(settings, 'pusher.region', 'PUSHER_REGION')
 
+    maybe_set(settings, 'webhooks.url', 'REDIS_URL')
+
+    maybe_set(settings, 'builds.max_jobs_per_project',
+              'BUILDS_MAX_JOBS_PER_PROJECT', coercer=int)
+    maybe_set(settings, 'builds.max_jobs_per_owner',
+              'BUILDS_MAX_JOBS_PER_OWNER', coercer=int)
+    maybe_set(settings, 'builds.retention_days',
+              'BUILDS_RETENTION_DAYS', coercer=int)
+
+    maybe_set(settings, 'events.url', 'REDIS_URL')
+    maybe_set(settings, 'events.window', 'EVENTS_WINDOW',
+              coercer=float, default=1.0)
+
     maybe_set(settings, 'mail.host', 'MAIL_HOST')
     maybe_set(settings, 'mail.port', 'MAIL_PORT')
     maybe_set(settings, 'mail.username', 'MAIL_USERNAME')
@@ -182,6 +226,9 @@ def configure(settings=None) -> Configurator:
     # Register support for database connections
     config.include('.db')
 
+    # Register shared Redis connection pools
+    config.include('.redis')
+
     # Register support for celery tasks
     config.include('.tasks')
 
@@ -197,15 +244,21 @@ def configure(settings=None) -> Configurator:
     # Register authentication
     config.include('.auth')
 
-    # Register XSS protections
-    config.include('.xss')
+    # Register XSS protections and other security headers
+    config.include('.headers')
 
     # Register Domain predicates
     config.include('.domain')
 
+    # Register Projects
+    config.include('.project')
+
     # Register Webhooks
     config.include('.webhooks')
 
+    # Register Build scheduling
+    config.include('.build')
+
     # Register Object Storage
     config.include('.storage')
 
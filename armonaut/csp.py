@@ -13,11 +13,13 @@
 # limitations under the License.
 
 import collections
-import copy
 
 SELF = '\'self\''
 NONE = '\'none\''
 
+# Number of distinct serialized policies to remember per worker.
+CACHE_MAXSIZE = 128
+
 
 def _serialize_policy(policy) -> str:
     return '; '.join([
@@ -26,38 +28,71 @@ def _serialize_policy(policy) -> str:
     ])
 
 
-def content_security_policy_tween_factory(handler, registry):
-    def content_security_policy_tween(request):
-        resp = handler(request)
-
-        try:
-            policy = request.find_service(name='csp')
-        except ValueError:
-            policy = collections.defaultdict(list)
-
-        # Disable Content-Security-Policy for debugtoolbar
-        policy = _serialize_policy(policy).format(request=request)
-        if not request.path.startswith('/_debug_toolbar/') and policy:
-            resp.headers['Content-Security-Policy'] = policy
-
-        return resp
-    return content_security_policy_tween
+def policy_header(policy, cache):
+    """Returns the serialized header for the policy and whether it
+    has to be formatted with the request. Headers are memoized by
+    the policy's frozen form so only new variants are serialized.
+    """
+    key = policy.freeze()
+    header = cache.get(key)
+    if header is None:
+        serialized = _serialize_policy(policy)
+        header = (serialized, '{' in serialized)
+        cache.set(key, header)
+    return header
 
 
 class ContentSecurityPolicy(collections.defaultdict):
+    """Sources are stored as tuples so that every change goes through
+    __setitem__ and the frozen form used as a cache key can't go stale.
+    Use merge() to add sources to a policy.
+    """
     def __init__(self, policy=None):
-        super().__init__(list, policy or {})
+        super().__init__(tuple, {
+            key: tuple(attrs) for key, attrs in (policy or {}).items()
+        })
+        self._frozen = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, tuple(value))
+        self._frozen = None
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._frozen = None
 
     def merge(self, policy):
         for key, attrs in policy.items():
-            self[key].extend(attrs)
+            self[key] = self[key] + tuple(attrs)
 
+    def freeze(self):
+        if self._frozen is None:
+            self._frozen = tuple(sorted(self.items()))
+        return self._frozen
 
-def csp_factory(_, request):
+    def copy(self):
+        policy = type(self)()
+        dict.update(policy, self)
+        policy._frozen = self._frozen
+        return policy
+
+
+def default_policy(registry):
     try:
-        return ContentSecurityPolicy(copy.deepcopy(request.registry.settings['csp']))
-    except KeyError:
-        return ContentSecurityPolicy({})
+        return registry.csp_policy
+    except AttributeError:
+        policy = ContentSecurityPolicy(registry.settings.get('csp', {}))
+        policy.freeze()
+        registry.csp_policy = policy
+        return policy
+
+
+def csp_factory(_, request):
+    policy = default_policy(request.registry).copy()
+    # Lets armonaut.headers find the policy without creating the
+    # request's service container when a view never asked for it.
+    request.environ['armonaut.csp'] = policy
+    return policy
 
 
 def includeme(config):
@@ -75,4 +110,3 @@ def includeme(config):
         'script-src': [SELF],
         'style-src': [SELF, 'fonts.googleapis.com']
     })
-    config.add_tween('armonaut.csp.content_security_policy_tween_factory')
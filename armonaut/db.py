@@ -12,9 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import functools
+import itertools
+import re
+import threading
+import time
 import alembic.config
 import sqlalchemy
+import sqlalchemy.exc
 import psycopg2.extensions
 import venusian
 from sqlalchemy import event
@@ -88,6 +94,114 @@ def _reset(dbapi_connection, connection_record):
         )
 
 
+# Number of times the same statement fingerprint may be issued by a
+# single request or task before it's reported as a likely N+1 query.
+REPEATED_STATEMENT_THRESHOLD = 10
+
+# Seconds that a replica may lag behind the primary
+# before read-only requests stop being routed to it.
+REPLICA_MAX_LAG = 5.0
+
+# Seconds between checking a replica's lag or retrying a down replica.
+REPLICA_CHECK_INTERVAL = 5.0
+
+_FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' ')
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """
+    Normalizes a statement by replacing literals and parameters with
+    placeholders so that the same query with different values has
+    the same fingerprint.
+    """
+    for pattern, replacement in _FINGERPRINT_PATTERNS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class StatementStats(object):
+    """
+    Records the statements that a request or task issues.
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = collections.Counter()
+
+    def record(self, statement: str, duration: float):
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold: int):
+        """
+        Returns (fingerprint, count) for every statement that
+        was issued more than ``threshold`` times.
+        """
+        return [
+            (statement, count)
+            for statement, count in self.fingerprints.most_common()
+            if count > threshold
+        ]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Starts timing a statement if the connection is being instrumented.
+    """
+    if 'armonaut.statements' in conn.info:
+        conn.info.setdefault('armonaut.statement_start', []).append(
+            time.perf_counter()
+        )
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Records a statement and its duration if the connection is being instrumented.
+    """
+    stats = conn.info.get('armonaut.statements')
+    starts = conn.info.get('armonaut.statement_start')
+    if stats is not None and starts:
+        stats.record(statement, time.perf_counter() - starts.pop())
+
+
+def _handle_error(context):
+    """
+    Discards the start time of a statement that failed.
+    """
+    connection = context.connection
+    if connection is not None and connection.info.get('armonaut.statement_start'):
+        connection.info['armonaut.statement_start'].pop()
+
+
+def _log_statements(request, stats: StatementStats):
+    """
+    Binds the statements that the request issued into request.log
+    and warns about statements that look like N+1 queries.
+    """
+    request.log = request.log.bind(**{
+        'db.statements': stats.count,
+        'db.duration_ms': round(stats.duration * 1000, 3)
+    })
+    request.log.info('Database statements')
+
+    threshold = request.registry.settings.get(
+        'database.repeated_statement_threshold', REPEATED_STATEMENT_THRESHOLD
+    )
+    for statement, count in stats.repeated(threshold):
+        request.log.warning('Repeated database statement', **{
+            'db.fingerprint': statement,
+            'db.repeats': count
+        })
+
+
 def _create_engine(url: str):
     """
     Creates the SQLAlchemy engine from the ``database.url`` setting
@@ -100,32 +214,178 @@ def _create_engine(url: str):
         pool_timeout=20
     )
     event.listen(engine, 'reset', _reset)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
     return engine
 
 
+def _replica_lag_query(server_version_info) -> str:
+    """
+    Returns a query for the seconds the replica is behind the primary.
+    A replica that has replayed everything it received isn't lagging
+    even if the primary hasn't written anything in a while.
+    """
+    if server_version_info is not None and server_version_info >= (10,):
+        receive, replay = 'pg_last_wal_receive_lsn()', 'pg_last_wal_replay_lsn()'
+    else:
+        receive, replay = 'pg_last_xlog_receive_location()', 'pg_last_xlog_replay_location()'
+    return (
+        f'SELECT CASE WHEN {receive} = {replay} THEN 0 '
+        f'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+    )
+
+
+class _Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def needs_check(self, now: float, interval: float) -> bool:
+        return self.checked_at is None or now - self.checked_at >= interval
+
+    def claim_check(self, now: float, interval: float) -> bool:
+        """
+        Returns True if the caller should check the replica's lag now.
+        Only one of the threads that find it due for a check does so.
+        """
+        with self._lock:
+            if not self.needs_check(now, interval):
+                return False
+            self.checked_at = now
+            return True
+
+    def failed(self, now: float):
+        with self._lock:
+            self.checked_at = now
+            self.lag = None
+
+    def usable(self, now: float, interval: float, max_lag: float) -> bool:
+        if self.needs_check(now, interval):
+            return True
+        lag = self.lag
+        return lag is not None and lag <= max_lag
+
+
+class ReplicaSet(object):
+    """
+    Chooses the read replica to connect to for read-only requests.
+    Replicas are chosen round-robin or by the fewest checked out
+    connections. Replicas that are down or lag behind the primary
+    by more than ``max_lag`` seconds are skipped until they're
+    checked again ``check_interval`` seconds later.
+    """
+    def __init__(self, engines, selection='round_robin',
+                 max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_CHECK_INTERVAL):
+        if selection not in {'round_robin', 'least_connections'}:
+            raise ValueError(f'Unknown replica selection {selection!r}')
+        self.replicas = [_Replica(engine) for engine in engines]
+        self.selection = selection
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._counter = itertools.count()
+
+    def _candidates(self, now: float):
+        replicas = [
+            replica for replica in self.replicas
+            if replica.usable(now, self.check_interval, self.max_lag)
+        ]
+        if self.selection == 'least_connections':
+            return sorted(replicas, key=lambda replica: replica.engine.pool.checkedout())
+        if replicas:
+            start = next(self._counter) % len(replicas)
+            replicas = replicas[start:] + replicas[:start]
+        return replicas
+
+    def connect(self):
+        """
+        Returns a connection to a usable replica or None if there isn't
+        one, in which case the primary should be used instead.
+        """
+        now = time.monotonic()
+        for replica in self._candidates(now):
+            try:
+                connection = replica.engine.connect()
+            except sqlalchemy.exc.DBAPIError:
+                replica.failed(now)
+                continue
+
+            if replica.claim_check(now, self.check_interval):
+                query = _replica_lag_query(replica.engine.dialect.server_version_info)
+                try:
+                    replica.lag = float(connection.scalar(query) or 0)
+                except sqlalchemy.exc.DBAPIError:
+                    replica.failed(now)
+                    connection.close()
+                    continue
+
+            # The lag isn't known yet while another thread
+            # checks it for the first time or after a failure.
+            lag = replica.lag
+            if lag is None or lag > self.max_lag:
+                connection.close()
+                continue
+            return connection
+        return None
+
+
+def _create_replicas(settings):
+    """
+    Creates the ReplicaSet from the ``database.replica_urls`` setting
+    """
+    urls = settings.get('database.replica_urls') or []
+    if not urls:
+        return None
+    return ReplicaSet(
+        [_create_engine(url) for url in urls],
+        selection=settings.get('database.replica_selection', 'round_robin'),
+        max_lag=settings.get('database.replica_max_lag', REPLICA_MAX_LAG),
+        check_interval=settings.get(
+            'database.replica_check_interval', REPLICA_CHECK_INTERVAL
+        )
+    )
+
+
 def _create_session(request) -> sqlalchemy.orm.Session:
     """
     Creates a session for the request. If the request is read-only then
-    the database is set in read-only mode as well for security.
+    it's routed to a read replica when there is a usable one and the
+    database is set in read-only mode as well for security.
     """
-    connection = request.registry['sqlalchemy.engine'].connect()
+    connection = None
+    replicas = request.registry.get('sqlalchemy.replicas')
+    if request.read_only and replicas is not None:
+        connection = replicas.connect()
+    replica = connection is not None
+    if connection is None:
+        connection = request.registry['sqlalchemy.engine'].connect()
 
     # Issue where sometimes the first connection errors so we want
-    # to discard that first connection if it's not idle.
+    # to discard that first connection if it's not idle. This also
+    # ends the transaction that a replica's lag check started.
     if (connection.connection.get_transaction_status() !=
             psycopg2.extensions.TRANSACTION_STATUS_IDLE):
         connection.connection.rollback()
 
     # If we receive a read-only request then we can set
     # the isolation level of the session to be read-only.
+    # Hot standbys don't support SERIALIZABLE so replicas are
+    # read with REPEATABLE READ which is what they provide.
     if request.read_only:
         connection.info['armonaut.needs_reset'] = True
         connection.connection.set_session(
-            isolation_level='SERIALIZABLE',
+            isolation_level='REPEATABLE READ' if replica else 'SERIALIZABLE',
             readonly=True,
-            deferrable=True
+            deferrable=not replica
         )
 
+    # Record statements from scratch for every request as the
+    # stats live on the pooled connection it's shared with.
+    stats = StatementStats()
+    connection.info['armonaut.statements'] = stats
+
     # Create the session bound to our connection
     session = Session(bind=connection)
 
@@ -135,11 +395,24 @@ def _create_session(request) -> sqlalchemy.orm.Session:
     @request.add_finished_callback
     def cleanup(request):
         session.close()
+        connection.info.pop('armonaut.statements', None)
+        connection.info.pop('armonaut.statement_start', None)
         connection.close()
+        _log_statements(request, stats)
 
     return session
 
 
+def _statement_count(request) -> int:
+    """
+    Returns the number of SQL statements the request has issued so far.
+    """
+    if 'db' not in request.__dict__:
+        return 0
+    stats = request.db.connection().info.get('armonaut.statements')
+    return stats.count if stats is not None else 0
+
+
 def _is_readonly(request) -> bool:
     if request.matched_route is not None:
         for predicate in request.matched_route.predicates:
@@ -157,8 +430,14 @@ def includeme(config):
         config.registry.settings['database.url']
     )
 
+    # Create the engines for read replicas, if there are any
+    config.registry['sqlalchemy.replicas'] = _create_replicas(
+        config.registry.settings
+    )
+
     # Add a request method to create a database session
     config.add_request_method(_create_session, name='db', reify=True)
+    config.add_request_method(_statement_count, name='db_statement_count', property=True)
 
     # Add support for marking certain routes as read-only.
     config.add_route_predicate('read_only', ReadOnlyPredicate)
@@ -33,3 +33,8 @@ def includeme(config):
     config.registry['pusher.client'] = client
 
     config.add_request_method(_pusher, name='pusher', reify=True)
+
+    # Imported here as the service imports the event names from this module.
+    from armonaut.events.interfaces import IEventPublisher
+    from armonaut.events.services import event_publisher_factory
+    config.register_service_factory(event_publisher_factory, IEventPublisher)
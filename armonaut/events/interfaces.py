@@ -0,0 +1,30 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from zope.interface import Interface
+
+
+class IEventPublisher(Interface):
+    def publish(channels, event, data):
+        """
+        Buffers an event for all channels once the current transaction
+        commits. Status updates for the same build or job that haven't
+        been sent yet are replaced so that only the latest is delivered.
+        """
+
+    def flush():
+        """
+        Sends all buffered events to Pusher in batches and
+        returns the number of calls made to the Pusher API.
+        """
@@ -0,0 +1,129 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import redis
+from zope.interface import implementer
+from armonaut.events import EVENT_JOB_STATUS, EVENT_BUILD_STATUS
+from armonaut.events.interfaces import IEventPublisher
+from armonaut.events.tasks import flush_events
+from armonaut.redis import connection_pool
+from armonaut.utils import crypto
+
+# Pusher accepts at most 10 events per batch trigger.
+MAX_BATCH_SIZE = 10
+
+# Events where a newer event for the same object replaces an older one.
+COLLAPSIBLE_EVENTS = {EVENT_JOB_STATUS, EVENT_BUILD_STATUS}
+
+
+@implementer(IEventPublisher)
+class RedisEventPublisher:
+    pending_key = 'armonaut/events/pending'
+    scheduled_key = 'armonaut/events/scheduled'
+
+    def __init__(self, url, pusher, flush_task, window=1.0,
+                 connection_pool=None):
+        if connection_pool is not None:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis.from_url(url)
+        self.pusher = pusher
+        self.flush_task = flush_task
+        self.window = window
+        self._pending = {}
+
+    def publish(self, channels, event, data):
+        if isinstance(channels, str):
+            channels = [channels]
+
+        for channel in channels:
+            self._pending[self._event_key(channel, event, data)] = json.dumps({
+                'channel': channel,
+                'name': event,
+                'data': data,
+                'time': time.time()
+            })
+
+    def flush(self):
+        # The flush is unscheduled along with taking the pending events
+        # otherwise events published after this but before the scheduled
+        # key expires wouldn't schedule a flush of their own.
+        pipeline = self.redis.pipeline()
+        pipeline.hgetall(self.pending_key)
+        pipeline.delete(self.pending_key, self.scheduled_key)
+        pending, _ = pipeline.execute()
+
+        pending = sorted(
+            ((key, value, json.loads(value)) for key, value in pending.items()),
+            key=lambda item: item[2]['time']
+        )
+        for i in range(0, len(pending), MAX_BATCH_SIZE):
+            try:
+                self.pusher.trigger_batch([
+                    {'channel': event['channel'],
+                     'name': event['name'],
+                     'data': event['data']}
+                    for _, _, event in pending[i:i + MAX_BATCH_SIZE]
+                ])
+            except Exception:
+                self._requeue(pending[i:])
+                raise
+        return (len(pending) + MAX_BATCH_SIZE - 1) // MAX_BATCH_SIZE
+
+    def _requeue(self, pending):
+        """Puts events which couldn't be sent back so that they're sent
+        by the next flush unless a newer event has replaced them since.
+        """
+        pipeline = self.redis.pipeline()
+        for key, value, _ in pending:
+            pipeline.hsetnx(self.pending_key, key, value)
+        pipeline.execute()
+
+    def _before_commit_hook(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        # Only the first publisher within a window schedules a flush,
+        # every event published until then is sent along with it.
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self.pending_key, mapping=pending)
+        pipeline.set(self.scheduled_key, 1, nx=True,
+                     px=int(self.window * 1000))
+        _, scheduled = pipeline.execute()
+
+        if scheduled:
+            self.flush_task.apply_async(countdown=self.window)
+
+    @staticmethod
+    def _event_key(channel, event, data):
+        if (event in COLLAPSIBLE_EVENTS and
+                isinstance(data, dict) and 'id' in data):
+            return f'{channel}/{event}/{data["id"]}'
+        return f'{channel}/{event}/{crypto.random_token()}'
+
+
+def event_publisher_factory(context, request):
+    url = request.registry.settings['events.url']
+    publisher = RedisEventPublisher(
+        url,
+        request.pusher,
+        request.task(flush_events),
+        window=request.registry.settings['events.window'],
+        connection_pool=connection_pool(request.registry, url)
+    )
+    request.tm.get().addBeforeCommitHook(publisher._before_commit_hook)
+    return publisher
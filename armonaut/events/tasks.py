@@ -12,13 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import requests
+from pusher.errors import PusherError
 from armonaut import tasks
+from armonaut.events.interfaces import IEventPublisher
 
 
 @tasks.task()
 def send_event(request, channels, event, data):
-    request.pusher.trigger(
-        channels=channels,
-        event_name=event,
-        data=data
-    )
+    publisher = request.find_service(IEventPublisher, context=None)
+    publisher.publish(channels, event, data)
+
+
+# Events which couldn't be sent are pending again when
+# the flush fails so retrying it sends them after all.
+@tasks.task(
+    ignore_result=True,
+    autoretry_for=(PusherError, requests.RequestException),
+    max_retries=5,
+    retry_backoff=True
+)
+def flush_events(request):
+    publisher = request.find_service(IEventPublisher, context=None)
+    publisher.flush()
@@ -0,0 +1,137 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pyramid.interfaces import IRoutesMapper
+from pyramid.tweens import EXCVIEW, INGRESS
+from armonaut.cache.http import merge_vary
+from armonaut.cache.lru import LRUCache
+from armonaut.csp import CACHE_MAXSIZE, default_policy, policy_header
+
+SECURITY_HEADERS = (
+    ('X-Frame-Options', 'deny'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Permitted-Cross-Domain-Policies', 'none')
+)
+
+
+class _HeaderSet(object):
+    """Headers which are added to every response of a route."""
+    def __init__(self, headers):
+        self.headers = tuple(
+            (name, value) for name, value in headers.items()
+            if value is not None
+        )
+        self.names = frozenset(name.lower() for name, _ in self.headers)
+
+    def apply(self, response):
+        headerlist = response.headerlist
+        if self.names.isdisjoint(name.lower() for name, _ in headerlist):
+            headerlist.extend(self.headers)
+        else:
+            for name, value in self.headers:
+                response.headers[name] = value
+
+
+def security_headers_tween_factory(handler, registry):
+    route_headers = registry.get('headers.routes', {})
+    cache = LRUCache(
+        maxsize=registry.settings.get('csp.cache_maxsize', CACHE_MAXSIZE)
+    )
+    policy = default_policy(registry)
+    default_frozen = policy.freeze()
+    default_csp, default_templated = policy_header(policy, cache)
+    mapper = registry.queryUtility(IRoutesMapper)
+    routes = mapper.get_routes() if mapper is not None else []
+    header_sets = LRUCache(maxsize=len(routes) + 1 + cache.maxsize)
+
+    def _header_set(route_name, csp):
+        headers = dict(SECURITY_HEADERS)
+        if csp:
+            headers['Content-Security-Policy'] = csp
+        headers.update(route_headers.get(route_name, {}))
+        return _HeaderSet(headers)
+
+    # Compile the header set of every route for the default policy.
+    if not default_templated:
+        for route_name in [None] + [route.name for route in routes]:
+            header_sets.set(
+                (route_name, default_csp), _header_set(route_name, default_csp)
+            )
+
+    def _csp(request):
+        # Disable Content-Security-Policy for debugtoolbar
+        if request.path.startswith('/_debug_toolbar/'):
+            return None, False
+
+        # Views which never used the csp service get the default policy.
+        policy = request.environ.get('armonaut.csp')
+        if policy is None or policy.freeze() is default_frozen:
+            return default_csp, default_templated
+        return policy_header(policy, cache)
+
+    def finalize(request, response):
+        route = request.matched_route
+        route_name = route.name if route is not None else None
+
+        csp, templated = _csp(request)
+        if templated:
+            _header_set(route_name, csp.format(request=request)).apply(
+                response
+            )
+        else:
+            key = (route_name, csp)
+            header_set = header_sets.get(key)
+            if header_set is None:
+                header_set = _header_set(route_name, csp)
+                header_sets.set(key, header_set)
+            header_set.apply(response)
+
+        merge_vary(request, response)
+
+    def security_headers_tween(request):
+        response = handler(request)
+
+        # Use add_response_callback so that the headers are finalized
+        # after every other response callback has added to them.
+        request.add_response_callback(finalize)
+        return response
+    return security_headers_tween
+
+
+def add_route_headers(config, route_name, headers):
+    """Adds headers to every response of a route. A value of None
+    removes a header that would otherwise be added, for example
+    {'X-Frame-Options': None} for a page that may be framed.
+    """
+    def register():
+        config.registry.setdefault('headers.routes', {}).setdefault(
+            route_name, {}
+        ).update(headers)
+
+    config.action(None, register)
+
+
+def includeme(config):
+    config.add_directive('add_route_headers', add_route_headers)
+    config.add_tween(
+        'armonaut.headers.security_headers_tween_factory',
+        over=[
+            'armonaut.static.whitenoise_tween_factory',
+            'armonaut.compression.compression_tween_factory',
+            EXCVIEW
+        ],
+        under=[
+            INGRESS
+        ]
+    )
@@ -0,0 +1,39 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Index builds by project and jobs by build"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '2d8b7f3e6a91'
+down_revision = '9e4f1b6a2c53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_builds_project_id_started_at', 'builds',
+        ['project_id', sa.text('started_at DESC')], unique=False
+    )
+    op.create_index(
+        'ix_jobs_build_id_status', 'jobs', ['build_id', 'status'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_jobs_build_id_status', table_name='jobs')
+    op.drop_index('ix_builds_project_id_started_at', table_name='builds')
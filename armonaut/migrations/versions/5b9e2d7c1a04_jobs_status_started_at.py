@@ -12,22 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pyramid.tweens import INGRESS
+"""Index jobs by status and started_at for scheduling"""
 
+from alembic import op
 
-def xss_tween_factory(handler, registry):
-    def xss_tween(request):
-        response = handler(request)
-        response.headers['X-Frame-Options'] = 'deny'
-        response.headers['X-XSS-Protection'] = '1; mode=block'
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        response.headers['X-Permitted-Cross-Domain-Policies'] = 'none'
-        return response
-    return xss_tween
+# revision identifiers, used by Alembic.
+revision = '5b9e2d7c1a04'
+down_revision = 'c4e7a9d2b318'
+branch_labels = None
+depends_on = None
 
 
-def includeme(config):
-    config.add_tween(
-        'armonaut.xss.xss_tween_factory',
-        under=[INGRESS]
+def upgrade():
+    op.create_index(
+        'ix_jobs_status_started_at', 'jobs', ['status', 'started_at'],
+        unique=False
     )
+
+
+def downgrade():
+    op.drop_index('ix_jobs_status_started_at', table_name='jobs')
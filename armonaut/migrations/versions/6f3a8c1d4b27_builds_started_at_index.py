@@ -0,0 +1,34 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Index finished builds by when they started"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '6f3a8c1d4b27'
+down_revision = '2d8b7f3e6a91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_builds_started_at_finished', 'builds', ['started_at'], unique=False,
+        postgresql_where=sa.text("status NOT IN ('pending', 'running')")
+    )
+
+
+def downgrade():
+    op.drop_index('ix_builds_started_at_finished', table_name='builds')
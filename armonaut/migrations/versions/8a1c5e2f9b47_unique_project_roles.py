@@ -0,0 +1,64 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unique GitHub IDs for projects and one role per user per project"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8a1c5e2f9b47'
+down_revision = '3d5123d18b73'
+branch_labels = None
+depends_on = None
+
+
+# Every project and the lowest project id with the same GitHub ID.
+DUPLICATE_PROJECTS = (
+    'SELECT id, min(id) OVER (PARTITION BY github_id) AS keep_id FROM projects'
+)
+
+
+def upgrade():
+    # Syncing users concurrently could create duplicate projects and
+    # roles before there were constraints against them. The lowest id
+    # is kept and everything referring to a duplicate is moved to it.
+    for table in ('builds', 'project_roles'):
+        op.execute(
+            f'UPDATE {table} SET project_id = duplicates.keep_id '
+            f'FROM ({DUPLICATE_PROJECTS}) AS duplicates '
+            f'WHERE {table}.project_id = duplicates.id '
+            f'AND duplicates.id <> duplicates.keep_id'
+        )
+    op.execute(
+        f'DELETE FROM projects USING ({DUPLICATE_PROJECTS}) AS duplicates '
+        f'WHERE projects.id = duplicates.id AND duplicates.id <> duplicates.keep_id'
+    )
+    op.execute(
+        'DELETE FROM project_roles USING ('
+        'SELECT id, min(id) OVER (PARTITION BY project_id, user_id) AS keep_id '
+        'FROM project_roles) AS duplicates '
+        'WHERE project_roles.id = duplicates.id AND duplicates.id <> duplicates.keep_id'
+    )
+
+    op.drop_index('ix_projects_github_id', table_name='projects')
+    op.create_index(op.f('ix_projects_github_id'), 'projects', ['github_id'], unique=True)
+    op.create_unique_constraint(
+        'uix_project_roles_user', 'project_roles', ['project_id', 'user_id']
+    )
+
+
+def downgrade():
+    op.drop_constraint('uix_project_roles_user', 'project_roles', type_='unique')
+    op.drop_index(op.f('ix_projects_github_id'), table_name='projects')
+    op.create_index('ix_projects_github_id', 'projects', ['github_id'], unique=False)
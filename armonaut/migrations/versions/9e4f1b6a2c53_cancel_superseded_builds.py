@@ -0,0 +1,54 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cancel superseded builds"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9e4f1b6a2c53'
+down_revision = '5b9e2d7c1a04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Values can't be added to an enum inside of a transaction.
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE status ADD VALUE IF NOT EXISTS 'cancelled'")
+
+    op.add_column('jobs', sa.Column('task_id', sa.String(length=36), nullable=True))
+    op.add_column('projects', sa.Column(
+        'auto_cancel', sa.Boolean(), server_default=sa.true(), nullable=False
+    ))
+
+
+def downgrade():
+    op.drop_column('projects', 'auto_cancel')
+    op.drop_column('jobs', 'task_id')
+
+    # Postgres can't drop a value from an enum so the type is recreated.
+    for table in ('builds', 'jobs'):
+        op.execute(f"UPDATE {table} SET status = 'error' WHERE status = 'cancelled'")
+    op.execute('ALTER TYPE status RENAME TO status_old')
+    op.execute(
+        "CREATE TYPE status AS ENUM "
+        "('pending', 'running', 'success', 'failure', 'error')"
+    )
+    for table in ('builds', 'jobs'):
+        op.execute(
+            f'ALTER TABLE {table} ALTER COLUMN status '
+            f'TYPE status USING status::text::status'
+        )
+    op.execute('DROP TYPE status_old')
@@ -0,0 +1,35 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Add acl_version to projects"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c4e7a9d2b318'
+down_revision = '8a1c5e2f9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'projects',
+        sa.Column('acl_version', sa.Integer(), server_default='0', nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_column('projects', 'acl_version')
@@ -0,0 +1,38 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unique index on projects by their webhook id"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e1b5d9a3f740'
+down_revision = '6f3a8c1d4b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A webhook can only belong to one project so only the lowest
+    # project id keeps one which is shared, the others lose theirs.
+    op.execute(
+        'UPDATE projects SET webhook_id = NULL, webhook_secret = NULL FROM ('
+        'SELECT id, min(id) OVER (PARTITION BY webhook_id) AS keep_id '
+        'FROM projects WHERE webhook_id IS NOT NULL) AS duplicates '
+        'WHERE projects.id = duplicates.id AND duplicates.id <> duplicates.keep_id'
+    )
+    op.create_index(op.f('ix_projects_webhook_id'), 'projects', ['webhook_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_projects_webhook_id'), table_name='projects')
@@ -11,3 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+from armonaut.project.interfaces import IConditionalRequestCache
+from armonaut.project.services import conditional_request_cache_factory
+from armonaut.project.tasks import synchronize_all_users
+
+
+def includeme(config):
+    config.register_service_factory(
+        conditional_request_cache_factory,
+        IConditionalRequestCache
+    )
+
+    # Re-synchronize all users every 6 hours so that new repositories
+    # and changes to access show up without the user logging in again.
+    config.add_periodic_task(6 * 60 * 60, synchronize_all_users)
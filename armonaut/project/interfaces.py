@@ -0,0 +1,44 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from zope.interface import Interface
+
+
+class IConditionalRequestCache(Interface):
+    def get(key):
+        """
+        Returns the ETag and Last-Modified information stored
+        for a GitHub page or None if nothing is stored.
+        """
+
+    def set(key, etag, last_modified):
+        """
+        Stores the ETag and Last-Modified information for a
+        GitHub page once the current transaction commits.
+        """
+
+    def hit():
+        """
+        Records that a conditional request returned 304 Not Modified.
+        """
+
+    def miss():
+        """
+        Records that a conditional request returned new content.
+        """
+
+    def stats():
+        """
+        Returns the number of hits and misses for the cache.
+        """
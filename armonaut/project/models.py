@@ -13,12 +13,24 @@
 # limitations under the License.
 
 import enum
-from sqlalchemy import Column, BigInteger, Enum, String, UniqueConstraint, ForeignKey, Boolean
-from sqlalchemy.orm import relationship, object_session, lazyload
+from sqlalchemy import (Column, BigInteger, Integer, Enum, String,
+                        UniqueConstraint, ForeignKey, Boolean, inspect, sql)
+from sqlalchemy.orm import relationship, object_session, lazyload, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.util import identity_key
 from pyramid.authorization import Allow, Everyone
 from pyramid.security import DENY_ALL
-from armonaut.db import Model
+from armonaut.cache.lru import LRUCache
+from armonaut.db import Model, listens_for
+
+# ACLs are keyed by the project's ``acl_version`` which is loaded along with
+# the project itself so a cached ACL can never be used after a role changes.
+_acl_cache = LRUCache(maxsize=4096)
+
+# Maps (owner, name) to the project's id so hot projects
+# are looked up by their primary key during traversal.
+_slug_cache = LRUCache(maxsize=4096)
 
 
 class ProjectRoleType(enum.Enum):
@@ -29,6 +41,9 @@ class ProjectRoleType(enum.Enum):
 
 class ProjectRole(Model):
     __tablename__ = 'project_roles'
+    __table_args__ = (
+        UniqueConstraint('project_id', 'user_id', name='uix_project_roles_user'),
+    )
 
     role_type = Column(Enum(ProjectRoleType), nullable=False)
     user = relationship('User', uselist=False, back_populates='roles')
@@ -48,7 +63,7 @@ class Project(Model):
     __tablename__ = 'projects'
     __table_args__ = (UniqueConstraint('name', 'owner', name='uix_slug'),)
 
-    github_id = Column(BigInteger, nullable=False, index=True)
+    github_id = Column(BigInteger, nullable=False, index=True, unique=True)
 
     name = Column(String(255), nullable=False, index=True)
     owner = Column(String(255), nullable=False, index=True)
@@ -56,9 +71,16 @@ class Project(Model):
     public = Column(Boolean, nullable=False)
     active = Column(Boolean, nullable=False)
 
-    webhook_id = Column(BigInteger)
+    webhook_id = Column(BigInteger, index=True, unique=True)
     webhook_secret = Column(String(255))
 
+    # Incremented whenever a ProjectRole for the project changes.
+    acl_version = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # Set from ``auto_cancel`` in the project's ``.armonaut.yml``.
+    auto_cancel = Column(Boolean, nullable=False, default=True,
+                         server_default=sql.true())
+
     builds = relationship('Build', back_populates='project')
     roles = relationship('ProjectRole', back_populates='project')
 
@@ -67,12 +89,28 @@ class Project(Model):
         return f'{self.owner}/{self.name}'
 
     def __acl__(self):
-        session = object_session(self)
+        if self.id is None:
+            return self._load_acl()
+
+        key = (self.id, self.acl_version, self.public)
+        acls = _acl_cache.get(key)
+        if acls is None:
+            acls = tuple(self._load_acl())
+            _acl_cache.set(key, acls)
+        return list(acls)
+
+    def _load_acl(self):
         acls = [(Allow, 'group:admins', ['admin'])]
 
-        query = session.query(ProjectRole).filter(ProjectRole.project == self)
-        query = query.options(lazyload('project'))
-        query = query.options(lazyload('user'))
+        # If the roles were eagerly loaded along with the
+        # project then we don't need to query for them again.
+        if 'roles' not in inspect(self).unloaded:
+            roles = self.roles
+        else:
+            query = object_session(self).query(ProjectRole).filter(ProjectRole.project == self)
+            query = query.options(lazyload('project'))
+            query = query.options(lazyload('user'))
+            roles = query.all()
 
         def sorted_key(role):
             return [
@@ -81,7 +119,7 @@ class Project(Model):
                 ProjectRoleType.READ_ONLY
             ].index(role.role_type)
 
-        for role in sorted(query.all(), key=sorted_key):
+        for role in sorted(roles, key=sorted_key):
             if role.role_type == ProjectRoleType.OWNER:
                 acls.append((
                     Allow, str(role.user_id),
@@ -102,6 +140,31 @@ class Project(Model):
         return acls
 
 
+@listens_for(ProjectRole, 'after_insert')
+@listens_for(ProjectRole, 'after_update')
+@listens_for(ProjectRole, 'after_delete')
+def _increment_acl_version(config, mapper, connection, target):
+    """Invalidates any cached ACL for the project whenever
+    one of the project's roles is changed through the ORM.
+    """
+    projects = Project.__table__
+    statement = (
+        projects.update()
+        .where(projects.c.id == target.project_id)
+        .values(acl_version=projects.c.acl_version + 1)
+        .returning(projects.c.acl_version)
+    )
+    acl_version = connection.execute(statement).scalar()
+
+    # Keep an already loaded project in sync so its next
+    # __acl__() call in this session doesn't use the old version.
+    session = object_session(target)
+    if session is not None and acl_version is not None:
+        project = session.identity_map.get(identity_key(Project, target.project_id))
+        if project is not None:
+            set_committed_value(project, 'acl_version', acl_version)
+
+
 class ProjectFactory(object):
     """Factory object for Pyramid view traversal
     in order to determine the ACLs that a user
@@ -117,17 +180,40 @@ class ProjectFactory(object):
         if self.owner is None:
             self.owner = item
             return self
-        else:
-            try:
-                project = (
-                    self.request.db.query(Project)
-                    .filter(Project.owner == self.owner)
-                    .filter(Project.name == item)
-                    .one()
-                )
+
+        slug = (self.owner, item)
+        project_id = _slug_cache.get(slug)
+        if project_id is not None:
+            project = self._query().filter(Project.id == project_id).first()
+
+            # The project may have been renamed or deleted since
+            # we cached its id so fall back to looking up the slug.
+            if project is not None and (project.owner, project.name) == slug:
                 return project
-            except NoResultFound:
-                raise KeyError from None
+            _slug_cache.pop(slug)
+
+        try:
+            project = (
+                self._query()
+                .filter(Project.owner == self.owner)
+                .filter(Project.name == item)
+                .one()
+            )
+        except NoResultFound:
+            raise KeyError from None
+
+        _slug_cache.set(slug, project.id)
+        return project
+
+    def _query(self):
+        """Query which loads a project along with the user ids
+        and role types of all its roles in a single statement
+        so that Project.__acl__() doesn't need another query.
+        """
+        return (
+            self.request.db.query(Project)
+            .options(joinedload(Project.roles).lazyload('user'))
+        )
 
     def __acl__(self):
         """We deny all here because we want to do a full traversal
@@ -0,0 +1,87 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import msgpack
+import redis
+from zope.interface import implementer
+from armonaut.project.interfaces import IConditionalRequestCache
+from armonaut.redis import connection_pool
+
+
+@implementer(IConditionalRequestCache)
+class RedisConditionalRequestCache:
+    max_age = 30 * 24 * 60 * 60  # Forget about pages not seen in 30 days.
+
+    def __init__(self, url, connection_pool=None):
+        if connection_pool is not None:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis.from_url(url)
+        self._pending = {}
+
+    def get(self, key):
+        data = self.redis.get(self._redis_key(key))
+        if data is None:
+            return None
+        return msgpack.unpackb(data, encoding='utf-8')
+
+    def set(self, key, etag, last_modified):
+        # Changes are only stored once the transaction that consumed
+        # the page commits otherwise a failed sync would be skipped
+        # by the next sync receiving a 304 for the page.
+        self._pending[key] = {
+            'etag': etag,
+            'last_modified': last_modified
+        }
+
+    def hit(self):
+        self.redis.incr(self._stats_key('hits'))
+
+    def miss(self):
+        self.redis.incr(self._stats_key('misses'))
+
+    def stats(self):
+        hits, misses = self.redis.mget(self._stats_key('hits'), self._stats_key('misses'))
+        return {'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+    def _after_commit_hook(self, success):
+        pending, self._pending = self._pending, {}
+        if not success or not pending:
+            return
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, data in pending.items():
+            pipeline.setex(
+                self._redis_key(key),
+                self.max_age,
+                msgpack.packb(data, encoding='utf-8', use_bin_type=True)
+            )
+        pipeline.execute()
+
+    @staticmethod
+    def _redis_key(key):
+        return f'armonaut/github/etag/{key}'
+
+    @staticmethod
+    def _stats_key(name):
+        return f'armonaut/github/etag-stats/{name}'
+
+
+def conditional_request_cache_factory(context, request):
+    url = request.registry.settings['github.cache_url']
+    cache = RedisConditionalRequestCache(
+        url, connection_pool=connection_pool(request.registry, url)
+    )
+    request.tm.get().addAfterCommitHook(cache._after_commit_hook)
+    return cache
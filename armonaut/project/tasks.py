@@ -12,18 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import itertools
 import re
+from concurrent.futures import ThreadPoolExecutor
+import zope.sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
 from armonaut import tasks
+from armonaut.project.interfaces import IConditionalRequestCache
 from armonaut.project.models import Project, ProjectRole, ProjectRoleType
 
-_NEXT_URL_REGEX = re.compile(r'<(https://api\.github\.com/[^>]+)>; rel="next"')
+GITHUB_REPOS_URL = 'https://api.github.com/user/repos'
+MAX_CONCURRENT_PAGES = 4
+
+_LINK_REGEX = re.compile(r'<(https://api\.github\.com/[^>]+)>; rel="(\w+)"')
+_PAGE_REGEX = re.compile(r'[?&]page=(\d+)')
 
 
 @tasks.task(ignore_result=True, acks_late=True)
-def synchronize_user(request, user):
+def synchronize_user(request, user_id):
     """Synchronizes the latest information about the user from GitHub including
     user information and all repositories the user has access to.
     """
+    # Imported here as armonaut.auth imports this module.
+    from armonaut.auth.models import User
+
+    user = request.db.query(User).get(user_id)
+    if user is None:
+        return
+
+    cache = request.find_service(IConditionalRequestCache, context=None)
+
     request.http.headers['Authorization'] = f'token {user.access_token}'
     try:
         for affiliation, project_role_type in [
@@ -31,94 +50,259 @@ def synchronize_user(request, user):
                 ('collaborator', ProjectRoleType.COLLABORATOR),
                 ('organization_member', ProjectRoleType.READ_ONLY)
         ]:
-            repos = list_all_projects(request, affiliation)
-            update_all_projects(request, user, repos, project_role_type)
+            # Update each page as soon as it arrives so that database
+            # writes overlap with fetching the remaining pages. Pages
+            # that haven't changed since the last sync aren't yielded.
+            for page in iter_project_pages(request, affiliation,
+                                           max_workers=MAX_CONCURRENT_PAGES,
+                                           cache=cache,
+                                           cache_key=f'{user.id}/{affiliation}'):
+                skipped = update_all_projects(request, user, project_role_type, page)
+
+                # Repositories without a Project are skipped for non-owners
+                # so the page has to be fetched again on the next sync
+                # otherwise the role is never created once the owner
+                # creates the Project as the page itself won't change.
+                if not skipped and (page.etag is not None or
+                                    page.last_modified is not None):
+                    cache.set(page.cache_key, page.etag, page.last_modified)
     finally:
         request.http.headers.pop('Authorization')
 
 
+@tasks.task(ignore_result=True, acks_late=True)
+def synchronize_all_users(request):
+    """Periodically re-synchronizes every user with GitHub. This is cheap
+    for users whose repositories haven't changed because every page
+    is requested conditionally on the ETag from the previous sync.
+
+    Each user is synchronized in their own task so that one user failing,
+    for instance because their access token was revoked, doesn't roll
+    back the synchronization of every other user.
+    """
+    # Imported here as armonaut.auth imports this module.
+    from armonaut.auth.models import User
+
+    count = 0
+    for user_id, in request.db.query(User.id).yield_per(1000):
+        request.task(synchronize_user).delay(user_id)
+        count += 1
+
+    stats = request.find_service(IConditionalRequestCache, context=None).stats()
+    request.log.info('Synchronizing all users', **{
+        'github.users': count,
+        'github.cache.hits': stats['hits'],
+        'github.cache.misses': stats['misses']
+    })
+
+
+class ProjectPage(list):
+    """A page of repositories along with the key and validators
+    that the page should be cached with once it's been consumed.
+    """
+    def __init__(self, repos, cache_key=None, etag=None, last_modified=None):
+        super().__init__(repos)
+        self.cache_key = cache_key
+        self.etag = etag
+        self.last_modified = last_modified
+
+
 def list_all_projects(request, affiliation):
     """Helper function which traverses GitHubs pagination API in order
     to list all of a users repositories they have access to based on
     that users affiliation to the repository.
     """
-    next_url = 'https://api.github.com/user/repos'
-    repositories = []
-    while next_url is not None:
-        with request.http.get(next_url,
-                              params={'affiliation': affiliation,
-                                      'sort': 'updated'}) as r:
-            next_url = None
+    return list(itertools.chain.from_iterable(
+        iter_project_pages(request, affiliation)
+    ))
+
 
-            # Search for a 'next' link in the Link header.
-            link = r.headers.get('Link')
-            if link:
-                match = _NEXT_URL_REGEX.search(link)
-                if match is not None:
-                    next_url = match.group(1)
+def iter_project_pages(request, affiliation, max_workers=1, cache=None, cache_key=None):
+    """Generator which yields each page of a users repositories as soon as
+    it is available. If ``max_workers`` is greater than one and GitHub
+    tells us which page is the last page then all remaining pages are
+    fetched concurrently on a pool of at most ``max_workers`` threads
+    otherwise we follow the ``rel="next"`` links one page at a time.
 
-            repositories.extend(r.json())
-    return repositories
+    If a ``cache`` is given then every page is requested conditionally
+    and pages which haven't changed since they were last stored are
+    skipped instead of being yielded. Storing a page in the cache is
+    left to the consumer via the ``cache_key`` of each ``ProjectPage``.
+    """
+    params = {'affiliation': affiliation, 'sort': 'updated'}
+
+    def get_page(url, page, last_page=None, params=params):
+        # Pages after the first are keyed on the number of pages so that
+        # an unchanged page is only skipped if the whole page set is the same.
+        if cache is None:
+            key = None
+        elif page == 1:
+            key = f'{cache_key}/1'
+        else:
+            key = f'{cache_key}/{page}/{last_page}'
+        return _get_project_page(request, url, params, cache=cache, cache_key=key)
+
+    repos, links = get_page(GITHUB_REPOS_URL, 1)
+    if repos is not None:
+        yield repos
+
+    last_page = _page_number(links['last']) if 'last' in links else None
+
+    if max_workers <= 1 or last_page is None:
+        next_url = links.get('next')
+        while next_url is not None:
+            repos, links = get_page(next_url, _page_number(next_url), last_page)
+            next_url = links.get('next')
+            if repos is not None:
+                yield repos
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit(page):
+            return pool.submit(get_page, GITHUB_REPOS_URL, page, last_page,
+                               dict(params, page=page))
+
+        # Only keep a window of pages in flight so that a slow consumer
+        # doesn't cause every page to be buffered in memory at once.
+        pages = iter(range(2, last_page + 1))
+        pending = collections.deque(
+            submit(page) for page in itertools.islice(pages, max_workers)
+        )
+        while pending:
+            repos, _ = pending.popleft().result()
+            for page in itertools.islice(pages, 1):
+                pending.append(submit(page))
+            if repos is not None:
+                yield repos
+
+
+def _get_project_page(request, url, params, cache=None, cache_key=None):
+    """Fetches a single page of repositories and returns the
+    repositories as a ``ProjectPage`` along with the parsed ``Link``
+    header. If the page is unchanged since it was cached ``None`` is
+    returned in place of the repositories without decoding the body.
+    """
+    kwargs = {'params': params}
+
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        headers = {}
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified'] is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+        kwargs['headers'] = headers
+
+    with request.http.get(url, **kwargs) as r:
+        # GitHub sends the Link header with a 304 as well and it has to be
+        # read from there as pages may have been added after this one.
+        links = {rel: link for link, rel in _LINK_REGEX.findall(r.headers.get('Link', ''))}
+
+        if cached is not None and r.status_code == 304:
+            cache.hit()
+            return None, links
+
+        if cache is not None:
+            cache.miss()
+
+        return ProjectPage(
+            r.json(),
+            cache_key=cache_key,
+            etag=r.headers.get('ETag'),
+            last_modified=r.headers.get('Last-Modified')
+        ), links
+
+
+def _page_number(url):
+    match = _PAGE_REGEX.search(url)
+    return int(match.group(1)) if match is not None else None
 
 
 def update_all_projects(request, user, project_role_type, repos):
     """Given the role type that the user has for the list
     of repositories update all Projects within the database
     with the new role or create a new Project if there isn't one.
+
+    Projects and ProjectRoles are upserted with ``INSERT ... ON CONFLICT``
+    so the number of statements issued doesn't grow with the number of
+    repositories that the user has access to.
+
+    Returns the number of repositories that were skipped because
+    there isn't a Project for them and the user isn't the owner.
     """
+    # Key on the GitHub ID so a repository that is listed twice
+    # doesn't try to affect the same row twice in one statement.
+    projects = {}
     for repo in repos:
-        project = (
-            request.db.query(Project)
-                      .filter(Project.github_id == repo['id'])
-                      .first()
+        projects[repo['id']] = {
+            'github_id': repo['id'],
+            'owner': repo['owner']['login'],
+            'name': repo['name'],
+            'public': not repo['private'],
+            'active': False
+        }
+
+    # Only allow new projects to be created if
+    # we're an owner of the project.
+    if projects and project_role_type != ProjectRoleType.OWNER:
+        existing = (
+            request.db.query(Project.github_id)
+                      .filter(Project.github_id.in_(list(projects)))
         )
+        skipped = len(projects)
+        projects = {github_id: projects[github_id] for github_id, in existing}
+        skipped -= len(projects)
+    else:
+        skipped = 0
 
-        # Save this for use later to maybe save a database lookup.
-        lookup_role = True
-
-        # Only allow new projects to be created if
-        # we're an owner of the project.
-        if project is None:
-            if project_role_type == ProjectRoleType.OWNER:
-                # We're creating a new project so don't search
-                # for roles. They won't be there. :)
-                lookup_role = False
-
-                project = Project()
-                project.active = False
-            else:
-                continue
-
-        # Update the project with the latest information.
-        project.owner = repo['owner']['login']
-        project.name = repo['name']
-        project.public = not repo['private']
-        project.github_id = repo['id']
-
-        # See if there are any ProjectRoles that need to be updated.
-        project_role = None
-        if lookup_role:
-            project_role = (
-                request.db.query(ProjectRole)
-                          .filter(ProjectRole.project == project)
-                          .filter(ProjectRole.user == user)
-                          .first()
-            )
-
-        # No ProjectRole exists for the user so we should create one.
-        if project_role is None:
-            project_role = ProjectRole()
-            project_role.user = user
-            project_role.project = project
-            project_role.role_type = project_role_type
-            request.db.add(project_role)
-
-        # If the ProjectRole exists then we should update
-        # the role type to the actual type.
-        elif project_role.role_type != project_role_type:
-            project_role.role_type = project_role_type
-            request.db.add(project_role)
-
-        request.db.add(project)
+    if not projects:
+        return skipped
 
+    # Make sure the user and anything else pending is written
+    # before we start writing rows that reference it.
     request.db.flush()
+
+    # Update the projects with the latest information. Projects
+    # that already exist keep whether they're active or not.
+    statement = insert(Project.__table__).values(list(projects.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[Project.__table__.c.github_id],
+        set_={
+            'owner': statement.excluded.owner,
+            'name': statement.excluded.name,
+            'public': statement.excluded.public
+        }
+    ).returning(Project.__table__.c.id)
+    project_ids = [project_id for project_id, in request.db.execute(statement)]
+
+    # Create a ProjectRole for each project or update
+    # the role type to the actual type if it's changed.
+    statement = insert(ProjectRole.__table__).values([
+        {'project_id': project_id,
+         'user_id': user.id,
+         'role_type': project_role_type}
+        for project_id in project_ids
+    ])
+    statement = statement.on_conflict_do_update(
+        constraint='uix_project_roles_user',
+        set_={'role_type': statement.excluded.role_type},
+        where=(ProjectRole.__table__.c.role_type != statement.excluded.role_type)
+    ).returning(ProjectRole.__table__.c.project_id)
+    changed_ids = [project_id for project_id, in request.db.execute(statement)]
+
+    # Only roles that were created or changed are returned
+    # and those projects need their cached ACLs invalidated.
+    if changed_ids:
+        request.db.execute(
+            Project.__table__.update()
+                             .where(Project.__table__.c.id.in_(changed_ids))
+                             .values(acl_version=Project.__table__.c.acl_version + 1)
+        )
+
+    # The ORM doesn't know about writes done via Core statements so we
+    # need to tell the transaction manager to commit them and reload
+    # any objects that may have been changed underneath us.
+    zope.sqlalchemy.mark_changed(request.db, transaction_manager=request.tm)
+    request.db.expire_all()
+
+    return skipped
@@ -95,6 +95,9 @@ class RateLimit(object):
 
 
 def includeme(config):
+    # The limits library manages its own Redis client so
+    # bound it by the same setting as our shared pools.
     config.registry['ratelimit.storage'] = storage_from_string(
-        config.registry.settings['ratelimit.url']
+        config.registry.settings['ratelimit.url'],
+        max_connections=config.registry.settings['redis.max_connections']
     )
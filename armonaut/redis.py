@@ -0,0 +1,46 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import redis
+
+_pools_lock = threading.Lock()
+
+
+def connection_pool(registry, url) -> redis.ConnectionPool:
+    """
+    Returns the connection pool for the Redis url that is shared by
+    every Redis-backed subsystem. Pools are bounded by the
+    redis.max_connections setting and block instead of erroring
+    when all connections are in use.
+    """
+    with _pools_lock:
+        pools = registry.setdefault('redis.pools', {})
+        pool = pools.get(url)
+        if pool is None:
+            pool = redis.BlockingConnectionPool.from_url(
+                url,
+                max_connections=registry.settings['redis.max_connections'],
+                timeout=registry.settings['redis.pool_timeout']
+            )
+            pools[url] = pool
+    return pool
+
+
+def _redis_connection_pool(config, url):
+    return connection_pool(config.registry, url)
+
+
+def includeme(config):
+    config.add_directive('redis_connection_pool', _redis_connection_pool, action_wrap=False)
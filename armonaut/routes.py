@@ -29,3 +29,5 @@ def includeme(config):
         factory='armonaut.project.models:ProjectFactory',
         domain=armonaut
     )
+
+    config.add_route('webhooks.github', '/webhooks/github', domain=armonaut)
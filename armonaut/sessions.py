@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
 import functools
+import os
+import threading
 import time
 import msgpack
 import msgpack.exceptions
@@ -24,6 +27,7 @@ from pyramid.viewderivers import INGRESS
 from pyramid.interfaces import ISession, ISessionFactory
 
 from armonaut.cache.http import add_vary
+from armonaut.cache.lru import LRUCache
 from armonaut.utils import crypto
 
 
@@ -96,6 +100,10 @@ class InvalidSession(dict):
         self._error_message()
 
 
+# Values which can't have been modified in place since they were read.
+_IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+
 def _changed_method(method):
     @functools.wraps(method)
     def wrapped(self, *args, **kwargs):
@@ -104,41 +112,59 @@ def _changed_method(method):
     return wrapped
 
 
+def _changed_key_method(method):
+    @functools.wraps(method)
+    def wrapped(self, key, *args, **kwargs):
+        self.changed(key)
+        return method(self, key, *args, **kwargs)
+    return wrapped
+
+
 @implementer(ISession)
 class Session(dict):
 
     _csrf_token_key = '_csrf_token'
     _flash_key = '_flash_messages'
 
-    __delitem__ = _changed_method(dict.__delitem__)
+    __delitem__ = _changed_key_method(dict.__delitem__)
     clear = _changed_method(dict.clear)
-    pop = _changed_method(dict.pop)
     popitem = _changed_method(dict.popitem)
     update = _changed_method(dict.update)
 
+    def pop(self, key, *args):
+        # Popping a key that doesn't exist doesn't modify the session.
+        if key in self:
+            self.changed(key)
+        return dict.pop(self, key, *args)
+
     def setdefault(self, k, default=None):
         changed = k not in self
         ret = dict.setdefault(self, k, default)
         if changed:
-            self.changed()
+            self.changed(k)
         return ret
 
     def __setitem__(self, key, value):
         # Don't mark the session as modified if the value doesn't change.
-        if key in self and self[key] == value:
+        # Anything mutable might have been changed in place and assigned
+        # again so that always counts as a change.
+        if (isinstance(value, _IMMUTABLE_TYPES) and key in self and
+                self[key] == value):
             return
         dict.__setitem__(self, key, value)
-        self.changed()
+        self.changed(key)
 
-    def __init__(self, data=None, session_id=None, new=True):
+    def __init__(self, data=None, session_id=None, new=True, renewed=None):
         if data is None:
             data = {}
         super().__init__(data)
 
         self._sid = session_id
         self._changed = False
+        self._dirty = set()
         self.new = new
         self.created = int(time.time())
+        self.renewed = renewed
         self.invalidated = set()
 
     @property
@@ -147,14 +173,27 @@ class Session(dict):
             self._sid = crypto.random_token()
         return self._sid
 
-    def changed(self):
+    @property
+    def dirty(self):
+        """Keys modified since the session was loaded or ``None``
+        if the modification can't be narrowed down to single keys.
+        """
+        return self._dirty
+
+    def changed(self, key=None):
         self._changed = True
+        if key is None:
+            self._dirty = None
+        elif self._dirty is not None:
+            self._dirty.add(key)
 
     def invalidate(self):
         self.clear()
         self.new = True
         self.created = int(time.time())
+        self.renewed = None
         self._changed = False
+        self._dirty = set()
 
         if self._sid is not None:
             self.invalidated.add(self._sid)
@@ -171,6 +210,9 @@ class Session(dict):
         if not allow_duplicate and msg in self.get(queue_key, []):
             return
         self.setdefault(queue_key, []).append(msg)
+        # Appending to an existing queue mutates the list in
+        # place so the queue has to be marked as changed explicitly.
+        self.changed(queue_key)
 
     def peek_flash(self, queue=''):
         return self.get(self._get_flash_queue_key(queue), [])
@@ -192,25 +234,178 @@ class Session(dict):
         return token
 
 
+class LocalSessionCache(object):
+    """Per-process cache of packed session data keyed by session id
+    and version. Entries are dropped when any worker publishes a write
+    on the invalidation channel and expire after ``ttl`` seconds in
+    case an invalidation message was missed.
+    """
+    channel = 'armonaut/session/invalidate'
+
+    def __init__(self, redis, maxsize=1024, maxbytes=16 * 1024 * 1024,
+                 ttl=60):
+        self.redis = redis
+        self.ttl = ttl
+        self.stale = 0
+        self._cache = LRUCache(maxsize=maxsize, maxweight=maxbytes)
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, session_id, version):
+        self._listen()
+
+        entry = self._cache.get(session_id)
+        if entry is None:
+            return None
+
+        entry_version, data, expires = entry
+        if entry_version != version or expires <= time.monotonic():
+            self.stale += 1
+            self._cache.pop(session_id)
+            return None
+        return data
+
+    def set(self, session_id, version, data, weight=0):
+        self._cache.set(
+            session_id,
+            (version, data, time.monotonic() + self.ttl),
+            weight=weight
+        )
+
+    def invalidate(self, pipeline, *session_ids):
+        for session_id in session_ids:
+            self._cache.pop(session_id)
+            pipeline.publish(self.channel, session_id)
+
+    def stats(self):
+        stats = self._cache.stats()
+
+        # Entries found with an old version count as misses.
+        stats['hits'] -= self.stale
+        stats['misses'] += self.stale
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _listen(self):
+        # The listener thread doesn't survive a fork or a lost
+        # connection so every worker process makes sure it's
+        # subscribed before trusting anything in the cache.
+        pid = os.getpid()
+        if self._pid == pid and self._listener.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == pid and self._listener.is_alive():
+                return
+
+            self._cache.clear()
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1.0,
+                                                  daemon=True)
+            self._pid = pid
+
+    def _on_message(self, message):
+        self._cache.pop(message['data'].decode('utf-8'))
+
+
 @implementer(ISessionFactory)
 class RedisSessionFactory:
     cookie_name = 'session_id'
     max_age = 12 * 60 * 60
-
-    def __init__(self, secret, url):
-        self.redis = redis.StrictRedis.from_url(url)
+    redis_prefix = 'armonaut/session/data'
+
+    def __init__(self, secret, url, connection_pool=None,
+                 touch_interval=None, local_cache=None):
+        if connection_pool is not None:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis.from_url(url)
         self.signer = crypto.TimestampSigner(secret, salt='session')
+        self.touch_interval = touch_interval
+        self.local_cache = local_cache
 
     def __call__(self, request):
         return self._process_request(request)
 
+    @classmethod
+    def _redis_key(cls, session_id):
+        return f'{cls.redis_prefix}/{session_id}'
+
     @staticmethod
-    def _redis_key(session_id):
-        return f'armonaut/session/data/{session_id}'
+    def _pack(value):
+        return msgpack.packb(value, encoding='utf-8', use_bin_type=True)
+
+    @staticmethod
+    def _unpack(value):
+        return msgpack.unpackb(value, encoding='utf-8', use_list=True)
+
+    def _fetch(self, session_id):
+        # Grab the msgpack'ed session data from redis
+        return self.redis.get(self._redis_key(session_id))
+
+    def _decode(self, data):
+        # Unpack the session data into objects and values
+        try:
+            return self._unpack(data)
+        except (msgpack.exceptions.UnpackException,
+                msgpack.exceptions.ExtraData):
+            return None
+
+    @staticmethod
+    def _weigh(data):
+        return len(data)
+
+    def _load(self, session_id, version=None):
+        if self.local_cache is not None:
+            data = self.local_cache.get(session_id, version)
+            if data is not None:
+                return self._decode(data)
+
+        data = self._fetch(session_id)
+        if not data:
+            return None
+
+        session = self._decode(data)
+        if session is not None and self.local_cache is not None:
+            self.local_cache.set(
+                session_id, version, data, weight=self._weigh(data)
+            )
+        return session
+
+    def _save(self, pipeline, session):
+        # Use SETEX to allow the value to expire after `max_age` seconds.
+        pipeline.setex(
+            self._redis_key(session.sid),
+            self.max_age,
+            self._pack(session)
+        )
+
+    def _should_touch(self, session):
+        if self.touch_interval is None or session.new:
+            return False
+        if session.renewed is None:
+            return False
+        return time.time() - session.renewed >= self.touch_interval
+
+    def _set_cookie(self, request, response):
+        # Set the cookie to be the session id and also
+        # set MaxAge, HttpOnly, and Secure
+        response.set_cookie(
+            self.cookie_name,
+            self.signer.sign(request.session.sid.encode('utf-8')),
+            max_age=self.max_age,
+            httponly=True,
+            secure=request.scheme == 'https'
+        )
 
     def _process_request(self, request):
         request.add_response_callback(self._process_response)
+        return self._load_session(request)
 
+    def _load_session(self, request):
         session_id = request.cookies.get(self.cookie_name)
 
         # The request didn't claim to have a session
@@ -222,40 +417,53 @@ class RedisSessionFactory:
         # and return a fresh session if the session_id
         # is expired or tampered with.
         try:
-            session_id = self.signer.unsign(session_id, max_age=self.max_age)
+            session_id, signed_at = self.signer.unsign(
+                session_id,
+                max_age=self.max_age,
+                return_timestamp=True
+            )
             session_id = session_id.decode('utf-8')
         except crypto.BadSignature:
             return Session()
 
-        # Grab the msgpack'ed session data from redis
-        data = self.redis.get(self._redis_key(session_id))
+        # The cookie is re-signed every time the session is saved or
+        # its expiry is extended so its timestamp tells us when the
+        # session was last renewed and acts as the session's version.
+        renewed = calendar.timegm(signed_at.utctimetuple())
 
-        # If the session didn't exist in redis give the user
-        # a new session.
+        # If the session didn't exist in redis or the data
+        # is invalid give the user a new session.
+        data = self._load(session_id, renewed)
         if data is None:
             return Session()
 
-        # Unpack the session data into objects and values
-        try:
-            data = msgpack.unpackb(data, encoding='utf-8', use_list=True)
-        # If the session data is invalid give the user a new session
-        except (msgpack.exceptions.UnpackException,
-                msgpack.exceptions.ExtraData):
-            return Session()
+        # We were able to load an existing sessions data.
+        return Session(data, session_id, False, renewed=renewed)
 
-        # We were able to load an existing sessions data
-        return Session(data, session_id, False)
+    def _discard(self, session_ids):
+        pipeline = self.redis.pipeline()
+        pipeline.delete(*[
+            self._redis_key(session_id) for session_id in session_ids
+        ])
+        if self.local_cache is not None:
+            self.local_cache.invalidate(pipeline, *session_ids)
+        pipeline.execute()
 
     def _process_response(self, request, response):
         if isinstance(request.session, InvalidSession):
             return
 
+        # All writes for the request are sent in a single round trip.
+        pipeline = self.redis.pipeline()
+
         # If our session has been invalidated we need to clean
         # up old sessions and potentially delete the cookie
         if request.session.invalidated:
             # Delete all old session ids
-            for invalid_id in request.session.invalidated:
-                self.redis.delete(self._redis_key(invalid_id))
+            pipeline.delete(*[
+                self._redis_key(invalid_id)
+                for invalid_id in request.session.invalidated
+            ])
 
             # If no new session was created after an invalidate
             # then don't send a cookie with a session.
@@ -266,26 +474,181 @@ class RedisSessionFactory:
         # the session to redis and the cookie with newly
         # signed values.
         if request.session.should_save():
-            # Use SETEX to allow the value to expire after `max_age` seconds.
-            self.redis.setex(
+            self._save(pipeline, request.session)
+            self._set_cookie(request, response)
+
+        # Otherwise slide the expiry of an active session forward
+        # with a cheap EXPIRE at most once per `touch_interval`.
+        elif self._should_touch(request.session):
+            pipeline.expire(
                 self._redis_key(request.session.sid),
-                self.max_age,
-                msgpack.packb(
-                    request.session,
-                    encoding='utf-8',
-                    use_bin_type=True
-                )
+                self.max_age
             )
+            self._set_cookie(request, response)
 
-            # Set the cookie to be the session id and also
-            # set MaxAge, HttpOnly, and Secure
-            response.set_cookie(
-                self.cookie_name,
-                self.signer.sign(request.session.sid.encode('utf-8')),
-                max_age=self.max_age,
-                httponly=True,
-                secure=request.scheme == 'https'
+        # Let every worker know that its cached copy is out of date.
+        if self.local_cache is not None:
+            written = set(request.session.invalidated)
+            if request.session.should_save():
+                written.add(request.session.sid)
+            self.local_cache.invalidate(pipeline, *written)
+
+        if len(pipeline):
+            pipeline.execute()
+
+
+@implementer(ISessionFactory)
+class RedisHashSessionFactory(RedisSessionFactory):
+    """Stores each session key as a field of a Redis hash
+    so only the keys modified by a request are written back.
+    """
+    redis_prefix = 'armonaut/session/hash'
+
+    def _fetch(self, session_id):
+        return self.redis.hgetall(self._redis_key(session_id))
+
+    @staticmethod
+    def _weigh(data):
+        return sum(len(field) + len(value) for field, value in data.items())
+
+    def _decode(self, data):
+        try:
+            return {
+                field.decode('utf-8'): self._unpack(value)
+                for field, value in data.items()
+            }
+        except (UnicodeDecodeError,
+                msgpack.exceptions.UnpackException,
+                msgpack.exceptions.ExtraData):
+            return None
+
+    def _save(self, pipeline, session):
+        key = self._redis_key(session.sid)
+        dirty = session.dirty
+
+        # Sessions that are new or were modified in a way that
+        # can't be tracked per key have to be written in full.
+        if session.new or dirty is None:
+            if not session.new:
+                pipeline.delete(key)
+            dirty = set(session)
+
+        updated = {
+            field: self._pack(session[field])
+            for field in dirty if field in session
+        }
+        deleted = [field for field in dirty if field not in session]
+
+        if updated:
+            pipeline.hset(key, mapping=updated)
+        if deleted:
+            pipeline.hdel(key, *deleted)
+        pipeline.expire(key, self.max_age)
+
+
+@implementer(ISessionFactory)
+class CookieSessionFactory(object):
+    """Stores sessions entirely within a signed cookie so that loading
+    and saving them doesn't need Redis. Sessions which don't fit within
+    ``max_size`` bytes are stored with the ``fallback`` factory instead.
+    """
+    cookie_name = 'session'
+
+    def __init__(self, secret, fallback, max_size=2048):
+        self.fallback = fallback
+        self.max_size = max_size
+        self.signer = crypto.TimestampSigner(secret, salt='session.cookie')
+        self.serializer = crypto.URLSafeSerializer(
+            secret, salt='session.cookie'
+        )
+
+    def __call__(self, request):
+        return self._process_request(request)
+
+    def _dump(self, session):
+        payload = self.serializer.dump_payload(dict(session))
+        return self.signer.sign(payload).decode('utf-8')
+
+    def _set_cookie(self, request, response, value):
+        response.set_cookie(
+            self.cookie_name,
+            value,
+            max_age=self.fallback.max_age,
+            httponly=True,
+            secure=request.scheme == 'https'
+        )
+
+    def _process_request(self, request):
+        request.add_response_callback(self._process_response)
+
+        value = request.cookies.get(self.cookie_name)
+
+        # Sessions that aren't stored in a cookie may be in Redis.
+        if value is None:
+            return self.fallback._load_session(request)
+
+        try:
+            payload, signed_at = self.signer.unsign(
+                value,
+                max_age=self.fallback.max_age,
+                return_timestamp=True
             )
+            data = self.serializer.load_payload(payload)
+        except crypto.BadData:
+            return Session()
+
+        if not isinstance(data, dict):
+            return Session()
+
+        return Session(
+            data, None, False,
+            renewed=calendar.timegm(signed_at.utctimetuple())
+        )
+
+    def _process_response(self, request, response):
+        session = request.session
+        if isinstance(session, InvalidSession):
+            return
+
+        from_cookie = self.cookie_name in request.cookies
+
+        if not session.should_save():
+            # Sessions loaded from Redis are cleaned up
+            # and touched by the fallback factory.
+            if not from_cookie:
+                self.fallback._process_response(request, response)
+
+            # The session was invalidated or its cookie was invalid.
+            elif session.new:
+                response.delete_cookie(self.cookie_name)
+
+            elif self.fallback._should_touch(session):
+                self._set_cookie(request, response, self._dump(session))
+            return
+
+        value = self._dump(session)
+
+        # Sessions that are too large for a cookie are moved to Redis.
+        if len(value) > self.max_size:
+            if from_cookie:
+                response.delete_cookie(self.cookie_name)
+
+                # Nothing of the session is in Redis yet so it has to be
+                # written in full rather than only the keys changed now.
+                session.new = True
+            self.fallback._process_response(request, response)
+            return
+
+        # Sessions that were stored in Redis until now can be removed
+        # from Redis once they're stored within the cookie.
+        stale = set(session.invalidated)
+        if session._sid is not None:
+            stale.add(session._sid)
+        if stale:
+            self.fallback._discard(stale)
+            response.delete_cookie(self.fallback.cookie_name)
+
+        self._set_cookie(request, response, value)
 
 
 def session_view(view, info):
@@ -318,13 +681,41 @@ session_view.options = {'uses_session'}
 
 
 def includeme(config):
-    config.set_session_factory(
-        RedisSessionFactory(
-            config.registry.settings['sessions.secret'],
-            config.registry.settings['sessions.url']
+    settings = config.registry.settings
+
+    if settings.get('sessions.storage', 'string') == 'hash':
+        session_factory_cls = RedisHashSessionFactory
+    else:
+        session_factory_cls = RedisSessionFactory
+
+    connection_pool = config.redis_connection_pool(settings['sessions.url'])
+
+    local_cache = None
+    if settings.get('sessions.local_cache_size'):
+        local_cache = LocalSessionCache(
+            redis.StrictRedis(connection_pool=connection_pool),
+            maxsize=settings['sessions.local_cache_size'],
+            maxbytes=settings['sessions.local_cache_bytes'],
+            ttl=settings['sessions.local_cache_ttl']
         )
+
+    session_factory = session_factory_cls(
+        settings['sessions.secret'],
+        settings['sessions.url'],
+        connection_pool=connection_pool,
+        touch_interval=settings.get('sessions.touch_interval'),
+        local_cache=local_cache
     )
 
+    if settings.get('sessions.backend', 'redis') == 'cookie':
+        session_factory = CookieSessionFactory(
+            settings['sessions.secret'],
+            session_factory,
+            max_size=settings['sessions.cookie_max_size']
+        )
+
+    config.set_session_factory(session_factory)
+
     config.add_view_deriver(
         session_view,
         over='csrf_view',
@@ -14,82 +14,407 @@
 
 import os
 import json
+import hashlib
+import mimetypes
+import threading
+import time
+from wsgiref.headers import Headers
+import structlog
 from pyramid.path import AssetResolver
 from pyramid.httpexceptions import HTTPMethodNotAllowed
-from pyramid.response import FileResponse
+from pyramid.response import Response
 from pyramid.tweens import EXCVIEW, INGRESS
-from webob.multidict import MultiDict
 from whitenoise import WhiteNoise as _WhiteNoise
+from armonaut import compression
 
 
 resolver = AssetResolver()
 
+# Files up to this size are held in memory, larger files are read from disk.
+BODY_MAX = 256 * 1024
+
+# Encodings we serve static files with in the order we prefer them.
+ENCODINGS = ['br', 'gzip', 'identity']
+
+# Size of the blocks read from files served without os.sendfile.
+BLOCK_SIZE = 64 * 1024
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'image/x-icon'
+}
+
 
 class WhiteNoise(_WhiteNoise):
     config_attrs = _WhiteNoise.config_attrs + ('manifest',)
 
     def __init__(self, *args, manifest=None, **kwargs):
         self._manifest = None
+        self._manifest_mtime = None
+        self._immutable_paths = frozenset()
         self.manifest_path = (
             resolver.resolve(manifest).abspath()
             if manifest is not None else None
         )
         super().__init__(*args,  **kwargs)
 
+    def _load_manifest(self):
+        if self.manifest_path is None:
+            self._manifest = set()
+            return
+
+        if self._manifest is not None and not self.autorefresh:
+            return
+
+        # Only re-read the manifest in autorefresh mode when it changes.
+        mtime = os.stat(self.manifest_path).st_mtime
+        if self._manifest is not None and mtime == self._manifest_mtime:
+            return
+
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        manifest_dir = os.path.dirname(self.manifest_path)
+        self._manifest = set(data.values())
+        self._manifest_mtime = mtime
+        self._immutable_paths = frozenset(
+            os.path.normpath(os.path.join(manifest_dir, relpath))
+            for relpath in self._manifest
+        )
+
     @property
     def manifest(self):
-        if self._manifest is None:
-            manifest_files = set()
-            if self.manifest_path is not None:
-                with open(self.manifest_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                manifest_files.update(data.values())
-
-            if not self.autorefresh:
-                self._manifest = manifest_files
-            return manifest_files
-        else:
-            return self._manifest
+        self._load_manifest()
+        return self._manifest
 
     def is_immutable_file(self, path, url):
-        if self.manifest_path is not None:
-            manifest_dir = os.path.dirname(self.manifest_path)
-            if os.path.commonpath([self.manifest_path, path]) == manifest_dir:
-                if os.path.relpath(path, manifest_dir) in self.manifest:
-                    return True
+        self._load_manifest()
+        if os.path.normpath(path) in self._immutable_paths:
+            return True
+
+        parent = getattr(super(), 'is_immutable_file', None)
+        if parent is None:
+            parent = super().immutable_file_test
+        return parent(path, url)
+
+    # WhiteNoise 4 renamed is_immutable_file() to immutable_file_test().
+    immutable_file_test = is_immutable_file
+
+
+class _RangeFileIterMixin(object):
+    """Iterates over at most ``remaining`` bytes of ``filelike``
+    starting from its current position.
+    """
+    remaining = None
+
+    def app_iter_range(self, start, stop):
+        # Servers that use os.sendfile() for wsgi.file_wrapper send
+        # Content-Length bytes starting from the file's current offset
+        # so seeking to the start of the range is all they need.
+        self.filelike.seek(start)
+        self.remaining = stop - start
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        size = self.blksize
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        data = self.filelike.read(size) if size > 0 else b''
+        if not data:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def __getitem__(self, key):
+        try:
+            return self.__next__()
+        except StopIteration:
+            raise IndexError
+
+
+class _RangeFileIter(_RangeFileIterMixin):
+    def __init__(self, filelike, blksize):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def close(self):
+        self.filelike.close()
+
+
+_range_file_wrappers = {}
+
+
+def _file_iter(f, environ, block_size):
+    file_wrapper = environ.get('wsgi.file_wrapper')
+
+    # Servers only use os.sendfile() for instances of their own file
+    # wrapper so extend it to support range requests if we're able to.
+    if isinstance(file_wrapper, type):
+        cls = _range_file_wrappers.get(file_wrapper)
+        if cls is None:
+            cls = type('RangeFileWrapper',
+                       (_RangeFileIterMixin, file_wrapper), {})
+            _range_file_wrappers[file_wrapper] = cls
+        app_iter = cls(f, block_size)
+        if hasattr(app_iter, 'filelike') and hasattr(app_iter, 'blksize'):
+            return app_iter
+    elif file_wrapper is not None:
+        return file_wrapper(f, block_size)
+
+    return _RangeFileIter(f, block_size)
+
+
+class SendfileResponse(Response):
+    """Response for a file on disk that's sent with the server's
+    ``wsgi.file_wrapper`` so that servers such as gunicorn send it
+    with ``os.sendfile()`` instead of copying it through Python. Range
+    requests seek within the file instead of reading up to the range.
+    """
+    def __init__(self, path, request=None, content_type=None,
+                 content_encoding=None, block_size=BLOCK_SIZE):
+        if content_type is None:
+            content_type, content_encoding = mimetypes.guess_type(
+                path, strict=False
+            )
+            if content_type is None:
+                content_type = 'application/octet-stream'
+        super().__init__(
+            conditional_response=True,
+            content_type=content_type,
+            content_encoding=content_encoding
+        )
+
+        f = open(path, 'rb')
+        stat = os.fstat(f.fileno())
+        environ = request.environ if request is not None else {}
+        self.app_iter = _file_iter(f, environ, block_size)
+        # Assigning app_iter clears Content-Length so it's assigned after.
+        self.content_length = stat.st_size
+        self.last_modified = stat.st_mtime
+
+
+class StaticVariant(object):
+    __slots__ = ('path', 'body', 'size', 'etag')
+
+    def __init__(self, path, body, size, etag):
+        self.path = path
+        self.body = body
+        self.size = size
+        self.etag = etag
+
 
-        return super().is_immutable_file(path, url)
+class StaticAsset(object):
+    __slots__ = ('headers', 'last_modified', 'variants', 'encodings')
+
+    def __init__(self, headers, last_modified, variants):
+        self.headers = headers
+        self.last_modified = last_modified
+        self.variants = variants
+        self.encodings = [e for e in ENCODINGS if e in variants]
+
+
+class StaticIndex(object):
+    """Index of every static file built once at startup with the
+    headers, ETag and compressed variants of each file precomputed
+    so that serving a file doesn't need to hash or stat anything.
+    """
+    def __init__(self, whitenoise, compress=True):
+        self.whitenoise = whitenoise
+        self.compress = compress
+        self.assets = {}
+        self.roots = []
+        self._mtimes = {}
+        self._watcher = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        return self.assets.get(url)
+
+    def add_files(self, root, prefix=None):
+        prefix = '/' + (prefix or '').strip('/')
+        prefix = prefix.rstrip('/') + '/'
+
+        self.roots.append((root, prefix))
+        self._scan(root, prefix)
+
+    def refresh(self):
+        """Re-indexes files which were added, modified or
+        removed since the index was last built.
+        """
+        seen = set()
+        for root, prefix in self.roots:
+            seen |= self._scan(root, prefix)
+
+        for url in set(self.assets) - seen:
+            self.assets.pop(url, None)
+            self._mtimes.pop(url, None)
+
+    def watch(self, interval=1.0):
+        """Refreshes the index from a background thread every
+        ``interval`` seconds so that requests never touch the
+        filesystem to find out whether a file has changed.
+        """
+        # The watcher thread doesn't survive a fork so every worker
+        # process starts its own and restarts it if it ever died.
+        pid = os.getpid()
+        if self._pid == pid and self._watcher.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == pid and self._watcher.is_alive():
+                return
+
+            def run():
+                while True:
+                    time.sleep(interval)
+
+                    # Files can be read while they're being rewritten, such
+                    # as the manifest while gulp writes it, which shouldn't
+                    # stop the index from being refreshed next time.
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        structlog.get_logger('armonaut.static').warning(
+                            'Could not refresh the static file index', error=str(e)
+                        )
+
+            self._watcher = threading.Thread(
+                target=run, name='armonaut-static-watcher', daemon=True
+            )
+            self._watcher.start()
+            self._pid = pid
+
+    def _scan(self, root, prefix):
+        seen = set()
+        for directory, _, filenames in os.walk(root, followlinks=True):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if self.whitenoise.is_compressed_variant(path):
+                    continue
+                relpath = os.path.relpath(path, root).replace(os.sep, '/')
+                url = prefix + relpath
+
+                try:
+                    mtime = os.stat(path).st_mtime
+                    if self._mtimes.get(url) != mtime:
+                        self.assets[url] = self._index_file(path, url)
+                        self._mtimes[url] = mtime
+                except OSError:
+                    # The file was removed while we were scanning.
+                    continue
+                seen.add(url)
+        return seen
+
+    def _index_file(self, path, url):
+        headers = Headers([])
+        self.whitenoise.add_mime_headers(headers, path, url)
+        self.whitenoise.add_cache_headers(headers, path, url)
+        if self.whitenoise.allow_all_origins:
+            headers['Access-Control-Allow-Origin'] = '*'
+        add_headers_function = getattr(
+            self.whitenoise, 'add_headers_function', None
+        )
+        if add_headers_function:
+            add_headers_function(headers, path, url)
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        variants = {'identity': self._variant(path, body)}
+
+        content_type = headers.get('Content-Type', '').split(';')[0]
+        if self.compress and (content_type.startswith('text/') or
+                              content_type in COMPRESSIBLE_TYPES):
+            for encoding in ('br', 'gzip'):
+                variant = self._compressed_variant(path, body, encoding)
+                if variant is not None:
+                    variants[encoding] = variant
+
+        return StaticAsset(
+            headers=[(k, v) for k, v in headers.items()],
+            last_modified=os.stat(path).st_mtime,
+            variants=variants
+        )
+
+    @staticmethod
+    def _variant(path, body):
+        return StaticVariant(
+            path=path,
+            body=body if len(body) <= BODY_MAX else None,
+            size=len(body),
+            etag=hashlib.md5(body).hexdigest()
+        )
+
+    def _compressed_variant(self, path, body, encoding):
+        # Use a variant compressed while building the assets if there
+        # is one otherwise compress the file once ourselves.
+        compressed_path = path + {'br': '.br', 'gzip': '.gz'}[encoding]
+        if os.path.isfile(compressed_path):
+            with open(compressed_path, 'rb') as f:
+                compressed = f.read()
+        else:
+            if len(body) <= compression.BUFFER_MAX:
+                level = compression.DEFAULT_LEVELS[encoding]
+            else:
+                level = compression.STREAMING_LEVELS[encoding]
+            compressed = b''.join(
+                compression._ENCODERS[encoding]([body], level)
+            )
+            compressed_path = None
+
+        if len(compressed) >= len(body):
+            return None
+
+        variant = self._variant(compressed_path, compressed)
+        if variant.body is None and compressed_path is None:
+            variant.body = compressed
+        return variant
+
+
+def _index_response(request, asset):
+    encoding = request.accept_encoding.best_match(
+        asset.encodings, default_match='identity'
+    )
+    variant = asset.variants[encoding]
+
+    if variant.body is not None:
+        resp = Response(body=variant.body, conditional_response=True)
+    else:
+        resp = SendfileResponse(variant.path, request=request)
+
+    resp.headers.update(asset.headers)
+    resp.content_length = variant.size
+    resp.last_modified = asset.last_modified
+    resp.etag = variant.etag
+    if encoding != 'identity':
+        resp.content_encoding = encoding
+    if len(asset.encodings) > 1:
+        resp.vary = ('Accept-Encoding',)
+    return resp
 
 
 def whitenoise_tween_factory(handler, registry):
     def whitenoise_tween(request):
-        wh = request.registry.whitenoise
+        index = request.registry.static_index
 
-        if wh.autorefresh:
-            static_file = wh.find_file(request.path_info)
-        else:
-            static_file = wh.files.get(request.path_info)
+        if request.registry.whitenoise.autorefresh:
+            index.watch()
 
-        if static_file is None:
+        asset = index.get(request.path_info)
+        if asset is None:
             return handler(request)
 
         if request.method not in {'GET', 'HEAD'}:
             return HTTPMethodNotAllowed()
 
-        request_headers = dict(kv for kv in request.environ.items()
-                               if kv[0].startswith('HTTP_'))
-        path, headers = static_file.get_path_and_headers(request_headers)
-        headers = MultiDict(headers)
-
-        resp = FileResponse(
-            path,
-            request=request,
-            content_type=headers.pop('Content-Type', None),
-            content_encoding=headers.pop('Content-Encoding', None)
-        )
-        resp.md5_etag()
-        resp.headers.update(headers)
-        return resp
+        return _index_response(request, asset)
     return whitenoise_tween
 
 
@@ -100,13 +425,18 @@ def whitenoise_serve_static(config, **kwargs):
 
     def register():
         config.registry.whitenoise = WhiteNoise(None, **kwargs)
+        config.registry.static_index = StaticIndex(
+            config.registry.whitenoise,
+            # Compressing every change isn't worth it while developing.
+            compress=not config.registry.whitenoise.autorefresh
+        )
 
     config.action(('whitenoise', 'create instance'), register)
 
 
 def whitenoise_add_files(config, path, prefix=None):
     def add_files():
-        config.registry.whitenoise.add_files(
+        config.registry.static_index.add_files(
             resolver.resolve(path).abspath(),
             prefix=prefix
         )
@@ -107,6 +107,18 @@ def task(**kwargs):
     return decorator
 
 
+def revoke(request, task_ids):
+    """Revokes the queued Celery tasks once the request's
+    transaction commits so a rollback leaves them queued.
+    """
+    def _revoke_after_commit(success):
+        if success:
+            request.registry['celery.app'].control.revoke(list(task_ids))
+
+    if task_ids:
+        request.tm.get().addAfterCommitHook(_revoke_after_commit)
+
+
 def _get_task(celery_app, task_func):
     task_name = celery_app.gen_task_name(
         task_func.__name__,
@@ -155,6 +167,7 @@ def includeme(config):
         broker_url=settings['celery.broker_url'],
         broker_use_ssl=False,
         result_backend=settings['celery.result_url'],
+        redis_max_connections=settings['redis.max_connections'],
         result_compression='gzip',
         result_serializer='json',
         task_queue_ha_policy='all',
@@ -12,6 +12,58 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import redis
+import sqlalchemy.exc
+import structlog
+from pyramid.events import ApplicationCreated
+from armonaut.cache.lru import LRUCache
+from armonaut.db import Session
+from armonaut.webhooks.interfaces import (
+    IWebhookSecretService, IWebhookDeliveryService
+)
+from armonaut.webhooks.services import (
+    CachedWebhookSecretService,
+    webhook_secret_service_factory,
+    webhook_delivery_service_factory
+)
+
+
+def _warm_secret_cache(event):
+    registry = event.app.registry
+    settings = registry.settings
+    if not settings.get('webhooks.warm_secret_cache', True):
+        return
+
+    # The cache fills up on demand as well so starting without
+    # warming it is better than not starting at all.
+    session = Session(bind=registry['sqlalchemy.engine'])
+    try:
+        CachedWebhookSecretService(
+            settings['webhooks.url'],
+            session,
+            registry['webhooks.secret_cache'],
+            local_max_age=settings.get('webhooks.secret_cache_ttl', 60)
+        ).warm()
+    except (redis.RedisError, sqlalchemy.exc.DBAPIError) as e:
+        structlog.get_logger('armonaut.webhooks').warning(
+            'Could not warm the webhook secret cache', error=str(e)
+        )
+    finally:
+        session.close()
+
 
 def includeme(config):
-    pass
+    config.registry['webhooks.secret_cache'] = LRUCache(
+        maxsize=config.registry.settings.get('webhooks.secret_cache_size', 16384)
+    )
+    config.register_service_factory(
+        webhook_secret_service_factory,
+        IWebhookSecretService
+    )
+    config.register_service_factory(
+        webhook_delivery_service_factory,
+        IWebhookDeliveryService
+    )
+
+    # Load the webhook secrets once the application has been created.
+    config.add_subscriber(_warm_secret_cache, ApplicationCreated)
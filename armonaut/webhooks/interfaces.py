@@ -0,0 +1,46 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from zope.interface import Interface
+
+
+class IWebhookSecretService(Interface):
+    def get(hook_id, cached=True):
+        """
+        Returns the WebhookSecret for the GitHub webhook
+        with the given id or None if it isn't known. With
+        cached=False the secret is read from the database
+        again unless the webhook is known not to exist or
+        it has been read again very recently.
+        """
+
+    def get_for_repository(repository_id, cached=True):
+        """
+        Returns the WebhookSecret for the project of the GitHub
+        repository with the given id or None if it isn't known.
+        """
+
+    def invalidate(hook_ids, repository_ids):
+        """
+        Forgets the cached secrets for the given webhooks and repositories.
+        """
+
+
+class IWebhookDeliveryService(Interface):
+    def accept(delivery_id):
+        """
+        Returns True the first time a delivery is seen and False for
+        redeliveries. Accepted deliveries are forgotten again if the
+        current transaction doesn't commit so they can be retried.
+        """
@@ -0,0 +1,274 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import time
+import msgpack
+import redis
+from sqlalchemy import inspect
+from sqlalchemy.orm import object_session
+from zope.interface import implementer
+from armonaut.db import Session, listens_for
+from armonaut.project.models import Project
+from armonaut.redis import connection_pool
+from armonaut.webhooks.interfaces import (
+    IWebhookSecretService, IWebhookDeliveryService
+)
+
+WebhookSecret = collections.namedtuple(
+    'WebhookSecret', ['project_id', 'secret']
+)
+
+# Columns which webhook secrets are looked up by.
+_LOOKUP_COLUMNS = {
+    'hook': Project.webhook_id,
+    'repository': Project.github_id
+}
+
+
+@implementer(IWebhookSecretService)
+class CachedWebhookSecretService:
+    """Looks up webhook secrets in a per-process cache, then Redis and
+    only then Postgres. Entries in Redis are deleted when the project
+    changes. Entries in other processes expire after ``local_max_age``
+    seconds, callers can skip them with cached=False if a secret
+    doesn't verify because it might have just been changed. That
+    also reads the secret from Postgres again and replaces it in Redis
+    but at most once every ``refresh_interval`` seconds per id.
+    """
+    max_age = 24 * 60 * 60
+
+    # Unknown ids are remembered briefly so that requests for
+    # them don't all reach Postgres.
+    missing_max_age = 60
+
+    # Anyone can send deliveries with a known hook id and a bad signature
+    # so how often those read the secret from Postgres again is limited.
+    refresh_interval = 10
+
+    def __init__(self, url, db, local_cache, local_max_age=60,
+                 connection_pool=None):
+        if connection_pool is not None:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis.from_url(url)
+        self.db = db
+        self.local_cache = local_cache
+        self.local_max_age = local_max_age
+
+    def get(self, hook_id, cached=True):
+        return self._get('hook', hook_id, cached)
+
+    def get_for_repository(self, repository_id, cached=True):
+        return self._get('repository', repository_id, cached)
+
+    def invalidate(self, hook_ids, repository_ids):
+        keys = (
+            [('hook', hook_id) for hook_id in hook_ids] +
+            [('repository', repository_id) for repository_id in repository_ids]
+        )
+        if not keys:
+            return
+        for key in keys:
+            self.local_cache.pop(key)
+        self.redis.delete(*[
+            redis_key
+            for key in keys
+            for redis_key in (self._redis_key(*key), self._refresh_key(*key))
+        ])
+
+    def warm(self):
+        """Loads the secrets of every project with a webhook into
+        the per-process cache and Redis so that none of the first
+        deliveries after starting up need to query Postgres.
+        """
+        rows = (
+            self.db.query(
+                Project.id, Project.webhook_id,
+                Project.github_id, Project.webhook_secret
+            )
+            .filter(Project.webhook_id.isnot(None))
+            .filter(Project.webhook_secret.isnot(None))
+            .limit(self.local_cache.maxsize // 2)
+        )
+        expires = time.monotonic() + self.local_max_age
+        pipeline = self.redis.pipeline(transaction=False)
+        for row in rows:
+            secret = WebhookSecret(row.id, row.webhook_secret)
+            for key in [('hook', row.webhook_id), ('repository', row.github_id)]:
+                self.local_cache.set(key, (secret, expires))
+                pipeline.setex(self._redis_key(*key), self.max_age, self._pack(secret))
+        pipeline.execute()
+
+    def _get(self, kind, id_, cached):
+        try:
+            id_ = int(id_)
+        except (TypeError, ValueError):
+            return None
+        key = (kind, id_)
+
+        now = time.monotonic()
+        if cached:
+            entry = self.local_cache.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+
+        # A lookup or warm() may have read the secret just before it was
+        # changed and stored it in Redis after it was invalidated so a
+        # secret which didn't verify is read from Postgres again.
+        data = self.redis.get(self._redis_key(*key))
+        if data is not None and (cached or not data or not self._refresh(key)):
+            secret = self._unpack(data)
+        else:
+            secret = self._query(kind, id_)
+            self.redis.setex(
+                self._redis_key(*key),
+                self.max_age if secret is not None else self.missing_max_age,
+                self._pack(secret)
+            )
+
+        self.local_cache.set(key, (secret, now + self.local_max_age))
+        return secret
+
+    def _refresh(self, key):
+        """Returns True if the secret for the key may be read from
+        Postgres again, which is the case once per ``refresh_interval``.
+        """
+        return bool(self.redis.set(
+            self._refresh_key(*key), b'1', ex=self.refresh_interval, nx=True
+        ))
+
+    def _query(self, kind, id_):
+        row = (
+            self.db.query(Project.id, Project.webhook_secret)
+            .filter(_LOOKUP_COLUMNS[kind] == id_)
+            .first()
+        )
+        if row is None or row.webhook_secret is None:
+            return None
+        return WebhookSecret(row.id, row.webhook_secret)
+
+    @staticmethod
+    def _pack(secret):
+        if secret is None:
+            return b''
+        return msgpack.packb(list(secret), use_bin_type=True)
+
+    @staticmethod
+    def _unpack(data):
+        if not data:
+            return None
+        return WebhookSecret(*msgpack.unpackb(data, encoding='utf-8'))
+
+    @staticmethod
+    def _redis_key(kind, id_):
+        return f'armonaut/webhooks/secret/{kind}/{id_}'
+
+    @staticmethod
+    def _refresh_key(kind, id_):
+        return f'armonaut/webhooks/secret/{kind}/{id_}/refresh'
+
+
+def webhook_secret_service_factory(context, request):
+    settings = request.registry.settings
+    url = settings['webhooks.url']
+    return CachedWebhookSecretService(
+        url,
+        request.db,
+        request.registry['webhooks.secret_cache'],
+        local_max_age=settings.get('webhooks.secret_cache_ttl', 60),
+        connection_pool=connection_pool(request.registry, url)
+    )
+
+
+@listens_for(Project, 'after_insert')
+@listens_for(Project, 'after_update')
+@listens_for(Project, 'after_delete')
+def _changed_project(config, mapper, connection, target):
+    """Remembers the webhook and repository ids of a changed project,
+    including their previous values, so that their cached secrets
+    are invalidated once the transaction commits.
+    """
+    session = object_session(target)
+    if session is None:
+        return
+
+    hook_ids, repository_ids = session.info.setdefault(
+        'armonaut.webhook_secrets', (set(), set())
+    )
+    attrs = inspect(target).attrs
+    for ids, key in [(hook_ids, 'webhook_id'), (repository_ids, 'github_id')]:
+        ids.update(value for value in attrs[key].history.sum() if value is not None)
+
+
+@listens_for(Session, 'after_commit')
+def _invalidate_webhook_secrets(config, session):
+    ids = session.info.pop('armonaut.webhook_secrets', None)
+    if ids is None:
+        return
+
+    url = config.registry.settings['webhooks.url']
+    service = CachedWebhookSecretService(
+        url, None, config.registry['webhooks.secret_cache'],
+        connection_pool=connection_pool(config.registry, url)
+    )
+    service.invalidate(*ids)
+
+
+@listens_for(Session, 'after_rollback')
+def _discard_webhook_secrets(config, session):
+    session.info.pop('armonaut.webhook_secrets', None)
+
+
+@implementer(IWebhookDeliveryService)
+class RedisWebhookDeliveryService:
+    # GitHub only redelivers recent deliveries so they
+    # don't need to be remembered for very long.
+    max_age = 24 * 60 * 60
+
+    def __init__(self, url, max_age=None, connection_pool=None):
+        if connection_pool is not None:
+            self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis = redis.StrictRedis.from_url(url)
+        if max_age is not None:
+            self.max_age = max_age
+        self._accepted = []
+
+    def accept(self, delivery_id):
+        key = self._redis_key(delivery_id)
+        if not self.redis.set(key, b'1', ex=self.max_age, nx=True):
+            return False
+        self._accepted.append(key)
+        return True
+
+    def _after_commit_hook(self, success):
+        accepted, self._accepted = self._accepted, []
+        if not success and accepted:
+            self.redis.delete(*accepted)
+
+    @staticmethod
+    def _redis_key(delivery_id):
+        return f'armonaut/webhooks/delivery/{delivery_id}'
+
+
+def webhook_delivery_service_factory(context, request):
+    url = request.registry.settings['webhooks.url']
+    service = RedisWebhookDeliveryService(
+        url,
+        max_age=request.registry.settings.get('webhooks.delivery_max_age'),
+        connection_pool=connection_pool(request.registry, url)
+    )
+    request.tm.get().addAfterCommitHook(service._after_commit_hook)
+    return service
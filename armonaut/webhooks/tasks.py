@@ -12,26 +12,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import hmac
 from armonaut import tasks
+from armonaut.build.models import Build, Commit
+from armonaut.build.services import cancel_superseded
+from armonaut.project.models import Project
 
 
 @tasks.task(ignore_result=True, acks_late=True)
-def process_github_webhook(request):
-
-    secret = ''  # TODO: Get the webhook secret from project.
-
-    # Verify the HMAC Signature against the webhook secret
-    signature = request.headers.get('X-Hub-Signature')
-    if signature is None:
-        return False
-
-    sigtype, signature = signature.split('=')
-
-    # Did Github change their signature algorithm?
-    if sigtype != 'sha1':
-        return False
-
-    mac = hmac.new(secret.encode('ascii'), msg=request.data, digestmod='sha1')
-    if not hmac.compare_digest(str(mac.hexdigest()), str(signature)):
-        return False
+def process_github_webhook(request, payload):
+    """Creates a pending Build for a verified webhook delivery.
+    The payload has already been reduced by the webhook view
+    to the commit that is to be built.
+    """
+    project = request.db.query(Project).get(payload['project_id'])
+    if project is None or not project.active:
+        return
+
+    commit = Commit(
+        hexsha=payload['sha'],
+        ref=payload['ref'],
+        author_name=payload['author_name'],
+        author_email=payload['author_email'],
+        message=payload['message'][:256]
+    )
+    build = Build(project_id=project.id, commit=commit)
+    request.db.add(build)
+
+    if project.auto_cancel:
+        superseded, task_ids = cancel_superseded(
+            request.db, build, payload.get('before')
+        )
+        tasks.revoke(request, task_ids)
+        if superseded:
+            request.log.info('Cancelled superseded builds', **{
+                'project.id': project.id,
+                'build.ids': [obj.id for obj in superseded],
+                'commit.ref': commit.ref
+            })
+
+    request.log.info('Created build from webhook', **{
+        'project.id': project.id,
+        'webhook.event': payload['event'],
+        'webhook.delivery_id': payload['delivery_id']
+    })
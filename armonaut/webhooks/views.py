@@ -11,3 +11,150 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+import functools
+import hashlib
+import hmac
+import json
+from pyramid.httpexceptions import (
+    HTTPAccepted, HTTPBadRequest, HTTPForbidden, HTTPNotFound
+)
+from pyramid.view import view_config
+from armonaut.webhooks.interfaces import (
+    IWebhookSecretService, IWebhookDeliveryService
+)
+from armonaut.webhooks.tasks import process_github_webhook
+
+# Header and digest for each signature GitHub sends, strongest first.
+SIGNATURES = [
+    ('X-Hub-Signature-256', 'sha256', hashlib.sha256),
+    ('X-Hub-Signature', 'sha1', hashlib.sha1)
+]
+
+# Pull request actions that change the code to be built.
+PULL_REQUEST_ACTIONS = {'opened', 'reopened', 'synchronize'}
+
+
+def _verify_signature(request, secret):
+    """
+    Verifies the strongest signature in the request in constant time.
+    """
+    for header, sigtype, digestmod in SIGNATURES:
+        signature = request.headers.get(header)
+        if signature is None:
+            continue
+
+        prefix = sigtype + '='
+        if not signature.startswith(prefix):
+            return False
+        mac = hmac.new(secret.encode('utf-8'), request.body, digestmod)
+        return hmac.compare_digest(mac.hexdigest(), signature[len(prefix):])
+    return False
+
+
+def _secret_lookup(request):
+    """
+    Returns a function which looks up the webhook's secret by the
+    hook id or, if there isn't one, by the repository id.
+    """
+    secret_service = request.find_service(IWebhookSecretService, context=None)
+
+    hook_id = request.headers.get('X-GitHub-Hook-ID')
+    if hook_id is not None:
+        return functools.partial(secret_service.get, hook_id)
+
+    target_type = request.headers.get('X-GitHub-Hook-Installation-Target-Type')
+    repository_id = request.headers.get('X-GitHub-Hook-Installation-Target-ID')
+    if target_type == 'repository' and repository_id is not None:
+        return functools.partial(secret_service.get_for_repository, repository_id)
+    return None
+
+
+def _load_payload(request):
+    if request.content_type == 'application/x-www-form-urlencoded':
+        return json.loads(request.POST['payload'])
+    return json.loads(request.body.decode('utf-8'))
+
+
+def _compact_push(data):
+    head_commit = data.get('head_commit')
+    if data.get('deleted') or head_commit is None:
+        return None
+    return {
+        'ref': data['ref'],
+        'sha': head_commit['id'],
+        'before': data.get('before'),
+        'message': head_commit['message'],
+        'author_name': head_commit['author']['name'],
+        'author_email': head_commit['author']['email']
+    }
+
+
+def _compact_pull_request(data):
+    if data.get('action') not in PULL_REQUEST_ACTIONS:
+        return None
+    pull_request = data['pull_request']
+    return {
+        'ref': f'refs/pull/{pull_request["number"]}/head',
+        'sha': pull_request['head']['sha'],
+        'before': data.get('before'),
+        'message': pull_request['title'],
+        'author_name': pull_request['user']['login'],
+        'author_email': ''
+    }
+
+
+# Events that start builds and how to reduce their payload
+# to only what's needed to create the build.
+EVENTS = {
+    'push': _compact_push,
+    'pull_request': _compact_pull_request
+}
+
+
+@view_config(
+    route_name='webhooks.github',
+    require_csrf=False,
+    require_methods=['POST']
+)
+def github_webhook(request):
+    delivery_id = request.headers.get('X-GitHub-Delivery')
+    event = request.headers.get('X-GitHub-Event')
+    lookup = _secret_lookup(request)
+    if lookup is None or delivery_id is None or event is None:
+        return HTTPBadRequest('Missing GitHub webhook headers')
+
+    webhook_secret = lookup()
+    if (webhook_secret is None or
+            not _verify_signature(request, webhook_secret.secret)):
+        # The cached secret might be from before it was changed.
+        webhook_secret = lookup(cached=False)
+        if webhook_secret is None:
+            return HTTPNotFound('Unknown webhook')
+        if not _verify_signature(request, webhook_secret.secret):
+            return HTTPForbidden('Invalid webhook signature')
+
+    compact = EVENTS.get(event)
+    if compact is None:
+        return HTTPAccepted()
+
+    try:
+        payload = compact(_load_payload(request))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return HTTPBadRequest('Invalid webhook payload')
+    if payload is None:
+        return HTTPAccepted()
+
+    # GitHub retries deliveries that it didn't see a response
+    # for in time so only the first one is acted upon.
+    delivery_service = request.find_service(IWebhookDeliveryService, context=None)
+    if not delivery_service.accept(delivery_id):
+        return HTTPAccepted()
+
+    payload.update({
+        'event': event,
+        'delivery_id': delivery_id,
+        'project_id': webhook_secret.project_id
+    })
+    request.task(process_github_webhook).delay(payload)
+    return HTTPAccepted()
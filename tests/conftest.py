@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import os
 import pytest
 import dsnparse
 from alembic import command
 import pyramid.testing
 from armonaut.config import configure, Environment
+from armonaut.db import StatementStats
 from sqlalchemy import event
 import webtest as _webtest
 from pytest_postgresql.factories import (
@@ -100,6 +102,34 @@ def db_session(app_config):
         engine.dispose()
 
 
+@pytest.fixture
+def query_budget(db_session):
+    """Returns a context manager that fails the test if the code
+    within it issues more than ``maximum`` SQL statements::
+
+        with query_budget(1) as stats:
+            ...
+    """
+    @contextlib.contextmanager
+    def budget(maximum):
+        info = db_session.connection().info
+        previous = info.get('armonaut.statements')
+        stats = info['armonaut.statements'] = StatementStats()
+        try:
+            yield stats
+        finally:
+            if previous is None:
+                info.pop('armonaut.statements', None)
+            else:
+                info['armonaut.statements'] = previous
+
+        assert stats.count <= maximum, (
+            f'Issued {stats.count} SQL statements, the budget is {maximum}: '
+            f'{dict(stats.fingerprints)!r}'
+        )
+    return budget
+
+
 @pytest.yield_fixture
 def webtest(app_config) -> _webtest.TestApp:
     try:
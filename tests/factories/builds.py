@@ -0,0 +1,47 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import factory.fuzzy
+from armonaut.build.models import Build, Commit, Job, Status
+from . import ArmonautFactory
+from .projects import ProjectFactory
+
+
+class CommitFactory(ArmonautFactory):
+    class Meta:
+        model = Commit
+
+    hexsha = factory.fuzzy.FuzzyText(length=40, chars='0123456789abcdef')
+    ref = 'refs/heads/master'
+    author_name = factory.fuzzy.FuzzyText(length=12)
+    author_email = factory.fuzzy.FuzzyText(length=12, suffix='@example.com')
+    message = factory.fuzzy.FuzzyText(length=32)
+
+
+class BuildFactory(ArmonautFactory):
+    class Meta:
+        model = Build
+
+    status = Status.pending
+    project = factory.SubFactory(ProjectFactory)
+    commit = factory.SubFactory(CommitFactory)
+
+
+class JobFactory(ArmonautFactory):
+    class Meta:
+        model = Job
+
+    status = Status.pending
+    config = {}
+    build = factory.SubFactory(BuildFactory)
@@ -24,7 +24,7 @@ class ProjectFactory(ArmonautFactory):
 
     owner = factory.fuzzy.FuzzyText(length=12)
     name = factory.fuzzy.FuzzyText(length=12)
-    github_id = factory.fuzzy.FuzzyInteger(1, 10000)
+    github_id = factory.Sequence(lambda n: 10000 + n)
 
     webhook_id = factory.fuzzy.FuzzyInteger(1, 100)
     webhook_secret = factory.fuzzy.FuzzyText(length=32)
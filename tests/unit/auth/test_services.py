@@ -0,0 +1,30 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import pytest
+from armonaut.auth.services import RedisOAuthService
+
+
+@pytest.mark.parametrize(['deleted', 'expected'], [(1, True), (0, False)])
+def test_check_state(deleted, expected):
+    service = RedisOAuthService('redis://localhost:6379/0', 'id', 'secret')
+    service.redis = pretend.stub(
+        delete=pretend.call_recorder(lambda key: deleted)
+    )
+
+    assert service.check_state('state') is expected
+    assert service.redis.delete.calls == [
+        pretend.call('armonaut/oauth/data/state')
+    ]
@@ -0,0 +1,114 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import pytest
+from armonaut.build import includeme, tasks
+from armonaut.build.interfaces import IBuildScheduler
+from armonaut.build.services import build_scheduler_factory
+from armonaut.build.tasks import purge_expired_builds, schedule_jobs
+
+
+def test_includeme():
+    config = pretend.stub(
+        register_service_factory=pretend.call_recorder(lambda *args: None),
+        add_periodic_task=pretend.call_recorder(lambda *args: None)
+    )
+
+    includeme(config)
+
+    assert config.register_service_factory.calls == [
+        pretend.call(build_scheduler_factory, IBuildScheduler)
+    ]
+    assert config.add_periodic_task.calls == [
+        pretend.call(5, schedule_jobs),
+        pretend.call(3600, purge_expired_builds)
+    ]
+
+
+def test_schedule_jobs():
+    scheduler = pretend.stub(
+        schedule=pretend.call_recorder(lambda limit: [pretend.stub()])
+    )
+    request = pretend.stub(
+        find_service=lambda iface, context: scheduler,
+        registry=pretend.stub(settings={}),
+        log=pretend.stub(info=pretend.call_recorder(lambda *a, **kw: None))
+    )
+
+    schedule_jobs(request)
+
+    assert scheduler.schedule.calls == [pretend.call(50)]
+    assert request.log.info.calls == [
+        pretend.call('Scheduled jobs', **{'jobs.count': 1})
+    ]
+
+
+def _purge_request(settings):
+    delay = pretend.call_recorder(lambda **kwargs: None)
+    return pretend.stub(
+        db=pretend.stub(),
+        registry=pretend.stub(settings=settings),
+        log=pretend.stub(info=pretend.call_recorder(lambda *a, **kw: None)),
+        task=pretend.call_recorder(lambda func: pretend.stub(delay=delay))
+    )
+
+
+@pytest.mark.parametrize('settings', [{}, {'builds.retention_days': 0}])
+def test_purge_expired_builds_disabled(monkeypatch, settings):
+    purge_builds = pretend.call_recorder(lambda *args: 0)
+    monkeypatch.setattr(tasks, 'purge_builds', purge_builds)
+
+    purge_expired_builds(_purge_request(settings))
+
+    assert purge_builds.calls == []
+
+
+@pytest.mark.parametrize(
+    ('deleted', 'batch', 'next_batch'),
+    [
+        (0, 0, None),
+        (10, 0, None),
+        (tasks.RETENTION_BATCH_SIZE, 0, 1),
+        (tasks.RETENTION_BATCH_SIZE, tasks.RETENTION_MAX_BATCHES - 2,
+         tasks.RETENTION_MAX_BATCHES - 1),
+        (tasks.RETENTION_BATCH_SIZE, tasks.RETENTION_MAX_BATCHES - 1, None)
+    ]
+)
+def test_purge_expired_builds(monkeypatch, deleted, batch, next_batch):
+    purge_builds = pretend.call_recorder(lambda db, before, limit: deleted)
+    monkeypatch.setattr(tasks, 'purge_builds', purge_builds)
+    request = _purge_request({'builds.retention_days': 30})
+
+    purge_expired_builds(request, batch=batch)
+
+    assert len(purge_builds.calls) == 1
+    assert purge_builds.calls[0].args[2] == tasks.RETENTION_BATCH_SIZE
+    if deleted:
+        assert request.log.info.calls == [
+            pretend.call('Purged expired builds', **{
+                'builds.count': deleted,
+                'builds.batch': batch
+            })
+        ]
+    else:
+        assert request.log.info.calls == []
+
+    # Full batches continue in a new task, with its own transaction.
+    if next_batch is None:
+        assert request.task.calls == []
+    else:
+        assert request.task.calls == [pretend.call(purge_expired_builds)]
+        delay = request.task(purge_expired_builds).delay
+        assert delay.calls == [pretend.call(batch=next_batch)]
@@ -0,0 +1,123 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pytest
+from sqlalchemy import literal_column
+from sqlalchemy.dialects import postgresql
+from armonaut.build.models import Build, Job, Status
+from armonaut.build.services import expired_builds
+
+# Size of the generated history the query plans are checked against.
+BUILDS = 1000000
+JOBS_PER_BUILD = 2
+PROJECTS = 1000
+
+# Generating the history takes minutes so the query plans
+# are only checked when they're asked for explicitly.
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('ARMONAUT_TEST_QUERY_PLANS'),
+    reason='Set ARMONAUT_TEST_QUERY_PLANS=1 to check the query plans'
+)
+
+
+@pytest.fixture
+def history(db_session):
+    db_session.execute(
+        "INSERT INTO projects (github_id, name, owner, public, active) "
+        "SELECT i, 'project-' || i, 'owner-' || (i % 100), true, true "
+        "FROM generate_series(1, :projects) AS i",
+        {'projects': PROJECTS}
+    )
+    db_session.execute(
+        "INSERT INTO commits (hexsha, ref, author_name, author_email, message) "
+        "SELECT md5(i::text) || 'abcdefgh', 'refs/heads/master', 'Author', "
+        "'author@example.com', 'Commit ' || i "
+        "FROM generate_series(1, :builds) AS i",
+        {'builds': BUILDS}
+    )
+    db_session.execute(
+        "INSERT INTO builds (status, started_at, project_id, commit_id) "
+        "SELECT 'success', now() - i * interval '1 minute', "
+        "(SELECT min(id) FROM projects) + i % :projects, c.id "
+        "FROM (SELECT id, row_number() OVER (ORDER BY id) AS i FROM commits) AS c",
+        {'projects': PROJECTS}
+    )
+    db_session.execute(
+        "INSERT INTO jobs (status, started_at, config, build_id) "
+        "SELECT 'success', b.started_at, '{}', b.id "
+        "FROM builds AS b, generate_series(1, :jobs)",
+        {'jobs': JOBS_PER_BUILD}
+    )
+    db_session.execute('ANALYZE projects, commits, builds, jobs')
+
+    project_id, build_id = db_session.execute(
+        'SELECT project_id, id FROM builds ORDER BY id LIMIT 1'
+    ).first()
+    return project_id, build_id
+
+
+def _explain(db, query):
+    statement = query.statement.compile(
+        dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}
+    )
+    plan = db.execute(f'EXPLAIN (FORMAT JSON) {statement}').scalar()
+    nodes, pending = [], [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    return nodes
+
+
+def _assert_uses_index(nodes, table, index):
+    assert not any(
+        node['Node Type'] == 'Seq Scan' and node['Relation Name'] == table
+        for node in nodes
+    ), nodes
+    assert index in {node.get('Index Name') for node in nodes}, nodes
+
+
+def test_history_query_plans(db_session, history):
+    """
+    The history is generated once for all of the queries
+    since it's by far the slowest part of the test.
+    """
+    project_id, build_id = history
+
+    recent_builds = (
+        db_session.query(Build)
+        .filter(Build.project_id == project_id)
+        .order_by(Build.started_at.desc())
+        .limit(20)
+    )
+    nodes = _explain(db_session, recent_builds)
+    _assert_uses_index(nodes, 'builds', 'ix_builds_project_id_started_at')
+    assert not any(node['Node Type'] == 'Sort' for node in nodes)
+
+    jobs = db_session.query(Job).filter(Job.build_id == build_id)
+    _assert_uses_index(
+        _explain(db_session, jobs), 'jobs', 'ix_jobs_build_id_status'
+    )
+    _assert_uses_index(
+        _explain(db_session, jobs.filter(Job.status == Status.success)),
+        'jobs', 'ix_jobs_build_id_status'
+    )
+
+    # Nothing is old enough to be purged which is the usual case
+    # and mustn't need to walk every build to find that out.
+    purge = expired_builds(db_session, literal_column("now() - interval '10 years'"), 5000)
+    nodes = _explain(db_session, purge)
+    _assert_uses_index(nodes, 'builds', 'ix_builds_started_at_finished')
+    assert not any(node['Node Type'] == 'Sort' for node in nodes)
@@ -0,0 +1,368 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+import heapq
+import random
+import pretend
+import pytest
+from zope.interface.verify import verifyClass
+from armonaut.build.interfaces import IBuildScheduler
+from armonaut.build.models import Build, Commit, Job, Status
+from armonaut.build.services import (
+    Candidate, DatabaseBuildScheduler, build_scheduler_factory,
+    cancel_superseded, fair_order, purge_builds
+)
+from ...factories.builds import BuildFactory, CommitFactory, JobFactory
+from ...factories.projects import ProjectFactory
+
+T0 = datetime.datetime(2018, 1, 1)
+
+
+def _candidates(project_id, owner, count, start=0):
+    return [
+        Candidate(
+            job_id=project_id * 1000 + i, project_id=project_id, owner=owner,
+            started_at=T0 + datetime.timedelta(seconds=start + i), rank=i + 1
+        )
+        for i in range(count)
+    ]
+
+
+def test_scheduler_verify():
+    assert verifyClass(IBuildScheduler, DatabaseBuildScheduler)
+
+
+def test_fair_order_round_robins_projects():
+    candidates = _candidates(1, 'big', 5) + _candidates(2, 'a', 2, start=10)
+
+    chosen = fair_order(candidates, {}, 4, 5, 10)
+
+    assert [c.project_id for c in chosen] == [1, 2, 1, 2]
+
+
+def test_fair_order_counts_running_jobs():
+    candidates = _candidates(1, 'big', 3) + _candidates(2, 'a', 1, start=10)
+
+    chosen = fair_order(candidates, {(1, 'big'): 2}, 2, 5, 10)
+
+    assert [c.project_id for c in chosen] == [2, 1]
+
+
+def test_fair_order_project_limit():
+    chosen = fair_order(_candidates(1, 'big', 10), {(1, 'big'): 1}, 10, 3, 10)
+
+    assert len(chosen) == 2
+
+
+def test_fair_order_owner_limit():
+    candidates = _candidates(1, 'org', 5) + _candidates(2, 'org', 5)
+
+    chosen = fair_order(candidates, {}, 10, 5, 4)
+
+    assert sorted(c.project_id for c in chosen) == [1, 1, 2, 2]
+
+
+def test_fair_order_limit():
+    assert fair_order(_candidates(1, 'a', 5), {}, 0, 5, 5) == []
+
+
+def test_build_scheduler_factory():
+    request = pretend.stub(
+        db=pretend.stub(),
+        registry=pretend.stub(settings={'builds.max_jobs_per_project': 2})
+    )
+
+    scheduler = build_scheduler_factory(None, request)
+
+    assert scheduler.db is request.db
+    assert scheduler.max_per_project == 2
+    assert scheduler.max_per_owner == 10
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+def _query_candidates(pending, running, limit, max_per_project, max_per_owner):
+    """
+    Mirrors DatabaseBuildScheduler._candidates: ranks the pending jobs
+    within their project and then within their owner, drops the jobs
+    that don't fit within either limit and applies the same LIMIT.
+    """
+    projects = collections.Counter()
+    owners = collections.Counter()
+    for (project_id, owner), count in running.items():
+        projects[project_id] += count
+        owners[owner] += count
+
+    ranks = collections.Counter()
+    eligible = []
+    for c in sorted(pending, key=lambda c: (c.started_at, c.job_id)):
+        ranks[c.project_id] += 1
+        slot = ranks[c.project_id] + projects[c.project_id]
+        if slot <= max_per_project:
+            eligible.append((slot, c._replace(rank=ranks[c.project_id])))
+
+    owner_ranks = collections.Counter()
+    rows = []
+    for slot, c in sorted(eligible, key=lambda e: (e[0], e[1].started_at, e[1].job_id)):
+        owner_ranks[c.owner] += 1
+        if owner_ranks[c.owner] + owners[c.owner] <= max_per_owner:
+            rows.append((slot, c))
+    rows.sort(key=lambda e: (e[0], e[1].started_at))
+    return [c for _, c in rows[:limit * max_per_project]]
+
+
+def simulate(projects=2000, workers=300, monorepo_jobs=200, window=3600,
+             seed=0, max_per_project=5, max_per_owner=10, fair=True,
+             crowded_projects=0):
+    """
+    Simulates one monorepo pushing a large matrix every ten minutes
+    while thousands of small projects push a few jobs each over the
+    window. Optionally one owner with ``crowded_projects`` projects
+    pushes to all of them at the start. Returns the queue wait times
+    of the small projects' jobs and the most jobs the crowded owner
+    ever had running at once.
+    """
+    rng = random.Random(seed)
+    arrivals = []
+    for push, start in enumerate(range(0, window, 600)):
+        arrivals.extend(
+            c._replace(job_id=-(push * monorepo_jobs + c.job_id + 1))
+            for c in _candidates(0, 'monorepo', monorepo_jobs, start=start)
+        )
+    for project_id in range(projects + 1, projects + crowded_projects + 1):
+        arrivals.extend(_candidates(project_id, 'crowded', rng.randint(1, 4)))
+    for project_id in range(1, projects + 1):
+        start = rng.uniform(0, window)
+        arrivals.extend(_candidates(
+            project_id, f'owner-{project_id % (projects // 2)}',
+            rng.randint(1, 4), start=start
+        ))
+    arrivals.sort(key=lambda c: c.started_at)
+
+    def small(c):
+        return 0 < c.project_id <= projects
+
+    remaining = sum(1 for c in arrivals if small(c))
+
+    now = T0
+    pending, running, finishing, waits = [], {}, [], []
+    crowded_peak = 0
+    while remaining:
+        while arrivals and arrivals[0].started_at <= now:
+            pending.append(arrivals.pop(0))
+        while finishing and finishing[0][0] <= now:
+            _, key = heapq.heappop(finishing)
+            running[key] -= 1
+
+        free = workers - sum(running.values())
+        if fair:
+            candidates = _query_candidates(
+                pending, running, free, max_per_project, max_per_owner
+            )
+            chosen = fair_order(candidates, running, free, max_per_project, max_per_owner)
+        else:
+            chosen = sorted(pending, key=lambda c: (c.started_at, c.job_id))[:free]
+
+        chosen_ids = {c.job_id for c in chosen}
+        pending = [c for c in pending if c.job_id not in chosen_ids]
+        for c in chosen:
+            key = (c.project_id, c.owner)
+            running[key] = running.get(key, 0) + 1
+            duration = datetime.timedelta(seconds=rng.uniform(60, 300))
+            heapq.heappush(finishing, (now + duration, key))
+            if small(c):
+                remaining -= 1
+                waits.append((now - c.started_at).total_seconds())
+
+        crowded_peak = max(crowded_peak, sum(
+            count for (_, owner), count in running.items() if owner == 'crowded'
+        ))
+        now += datetime.timedelta(seconds=5)
+    return waits, crowded_peak
+
+
+def test_simulation_small_projects_are_not_starved():
+    fifo, _ = simulate(fair=False)
+    fair, _ = simulate(fair=True)
+
+    assert len(fair) == len(fifo)
+    assert _percentile(fair, 0.99) < _percentile(fifo, 0.5)
+
+
+def test_simulation_owner_at_limit_does_not_block_others():
+    """
+    One owner has more projects with old pending jobs than the
+    candidate query returns rows while it's at its limit, the other
+    owners still have to be scheduled.
+    """
+    fifo, _ = simulate(fair=False, crowded_projects=1000)
+    fair, crowded_peak = simulate(fair=True, crowded_projects=1000)
+
+    assert len(fair) == len(fifo)
+    assert _percentile(fair, 0.99) < _percentile(fifo, 0.5)
+    assert crowded_peak == 10
+
+
+def test_schedule_marks_jobs_running(db_session):
+    build = BuildFactory.create()
+    jobs = [JobFactory.create(build=build) for _ in range(3)]
+    scheduler = DatabaseBuildScheduler(db_session, max_per_project=2)
+
+    scheduled = scheduler.schedule(10)
+
+    assert scheduled == jobs[:2]
+    assert [job.status for job in jobs] == [
+        Status.running, Status.running, Status.pending
+    ]
+    assert scheduler.schedule(10) == []
+
+
+def test_schedule_is_fair_across_projects(db_session):
+    monorepo = BuildFactory.create()
+    for _ in range(10):
+        JobFactory.create(build=monorepo)
+    small = [JobFactory.create(build=BuildFactory.create()) for _ in range(3)]
+    scheduler = DatabaseBuildScheduler(db_session)
+
+    scheduled = scheduler.schedule(4)
+
+    assert set(small) < set(scheduled)
+
+
+@pytest.mark.parametrize('max_per_owner', [1, 2])
+def test_schedule_owner_limit(db_session, max_per_owner):
+    projects = [ProjectFactory.create(owner='owner') for _ in range(3)]
+    for project in projects:
+        JobFactory.create(build=BuildFactory.create(project=project))
+    scheduler = DatabaseBuildScheduler(db_session, max_per_owner=max_per_owner)
+
+    assert len(scheduler.schedule(10)) == max_per_owner
+
+
+def test_schedule_owner_at_limit_does_not_block_others(db_session):
+    crowded = [ProjectFactory.create(owner='crowded') for _ in range(20)]
+    for project in crowded:
+        JobFactory.create(build=BuildFactory.create(project=project))
+    other = JobFactory.create(build=BuildFactory.create())
+    scheduler = DatabaseBuildScheduler(db_session, max_per_project=1, max_per_owner=2)
+
+    assert len(scheduler.schedule(2)) == 2
+
+    # The crowded owner's older jobs would fill the LIMIT of the
+    # candidates query if the owner wasn't already at its limit.
+    assert scheduler.schedule(1) == [other]
+
+
+def test_cancel_superseded(db_session):
+    project = ProjectFactory.create()
+    old = BuildFactory.create(
+        project=project, status=Status.running,
+        commit=CommitFactory.create(hexsha='b' * 40)
+    )
+    done = JobFactory.create(build=old, status=Status.success)
+    running = JobFactory.create(build=old, status=Status.running, task_id='a')
+    pending = JobFactory.create(build=old)
+    other_ref = BuildFactory.create(
+        project=project,
+        commit=CommitFactory.create(hexsha='b' * 40, ref='refs/heads/other')
+    )
+    other_project = BuildFactory.create(commit=CommitFactory.create(hexsha='b' * 40))
+    build = BuildFactory.create(project=project)
+
+    cancelled, task_ids = cancel_superseded(db_session, build, 'b' * 40)
+
+    assert cancelled == [old]
+    assert task_ids == ['a']
+    assert old.status == Status.cancelled
+    assert [done.status, running.status, pending.status] == [
+        Status.success, Status.cancelled, Status.cancelled
+    ]
+    assert other_ref.status == Status.pending
+    assert other_project.status == Status.pending
+    assert build.status == Status.pending
+
+
+def test_cancel_superseded_only_replaced_commit(db_session):
+    project = ProjectFactory.create()
+    unrelated = BuildFactory.create(
+        project=project, commit=CommitFactory.create(hexsha='c' * 40)
+    )
+    build = BuildFactory.create(project=project)
+
+    assert cancel_superseded(db_session, build, 'b' * 40) == ([], [])
+    assert unrelated.status == Status.pending
+
+
+def test_cancel_superseded_out_of_order(db_session):
+    """
+    The task for the older push runs after the task for the newer
+    push so the newer commit's build has a lower id but isn't the
+    commit that the older push replaced and must not be cancelled.
+    """
+    project = ProjectFactory.create()
+    newer = BuildFactory.create(
+        project=project, commit=CommitFactory.create(hexsha='c' * 40)
+    )
+    oldest = BuildFactory.create(
+        project=project, commit=CommitFactory.create(hexsha='a' * 40)
+    )
+    build = BuildFactory.create(
+        project=project, commit=CommitFactory.create(hexsha='b' * 40)
+    )
+
+    cancelled, _ = cancel_superseded(db_session, build, 'a' * 40)
+
+    assert cancelled == [oldest]
+    assert newer.status == Status.pending
+    assert build.status == Status.pending
+
+
+def test_cancel_superseded_without_before(db_session):
+    project = ProjectFactory.create()
+    old = BuildFactory.create(project=project)
+    build = BuildFactory.create(project=project)
+
+    assert cancel_superseded(db_session, build, None) == ([], [])
+    assert old.status == Status.pending
+
+
+def test_purge_builds(db_session):
+    old = T0 - datetime.timedelta(days=1)
+    expired = BuildFactory.create(started_at=old, status=Status.success)
+    JobFactory.create(build=expired, status=Status.success)
+    running = BuildFactory.create(started_at=old, status=Status.running)
+    recent = BuildFactory.create(status=Status.success)
+    build_id, commit_id = expired.id, expired.commit_id
+
+    assert purge_builds(db_session, T0, 10) == 1
+    db_session.expire_all()
+
+    assert db_session.query(Build).order_by(Build.id).all() == [running, recent]
+    assert db_session.query(Job).filter(Job.build_id == build_id).count() == 0
+    assert db_session.query(Commit).get(commit_id) is None
+
+
+def test_purge_builds_limit(db_session):
+    old = T0 - datetime.timedelta(days=1)
+    for _ in range(3):
+        BuildFactory.create(started_at=old, status=Status.failure)
+
+    assert purge_builds(db_session, T0, 2) == 2
+    assert purge_builds(db_session, T0, 2) == 1
+    assert purge_builds(db_session, T0, 2) == 0
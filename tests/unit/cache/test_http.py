@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import pytest
 import pretend
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache import http
 from armonaut.cache.http import (
-    cache_control, add_vary,
+    cache_control, add_vary, merge_vary,
     conditional_http_tween_factory, includeme
 )
 
@@ -132,14 +136,7 @@ def test_prevent_http_cache():
 def test_add_vary(vary):
     """Assert that the add_vary() directive correctly adds
     a non-duplicate value to the Vary HTTP header."""
-    class FakeRequest:
-        def __init__(self):
-            self.callbacks = []
-
-        def add_response_callback(self, callback):
-            self.callbacks.append(callback)
-
-    request = FakeRequest()
+    request = pretend.stub(response_vary={'foobar'})
     context = pretend.stub()
     response = pretend.stub(vary=vary)
 
@@ -147,14 +144,23 @@ def test_add_vary(vary):
         return response
 
     assert add_vary('foobar')(view)(context, request) is response
-    assert len(request.callbacks) == 1
+    assert request.response_vary == {'foobar'}
 
-    request.callbacks[0](request, response)
+    merge_vary(request, response)
 
     if vary is None:
         vary = []
 
-    assert response.vary == {'foobar'} | set(vary)
+    assert response.vary == sorted({'foobar'} | set(vary))
+
+
+def test_merge_vary_without_pending_vary():
+    request = pretend.stub(response_vary=set())
+    response = pretend.stub(vary=['foo'])
+
+    merge_vary(request, response)
+
+    assert response.vary == ['foo']
 
 
 def test_has_last_modified():
@@ -170,10 +176,10 @@ def test_has_last_modified():
         content_length=None
     )
 
-    request = pretend.stub(method='GET')
+    request = pretend.stub(method='GET', path_qs='/')
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -193,7 +199,7 @@ def test_explicit_etag():
     request = pretend.stub(method='GET')
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -219,7 +225,7 @@ def test_implicit_etag(method):
     request = pretend.stub(method=method)
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -246,7 +252,7 @@ def test_implicit_etag_buffers_streaming():
     request = pretend.stub(method='GET')
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -270,7 +276,7 @@ def test_no_implicit_etag_not_200():
     request = pretend.stub(method="GET")
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -295,7 +301,7 @@ def test_no_implicit_etag_wrong_method(method):
     request = pretend.stub(method=method)
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -321,7 +327,7 @@ def test_no_etag_if_streaming_without_content_length():
     request = pretend.stub(method='GET')
     handler = pretend.call_recorder(lambda request: response)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = conditional_http_tween_factory(handler, pretend.stub(settings={}))
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
@@ -329,12 +335,151 @@ def test_no_etag_if_streaming_without_content_length():
     assert not response.conditional_response
 
 
+LAST_MODIFIED = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _streamed_response(chunks, content_length, last_modified=LAST_MODIFIED):
+    return Response(
+        app_iter=iter(chunks),
+        content_length=content_length,
+        last_modified=last_modified
+    )
+
+
+def _send(tween, request):
+    response = tween(request)
+    status, headers, body = None, None, []
+
+    def start_response(s, h, exc_info=None):
+        nonlocal status, headers
+        status, headers = s, dict(h)
+
+    app_iter = response(request.environ, start_response)
+    body = b''.join(app_iter)
+    getattr(app_iter, 'close', lambda: None)()
+    return status, headers, body
+
+
+@pytest.mark.parametrize('hash_name', ['md5', 'blake2b', 'crc32'])
+def test_streaming_etag_remembered(monkeypatch, hash_name):
+    """Large streamed responses are hashed while they're sent and their
+    ETag is used for If-None-Match on following requests.
+    """
+    monkeypatch.setattr(http, 'BUFFER_MAX', 4)
+    chunks = [b'foo', b'bar', b'baz']
+    handler = pretend.call_recorder(
+        lambda request: _streamed_response(chunks, 9)
+    )
+    tween = conditional_http_tween_factory(
+        handler, pretend.stub(settings={'cache.etag_hash': hash_name})
+    )
+
+    status, headers, body = _send(tween, Request.blank('/log'))
+    assert status == '200 OK'
+    assert 'ETag' not in headers
+    assert body == b'foobarbaz'
+
+    status, headers, body = _send(tween, Request.blank('/log'))
+    assert status == '200 OK'
+    etag = headers['ETag']
+
+    request = Request.blank('/log', headers={'If-None-Match': etag})
+    status, headers, body = _send(tween, request)
+    assert status == '304 Not Modified'
+    assert body == b''
+
+    # Buffered responses get the same ETag for the same body.
+    monkeypatch.setattr(http, 'BUFFER_MAX', 1024)
+    status, headers, body = _send(tween, Request.blank('/other'))
+    assert headers['ETag'] == etag
+
+
+def test_streaming_etag_not_trusted_when_changed(monkeypatch):
+    monkeypatch.setattr(http, 'BUFFER_MAX', 4)
+    responses = iter([
+        _streamed_response([b'foobarbaz'], 9),
+        _streamed_response([b'foobarbazqux'], 12)
+    ])
+    tween = conditional_http_tween_factory(
+        lambda request: next(responses), pretend.stub(settings={})
+    )
+
+    _send(tween, Request.blank('/log'))
+    status, headers, body = _send(tween, Request.blank('/log'))
+
+    assert 'ETag' not in headers
+    assert body == b'foobarbazqux'
+
+
+def test_streaming_etag_not_trusted_when_modified(monkeypatch):
+    monkeypatch.setattr(http, 'BUFFER_MAX', 4)
+    responses = iter([
+        _streamed_response([b'foobarbaz'], 9),
+        _streamed_response([b'bazbarfoo'], 9, LAST_MODIFIED + datetime.timedelta(1))
+    ])
+    tween = conditional_http_tween_factory(
+        lambda request: next(responses), pretend.stub(settings={})
+    )
+
+    _send(tween, Request.blank('/log'))
+    status, headers, body = _send(tween, Request.blank('/log'))
+
+    assert 'ETag' not in headers
+    assert body == b'bazbarfoo'
+
+
+def test_streaming_etag_needs_last_modified(monkeypatch):
+    """The Content-Length alone isn't enough to tell that a streamed
+    response is unchanged as it could be replaced with content of
+    the same size, so its ETag isn't remembered.
+    """
+    monkeypatch.setattr(http, 'BUFFER_MAX', 4)
+    responses = iter([
+        _streamed_response([b'foobarbaz'], 9, None),
+        _streamed_response([b'bazbarfoo'], 9, None)
+    ])
+    tween = conditional_http_tween_factory(
+        lambda request: next(responses), pretend.stub(settings={})
+    )
+
+    _send(tween, Request.blank('/log'))
+    status, headers, body = _send(tween, Request.blank('/log'))
+
+    assert 'ETag' not in headers
+    assert body == b'bazbarfoo'
+
+
+def test_streaming_etag_not_remembered_if_closed_early(monkeypatch):
+    monkeypatch.setattr(http, 'BUFFER_MAX', 4)
+    closed = []
+    tween = conditional_http_tween_factory(
+        lambda request: _streamed_response([b'foo', b'bar'], 6),
+        pretend.stub(settings={})
+    )
+
+    response = tween(Request.blank('/log'))
+    response.app_iter.app_iter = pretend.stub(
+        __iter__=lambda: iter([b'foo', b'bar']),
+        close=lambda: closed.append(True)
+    )
+    app_iter = iter(response.app_iter)
+    next(app_iter)
+    response.app_iter.close()
+
+    assert closed == [True]
+    assert tween(Request.blank('/log')).etag is None
+
+
 def test_includeme():
     config = pretend.stub(
+        add_request_method=pretend.call_recorder(lambda *a, **kw: None),
         add_tween=pretend.call_recorder(lambda t: None)
     )
     includeme(config)
 
+    assert config.add_request_method.calls == [
+        pretend.call(http._response_vary, 'response_vary', reify=True)
+    ]
     assert config.add_tween.calls == [
         pretend.call('armonaut.cache.http.conditional_http_tween_factory')
     ]
@@ -0,0 +1,89 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from armonaut.cache.lru import LRUCache
+
+
+def test_get_missing():
+    cache = LRUCache()
+
+    assert cache.get('key') is None
+    assert cache.get('key', 1) == 1
+    assert cache.stats() == {
+        'hits': 0, 'misses': 2, 'size': 0, 'weight': 0, 'hit_rate': 0.0
+    }
+
+
+def test_set_and_get():
+    cache = LRUCache()
+    cache.set('key', 'value')
+
+    assert 'key' in cache
+    assert cache.get('key') == 'value'
+    assert cache.stats() == {
+        'hits': 1, 'misses': 0, 'size': 1, 'weight': 0, 'hit_rate': 1.0
+    }
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    # Using 'a' makes 'b' the least recently used.
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_pop_and_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_evicts_over_maxweight():
+    cache = LRUCache(maxsize=10, maxweight=10)
+    cache.set('a', 1, weight=4)
+    cache.set('b', 2, weight=4)
+    cache.set('c', 3, weight=4)
+
+    assert 'a' not in cache
+    assert cache.weight == 8
+
+    # Replacing an entry doesn't count its old weight twice.
+    cache.set('c', 4, weight=2)
+    assert cache.weight == 6
+
+    cache.pop('b')
+    assert cache.weight == 2
+
+
+def test_set_heavier_than_maxweight():
+    cache = LRUCache(maxweight=10)
+    cache.set('a', 1, weight=11)
+
+    assert 'a' not in cache
+    assert cache.weight == 0
@@ -15,6 +15,8 @@
 import pretend
 import pusher
 from armonaut.events import includeme, _pusher
+from armonaut.events.interfaces import IEventPublisher
+from armonaut.events.services import event_publisher_factory
 
 
 def test_includeme(monkeypatch):
@@ -32,7 +34,8 @@ def test_includeme(monkeypatch):
             },
             __setitem__=pretend.call_recorder(lambda *args, **kwargs: None)
         ),
-        add_request_method=pretend.call_recorder(lambda *args, **kwargs: None)
+        add_request_method=pretend.call_recorder(lambda *args, **kwargs: None),
+        register_service_factory=pretend.call_recorder(lambda *args: None)
     )
 
     includeme(config)
@@ -45,3 +48,6 @@ def test_includeme(monkeypatch):
     )]
     assert config.add_request_method.calls == [pretend.call(_pusher, name='pusher', reify=True)]
     assert config.registry.__setitem__.calls == [pretend.call('pusher.client', pusher_obj)]
+    assert config.register_service_factory.calls == [
+        pretend.call(event_publisher_factory, IEventPublisher)
+    ]
@@ -0,0 +1,266 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import pytest
+import redis
+from zope.interface.verify import verifyClass
+from pusher.errors import PusherError
+from armonaut.events import EVENT_NEW_BUILD, EVENT_JOB_STATUS, EVENT_BUILD_STATUS
+from armonaut.events import services
+from armonaut.events.interfaces import IEventPublisher
+from armonaut.events.services import (
+    RedisEventPublisher, event_publisher_factory, MAX_BATCH_SIZE
+)
+
+
+class FakeRedis(object):
+    """In-memory stand-in for the few Redis commands the publisher uses."""
+    def __init__(self):
+        self.hashes = {}
+        self.keys = {}
+        self.round_trips = 0
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def hset(self, key, mapping):
+        self.commands.append(
+            lambda: self.redis.hashes.setdefault(key, {}).update(mapping)
+        )
+
+    def hsetnx(self, key, field, value):
+        self.commands.append(
+            lambda: self.redis.hashes.setdefault(key, {}).setdefault(field, value)
+        )
+
+    def hgetall(self, key):
+        self.commands.append(lambda: dict(self.redis.hashes.get(key, {})))
+
+    def delete(self, *keys):
+        def command():
+            for key in keys:
+                self.redis.hashes.pop(key, None)
+                self.redis.keys.pop(key, None)
+        self.commands.append(command)
+
+    def set(self, key, value, nx, px):
+        def command():
+            if nx and key in self.redis.keys:
+                return None
+            self.redis.keys[key] = value
+            return True
+        self.commands.append(command)
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [command() for command in self.commands]
+
+
+class FakePusher(object):
+    """Local stub of the Pusher API which records every call made."""
+    def __init__(self):
+        self.batches = []
+        self.calls = 0
+        self.errors = {}
+
+    def trigger_batch(self, batch):
+        assert len(batch) <= MAX_BATCH_SIZE
+        self.calls += 1
+        if self.calls in self.errors:
+            raise self.errors[self.calls]
+        self.batches.append(batch)
+
+
+@pytest.fixture
+def publisher(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(
+        redis, 'StrictRedis', pretend.stub(from_url=lambda url: fake_redis)
+    )
+    flush_task = pretend.stub(
+        apply_async=pretend.call_recorder(lambda countdown: None)
+    )
+    return RedisEventPublisher(
+        'redis://localhost:6379/0', FakePusher(), flush_task
+    )
+
+
+def _events(publisher):
+    return [event for batch in publisher.pusher.batches for event in batch]
+
+
+def test_verify_service():
+    assert verifyClass(IEventPublisher, RedisEventPublisher)
+
+
+def test_publish_buffered_until_commit(publisher):
+    publisher.publish('channel', EVENT_NEW_BUILD, {'id': 1})
+
+    assert publisher.redis.round_trips == 0
+    assert publisher.flush_task.apply_async.calls == []
+
+    publisher._before_commit_hook()
+
+    assert publisher.redis.round_trips == 1
+    assert publisher.flush_task.apply_async.calls == [
+        pretend.call(countdown=publisher.window)
+    ]
+
+
+def test_publish_nothing_on_commit(publisher):
+    publisher._before_commit_hook()
+
+    assert publisher.redis.round_trips == 0
+
+
+def test_flush_scheduled_once_per_window(publisher):
+    for i in range(3):
+        publisher.publish('channel', EVENT_NEW_BUILD, {'id': i})
+        publisher._before_commit_hook()
+
+    assert len(publisher.flush_task.apply_async.calls) == 1
+
+
+def test_flush_reschedules_for_later_events(publisher):
+    """The flush can run before the scheduled key expires, events
+    published after it must still schedule a flush of their own.
+    """
+    publisher.publish('channel', EVENT_BUILD_STATUS, {'id': 1, 'status': 'running'})
+    publisher._before_commit_hook()
+    publisher.flush()
+
+    publisher.publish('channel', EVENT_BUILD_STATUS, {'id': 1, 'status': 'success'})
+    publisher._before_commit_hook()
+
+    assert len(publisher.flush_task.apply_async.calls) == 2
+    assert publisher.flush() == 1
+    assert _events(publisher)[-1]['data'] == {'id': 1, 'status': 'success'}
+
+
+def test_flush_multiple_channels(publisher):
+    publisher.publish(['channel-1', 'channel-2'], EVENT_NEW_BUILD, {'id': 1})
+    publisher._before_commit_hook()
+
+    assert publisher.flush() == 1
+    assert _events(publisher) == [
+        {'channel': 'channel-1', 'name': EVENT_NEW_BUILD, 'data': {'id': 1}},
+        {'channel': 'channel-2', 'name': EVENT_NEW_BUILD, 'data': {'id': 1}}
+    ]
+
+    # Events are only ever sent once.
+    assert publisher.flush() == 0
+    assert len(publisher.pusher.batches) == 1
+
+
+def test_flush_collapses_superseded_status(publisher):
+    publisher.publish('channel', EVENT_JOB_STATUS, {'id': 1, 'status': 'pending'})
+    publisher.publish('channel', EVENT_JOB_STATUS, {'id': 2, 'status': 'pending'})
+    publisher._before_commit_hook()
+    publisher.publish('channel', EVENT_JOB_STATUS, {'id': 1, 'status': 'running'})
+    publisher._before_commit_hook()
+    publisher.flush()
+
+    assert [event['data'] for event in _events(publisher)] == [
+        {'id': 2, 'status': 'pending'},
+        {'id': 1, 'status': 'running'}
+    ]
+
+
+def test_flush_requeues_unsent_events(publisher):
+    for i in range(MAX_BATCH_SIZE * 2 + 1):
+        publisher.publish('channel', EVENT_NEW_BUILD, {'id': i})
+    publisher.publish('channel', EVENT_BUILD_STATUS, {'id': 1, 'status': 'running'})
+    publisher._before_commit_hook()
+
+    publisher.pusher.errors = {2: PusherError('Service unavailable')}
+    with pytest.raises(PusherError):
+        publisher.flush()
+    assert len(publisher.pusher.batches) == 1
+
+    # A newer status published in the meantime replaces the unsent one.
+    publisher.publish('channel', EVENT_BUILD_STATUS, {'id': 1, 'status': 'success'})
+    publisher._before_commit_hook()
+
+    assert publisher.flush() == 2
+    assert publisher.flush() == 0
+
+    events = [event['data'] for event in _events(publisher)]
+    assert events[:MAX_BATCH_SIZE] == [{'id': i} for i in range(MAX_BATCH_SIZE)]
+    assert events[MAX_BATCH_SIZE:] == (
+        [{'id': i} for i in range(MAX_BATCH_SIZE, MAX_BATCH_SIZE * 2 + 1)] +
+        [{'id': 1, 'status': 'success'}]
+    )
+
+
+def test_build_matrix_calls_per_build(publisher):
+    """A build with a 50 job matrix which moves every job through
+    pending, running and success within a single window should be
+    delivered with one batch call per 10 jobs plus the build events.
+    """
+    channel = 'private-project-owner@name'
+    publisher.publish(channel, EVENT_NEW_BUILD, {'id': 1})
+    for status in ['pending', 'running', 'success']:
+        for job_id in range(50):
+            publisher.publish(
+                channel, EVENT_JOB_STATUS, {'id': job_id, 'status': status}
+            )
+            publisher._before_commit_hook()
+        publisher.publish(channel, EVENT_BUILD_STATUS, {'id': 1, 'status': status})
+        publisher._before_commit_hook()
+
+    publisher.flush()
+
+    events = _events(publisher)
+    assert len(publisher.pusher.batches) == 6
+    assert len(events) == 52
+    assert events[0]['name'] == EVENT_NEW_BUILD
+    assert all(event['data']['status'] == 'success' for event in events[1:])
+    assert len(publisher.flush_task.apply_async.calls) == 1
+
+
+def test_factory_registers_before_commit_hook(monkeypatch):
+    pool = pretend.stub()
+    monkeypatch.setattr(services, 'connection_pool', lambda registry, url: pool)
+    monkeypatch.setattr(redis, 'StrictRedis', lambda connection_pool: pretend.stub())
+    transaction = pretend.stub(
+        addBeforeCommitHook=pretend.call_recorder(lambda hook: None)
+    )
+    flush_task = pretend.stub()
+    request = pretend.stub(
+        registry=pretend.stub(settings={
+            'events.url': 'redis://localhost:6379/0',
+            'events.window': 2.0
+        }),
+        pusher=pretend.stub(),
+        task=pretend.call_recorder(lambda func: flush_task),
+        tm=pretend.stub(get=lambda: transaction)
+    )
+
+    publisher = event_publisher_factory(None, request)
+
+    assert isinstance(publisher, RedisEventPublisher)
+    assert publisher.window == 2.0
+    assert publisher.flush_task is flush_task
+    assert publisher.pusher is request.pusher
+    assert request.task.calls == [pretend.call(services.flush_events)]
+    assert transaction.addBeforeCommitHook.calls == [
+        pretend.call(publisher._before_commit_hook)
+    ]
@@ -14,20 +14,35 @@
 
 import pretend
 import pytest
-from armonaut.events.tasks import send_event
+from armonaut.events.interfaces import IEventPublisher
+from armonaut.events.tasks import send_event, flush_events
+
+
+def _request(publisher):
+    return pretend.stub(
+        find_service=pretend.call_recorder(lambda iface, context: publisher)
+    )
 
 
 @pytest.mark.parametrize('channels', ['channel-name', ['channel-1', 'channel-2']])
 def test_send_event(channels):
-    request = pretend.stub(
-        pusher=pretend.stub(
-            trigger=pretend.call_recorder(lambda *args, **kwargs: None)
-        )
+    publisher = pretend.stub(
+        publish=pretend.call_recorder(lambda *args: None)
     )
+    request = _request(publisher)
     send_event(request, channels=channels, event='event-name', data={'key': 'value'})
 
-    assert request.pusher.trigger.calls == [
-        pretend.call(channels=channels,
-                     event_name='event-name',
-                     data={'key': 'value'})
+    assert request.find_service.calls == [
+        pretend.call(IEventPublisher, context=None)
+    ]
+    assert publisher.publish.calls == [
+        pretend.call(channels, 'event-name', {'key': 'value'})
     ]
+
+
+def test_flush_events():
+    publisher = pretend.stub(flush=pretend.call_recorder(lambda: 1))
+    request = _request(publisher)
+    flush_events(request)
+
+    assert publisher.flush.calls == [pretend.call()]
@@ -14,7 +14,7 @@
 
 import pytest
 from pyramid.security import Allow, Everyone
-from armonaut.project.models import Project, ProjectRoleType
+from armonaut.project.models import Project, ProjectRoleType, ProjectFactory as ProjectFactory_
 from ...factories.projects import ProjectRoleFactory, ProjectFactory
 
 
@@ -50,3 +50,82 @@ def test_public_project_acls(db_session):
     project = ProjectFactory.create()
 
     assert project.__acl__() == [(Allow, 'group:admins', ['admin']), (Allow, Everyone, ['project:read'])]
+
+
+def test_project_acls_cached(db_session, query_budget):
+    role = ProjectRoleFactory.create(role_type=ProjectRoleType.READ_ONLY)
+    project = role.project
+    project.public = False
+    db_session.flush()
+
+    acls = project.__acl__()
+
+    with query_budget(0):
+        assert project.__acl__() == acls
+
+
+def test_project_acls_invalidated_on_role_change(db_session):
+    role = ProjectRoleFactory.create(role_type=ProjectRoleType.READ_ONLY)
+    project = role.project
+    project.public = False
+    db_session.flush()
+
+    acl_version = project.acl_version
+    assert project.__acl__()[-1] == (Allow, str(role.user_id), ['project:read'])
+
+    role.role_type = ProjectRoleType.COLLABORATOR
+    db_session.flush()
+
+    assert project.acl_version == acl_version + 1
+    assert project.__acl__()[-1] == (
+        Allow, str(role.user_id), ['project:manage', 'project:read']
+    )
+
+
+def _traverse(pyramid_request, project):
+    factory = ProjectFactory_(pyramid_request)
+    return factory[project.owner][project.name]
+
+
+def test_project_factory_traversal(pyramid_request):
+    project = ProjectFactory.create()
+
+    assert _traverse(pyramid_request, project) is project
+
+
+def test_project_factory_not_found(pyramid_request):
+    factory = ProjectFactory_(pyramid_request)
+
+    with pytest.raises(KeyError):
+        factory['owner']['name']
+
+
+def test_project_factory_renamed_project(pyramid_request, db_session):
+    project = ProjectFactory.create()
+    owner, name = project.owner, project.name
+    _traverse(pyramid_request, project)
+
+    project.name = 'renamed'
+    db_session.flush()
+
+    factory = ProjectFactory_(pyramid_request)
+    with pytest.raises(KeyError):
+        factory[owner][name]
+    assert _traverse(pyramid_request, project) is project
+
+
+def test_project_factory_single_query(pyramid_request, db_session, query_budget):
+    """Assert that traversing to a project and computing its
+    ACL for authorization is only a single query.
+    """
+    role = ProjectRoleFactory.create()
+    project = role.project
+    db_session.flush()
+    db_session.expunge_all()
+
+    with query_budget(1) as stats:
+        traversed = _traverse(pyramid_request, project)
+        acls = traversed.__acl__()
+
+    assert stats.count == 1
+    assert acls[1][1] == str(role.user_id)
@@ -0,0 +1,126 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import msgpack
+import pretend
+import redis
+from zope.interface.verify import verifyClass
+from armonaut.project import services
+from armonaut.project.interfaces import IConditionalRequestCache
+from armonaut.project.services import (
+    RedisConditionalRequestCache, conditional_request_cache_factory
+)
+
+
+class FakePipeline(object):
+    def __init__(self):
+        self.setex = pretend.call_recorder(lambda *args: None)
+        self.execute = pretend.call_recorder(lambda: None)
+
+
+def test_verify_service():
+    assert verifyClass(IConditionalRequestCache, RedisConditionalRequestCache)
+
+
+def _cache(monkeypatch, **kwargs):
+    strict_redis_obj = pretend.stub(**kwargs)
+    monkeypatch.setattr(
+        redis, 'StrictRedis', pretend.stub(from_url=lambda url: strict_redis_obj)
+    )
+    return RedisConditionalRequestCache('redis://localhost:6379/0')
+
+
+def test_get_not_cached(monkeypatch):
+    cache = _cache(monkeypatch, get=pretend.call_recorder(lambda key: None))
+
+    assert cache.get('1/owner/1') is None
+    assert cache.redis.get.calls == [pretend.call('armonaut/github/etag/1/owner/1')]
+
+
+def test_get_cached(monkeypatch):
+    data = {'etag': '"abc"', 'last_modified': None}
+    cache = _cache(
+        monkeypatch,
+        get=lambda key: msgpack.packb(data, encoding='utf-8', use_bin_type=True)
+    )
+
+    assert cache.get('1/owner/1') == data
+
+
+def test_set_after_commit(monkeypatch):
+    pipeline = FakePipeline()
+    cache = _cache(monkeypatch, pipeline=lambda transaction: pipeline)
+
+    cache.set('1/owner/1', '"abc"', None)
+    assert pipeline.setex.calls == []
+
+    cache._after_commit_hook(True)
+
+    assert pipeline.setex.calls == [pretend.call(
+        'armonaut/github/etag/1/owner/1',
+        cache.max_age,
+        msgpack.packb({'etag': '"abc"', 'last_modified': None},
+                      encoding='utf-8', use_bin_type=True)
+    )]
+    assert pipeline.execute.calls == [pretend.call()]
+
+
+def test_set_not_stored_on_abort(monkeypatch):
+    pipeline = FakePipeline()
+    cache = _cache(monkeypatch, pipeline=lambda transaction: pipeline)
+
+    cache.set('1/owner/1', '"abc"', None)
+    cache._after_commit_hook(False)
+    cache._after_commit_hook(True)
+
+    assert pipeline.setex.calls == []
+    assert pipeline.execute.calls == []
+
+
+def test_stats(monkeypatch):
+    cache = _cache(
+        monkeypatch,
+        incr=pretend.call_recorder(lambda key: None),
+        mget=lambda *keys: [b'2', None]
+    )
+
+    cache.hit()
+    cache.miss()
+
+    assert cache.redis.incr.calls == [
+        pretend.call('armonaut/github/etag-stats/hits'),
+        pretend.call('armonaut/github/etag-stats/misses')
+    ]
+    assert cache.stats() == {'hits': 2, 'misses': 0}
+
+
+def test_factory_registers_after_commit_hook(monkeypatch):
+    _cache(monkeypatch)
+    pool = pretend.stub()
+    monkeypatch.setattr(services, 'connection_pool', lambda registry, url: pool)
+    monkeypatch.setattr(redis, 'StrictRedis', lambda connection_pool: pretend.stub())
+    transaction = pretend.stub(
+        addAfterCommitHook=pretend.call_recorder(lambda hook: None)
+    )
+    request = pretend.stub(
+        registry=pretend.stub(settings={'github.cache_url': 'redis://localhost:6379/0'}),
+        tm=pretend.stub(get=lambda: transaction)
+    )
+
+    cache = conditional_request_cache_factory(None, request)
+
+    assert isinstance(cache, RedisConditionalRequestCache)
+    assert transaction.addAfterCommitHook.calls == [
+        pretend.call(cache._after_commit_hook)
+    ]
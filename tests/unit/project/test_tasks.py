@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import re
+import threading
+import time
 import pretend
 import pytest
+import transaction
 from armonaut.project.tasks import (
-    list_all_projects, update_all_projects, synchronize_user
+    list_all_projects, iter_project_pages, update_all_projects,
+    synchronize_user, synchronize_all_users
 )
 from armonaut.project import tasks
+from armonaut.project.interfaces import IConditionalRequestCache
 from armonaut.project.models import ProjectRoleType, Project
 from ...factories.users import UserFactory
 from ...factories.projects import ProjectFactory, ProjectRoleFactory
@@ -113,9 +120,200 @@ def test_list_all_projects_multiple_pages():
     assert resp2.json.calls == [pretend.call()]
 
 
+class FakeGitHub(object):
+    """Serves ``/user/repos`` from memory with the same ``Link``
+    pagination headers that GitHub sends so that pagination can be
+    exercised without network access.
+    """
+    def __init__(self, total, per_page=30, latency=0.0):
+        self.repos = [{'id': i} for i in range(total)]
+        self.per_page = per_page
+        self.latency = latency
+        self.pages = []
+        self.changed = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.wait_for = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def _url(self, page):
+        return f'https://api.github.com/user/repos?affiliation=owner&sort=updated&page={page}'
+
+    def get(self, url, params=None, headers=None):
+        match = re.search(r'[?&]page=(\d+)', url)
+        page = int((params or {}).get('page', match.group(1) if match else 1))
+
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.wait_for is not None and self.in_flight >= self.wait_for:
+                self._ready.set()
+        try:
+            # Requests after the first page are held until ``wait_for``
+            # of them are in flight at once, or until the timeout.
+            if self.wait_for is not None and page > 1:
+                self._ready.wait(timeout=5)
+            time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+        self.pages.append(page)
+
+        last_page = max(1, -(-len(self.repos) // self.per_page))
+        links = []
+        if page < last_page:
+            links.append(f'<{self._url(page + 1)}>; rel="next"')
+            links.append(f'<{self._url(last_page)}>; rel="last"')
+
+        etag = f'"{page}-{page in self.changed}"'
+        if (headers or {}).get('If-None-Match') == etag:
+            status_code = 304
+        else:
+            status_code = 200
+
+        body = self.repos[(page - 1) * self.per_page:page * self.per_page]
+        resp = pretend.stub(
+            status_code=status_code,
+            json=lambda: body,
+            headers=dict({'ETag': etag}, **({'Link': ', '.join(links)} if links else {})),
+            __enter__=lambda *args, **kwargs: resp,
+            __exit__=lambda *args, **kwargs: None
+        )
+        return resp
+
+
+@pytest.fixture
+def fake_github():
+    return FakeGitHub(total=100, per_page=10)
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_iter_project_pages(fake_github, max_workers):
+    request = pretend.stub(http=fake_github)
+
+    pages = list(iter_project_pages(request, 'owner', max_workers=max_workers))
+
+    assert len(pages) == 10
+    assert list(itertools.chain.from_iterable(pages)) == fake_github.repos
+    assert sorted(fake_github.pages) == list(range(1, 11))
+
+
+def test_iter_project_pages_is_lazy(fake_github):
+    request = pretend.stub(http=fake_github)
+
+    pages = iter_project_pages(request, 'owner', max_workers=1)
+
+    assert next(pages) == fake_github.repos[:10]
+    assert fake_github.pages == [1]
+
+
+@pytest.mark.parametrize('max_workers', [1, 4, 9])
+def test_iter_project_pages_concurrent(fake_github, max_workers):
+    fake_github.wait_for = max_workers
+    request = pretend.stub(http=fake_github)
+
+    pages = list(iter_project_pages(request, 'owner', max_workers=max_workers))
+
+    assert list(itertools.chain.from_iterable(pages)) == fake_github.repos
+
+    # One request for the first page and then the rest with
+    # max_workers of them in flight, but never any more.
+    assert fake_github.max_in_flight == max_workers
+
+
+class FakeConditionalRequestCache(object):
+    def __init__(self):
+        self.data = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, etag, last_modified):
+        self.data[key] = {'etag': etag, 'last_modified': last_modified}
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+
+def _sync_pages(request, cache, max_workers):
+    pages = []
+    for page in iter_project_pages(request, 'owner', max_workers=max_workers,
+                                   cache=cache, cache_key='1/owner'):
+        cache.set(page.cache_key, page.etag, page.last_modified)
+        pages.append(page)
+    return pages
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_iter_project_pages_conditional(fake_github, max_workers):
+    cache = FakeConditionalRequestCache()
+    request = pretend.stub(http=fake_github)
+
+    pages = _sync_pages(request, cache, max_workers)
+
+    assert list(itertools.chain.from_iterable(pages)) == fake_github.repos
+    assert sorted(cache.data) == sorted(
+        ['1/owner/1'] + [f'1/owner/{page}/10' for page in range(2, 11)]
+    )
+    assert (cache.hits, cache.misses) == (0, 10)
+
+    # Only the third page has changed since the last sync.
+    fake_github.changed = {3}
+    fake_github.pages = []
+
+    pages = _sync_pages(request, cache, max_workers)
+
+    assert pages == [fake_github.repos[20:30]]
+    assert sorted(fake_github.pages) == list(range(1, 11))
+    assert (cache.hits, cache.misses) == (9, 11)
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_iter_project_pages_conditional_not_stored(fake_github, max_workers):
+    cache = FakeConditionalRequestCache()
+    request = pretend.stub(http=fake_github)
+
+    list(iter_project_pages(request, 'owner', max_workers=max_workers,
+                            cache=cache, cache_key='1/owner'))
+    pages = list(iter_project_pages(request, 'owner', max_workers=max_workers,
+                                    cache=cache, cache_key='1/owner'))
+
+    # Pages are only skipped once the consumer has stored them.
+    assert list(itertools.chain.from_iterable(pages)) == fake_github.repos
+    assert cache.data == {}
+    assert (cache.hits, cache.misses) == (0, 20)
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_iter_project_pages_conditional_pages_added(fake_github, max_workers):
+    cache = FakeConditionalRequestCache()
+    request = pretend.stub(http=fake_github)
+
+    _sync_pages(request, cache, max_workers)
+
+    # The first page is unchanged but its Link header now
+    # points at a page that didn't exist during the last sync.
+    fake_github.repos.extend({'id': i} for i in range(100, 105))
+    fake_github.pages = []
+
+    pages = _sync_pages(request, cache, max_workers)
+
+    assert list(itertools.chain.from_iterable(pages)) == fake_github.repos[10:]
+    assert sorted(fake_github.pages) == list(range(1, 12))
+    assert (cache.hits, cache.misses) == (1, 20)
+
+
 def test_new_project_with_owner(db_session):
     request = pretend.stub(
-        db=db_session
+        db=db_session,
+        tm=transaction.TransactionManager()
     )
 
     user = UserFactory.create()
@@ -147,12 +345,13 @@ def test_new_project_with_owner(db_session):
 )
 def test_new_project_non_owner(db_session, project_role_type):
     request = pretend.stub(
-        db=db_session
+        db=db_session,
+        tm=transaction.TransactionManager()
     )
 
     user = UserFactory.create()
 
-    update_all_projects(
+    skipped = update_all_projects(
         request,
         user,
         project_role_type,
@@ -161,11 +360,13 @@ def test_new_project_non_owner(db_session, project_role_type):
 
     projects = db_session.query(Project).all()
     assert not projects
+    assert skipped == 1
 
 
 def test_project_role_updated(db_session):
     request = pretend.stub(
-        db=db_session
+        db=db_session,
+        tm=transaction.TransactionManager()
     )
 
     project_role = ProjectRoleFactory.create(role_type=ProjectRoleType.READ_ONLY)
@@ -195,7 +396,8 @@ def test_project_role_updated(db_session):
 )
 def test_update_all_projects_no_updates_required(db_session, project_role_type):
     request = pretend.stub(
-        db=db_session
+        db=db_session,
+        tm=transaction.TransactionManager()
     )
 
     role = ProjectRoleFactory.create(role_type=project_role_type)
@@ -217,45 +419,165 @@ def test_update_all_projects_no_updates_required(db_session, project_role_type):
     assert role.user == user
 
 
-def test_synchronize_user(monkeypatch):
+def test_update_all_projects_duplicate_repos(db_session):
     request = pretend.stub(
-        http=pretend.stub(
-            headers={}
-        )
+        db=db_session,
+        tm=transaction.TransactionManager()
+    )
+
+    user = UserFactory.create()
+    repo = {'id': 1234, 'owner': {'login': user.username}, 'name': 'foobar', 'private': True}
+
+    update_all_projects(request, user, ProjectRoleType.OWNER, [repo, repo])
+
+    project = db_session.query(Project).filter(Project.github_id == 1234).one()
+    assert not project.public
+    assert len(project.roles) == 1
+
+
+@pytest.mark.parametrize(
+    ['project_role_type', 'max_statements'],
+    [(ProjectRoleType.OWNER, 3),
+     (ProjectRoleType.COLLABORATOR, 4),
+     (ProjectRoleType.READ_ONLY, 4)]
+)
+def test_update_all_projects_statement_count(db_session, query_budget,
+                                             project_role_type, max_statements):
+    """Assert that the number of statements issued while updating
+    projects doesn't depend on the number of repositories.
+    """
+    request = pretend.stub(
+        db=db_session,
+        tm=transaction.TransactionManager()
+    )
+
+    user = UserFactory.create()
+    projects = [ProjectFactory.create() for _ in range(10)]
+    repos = [
+        {'id': project.github_id, 'owner': {'login': project.owner},
+         'name': project.name, 'private': False}
+        for project in projects
+    ] + [
+        {'id': 1000000 + i, 'owner': {'login': user.username},
+         'name': f'new-{i}', 'private': False}
+        for i in range(10)
+    ]
+
+    with query_budget(max_statements):
+        update_all_projects(request, user, project_role_type, repos)
+
+    for project in projects:
+        assert project.acl_version == 1
+        assert [role.user for role in project.roles] == [user]
+        assert project.roles[0].role_type == project_role_type
+
+
+def test_synchronize_user(monkeypatch):
+    cache = pretend.stub(
+        set=pretend.call_recorder(lambda key, etag, last_modified: None)
     )
     user = pretend.stub(
+        id=1,
         access_token='access_token'
     )
-    repos = pretend.stub()
+    request = pretend.stub(
+        db=pretend.stub(
+            query=lambda model: pretend.stub(get=lambda user_id: user)
+        ),
+        http=pretend.stub(
+            headers={}
+        ),
+        find_service=pretend.call_recorder(lambda iface, context: cache)
+    )
 
-    def _list_all_projects(req, affiliation):
+    def _iter_project_pages(req, affiliation, max_workers, cache, cache_key):
         assert req is request
         assert req.http.headers == {'Authorization': 'token access_token'}
-        return repos
+        assert max_workers == tasks.MAX_CONCURRENT_PAGES
+        assert cache_key == f'1/{affiliation}'
+        yield tasks.ProjectPage([], cache_key=f'{cache_key}/1', etag='"1"')
+        yield tasks.ProjectPage([], cache_key=f'{cache_key}/2/2', etag='"2"')
 
-    def _update_all_projects(req, usr, reps, project_role_type):
+    def _update_all_projects(req, usr, project_role_type, reps):
         assert req is request
         assert req.http.headers == {'Authorization': 'token access_token'}
         assert usr is user
-        assert reps == repos
         assert isinstance(project_role_type, ProjectRoleType)
 
-    list_all_projects = pretend.call_recorder(_list_all_projects)
+        # The second page of collaborator repositories
+        # contains a repository without a Project.
+        if reps.cache_key == '1/collaborator/2/2':
+            return 1
+        return 0
+
+    iter_project_pages = pretend.call_recorder(_iter_project_pages)
     update_all_projects = pretend.call_recorder(_update_all_projects)
 
-    monkeypatch.setattr(tasks, 'list_all_projects', list_all_projects)
+    monkeypatch.setattr(tasks, 'iter_project_pages', iter_project_pages)
     monkeypatch.setattr(tasks, 'update_all_projects', update_all_projects)
 
-    synchronize_user(request, user)
+    synchronize_user(request, 1)
 
-    assert list_all_projects.calls == [
-        pretend.call(request, 'owner'),
-        pretend.call(request, 'collaborator'),
-        pretend.call(request, 'organization_member')
+    assert request.find_service.calls == [
+        pretend.call(IConditionalRequestCache, context=None)
+    ]
+    assert iter_project_pages.calls == [
+        pretend.call(request, affiliation, max_workers=tasks.MAX_CONCURRENT_PAGES,
+                     cache=cache, cache_key=f'1/{affiliation}')
+        for affiliation in ['owner', 'collaborator', 'organization_member']
+    ]
+    assert [
+        (call.args[2], call.args[3].cache_key) for call in update_all_projects.calls
+    ] == [
+        (ProjectRoleType.OWNER, '1/owner/1'),
+        (ProjectRoleType.OWNER, '1/owner/2/2'),
+        (ProjectRoleType.COLLABORATOR, '1/collaborator/1'),
+        (ProjectRoleType.COLLABORATOR, '1/collaborator/2/2'),
+        (ProjectRoleType.READ_ONLY, '1/organization_member/1'),
+        (ProjectRoleType.READ_ONLY, '1/organization_member/2/2')
     ]
-    assert update_all_projects.calls == [
-        pretend.call(request, user, repos, ProjectRoleType.OWNER),
-        pretend.call(request, user, repos, ProjectRoleType.COLLABORATOR),
-        pretend.call(request, user, repos, ProjectRoleType.READ_ONLY)
+    assert cache.set.calls == [
+        pretend.call('1/owner/1', '"1"', None),
+        pretend.call('1/owner/2/2', '"2"', None),
+        pretend.call('1/collaborator/1', '"1"', None),
+        pretend.call('1/organization_member/1', '"1"', None),
+        pretend.call('1/organization_member/2/2', '"2"', None)
     ]
     assert request.http.headers == {}
+
+
+def test_synchronize_user_not_found():
+    request = pretend.stub(
+        db=pretend.stub(
+            query=lambda model: pretend.stub(get=lambda user_id: None)
+        ),
+        find_service=pretend.call_recorder(lambda iface, context: None)
+    )
+
+    synchronize_user(request, 1)
+
+    assert request.find_service.calls == []
+
+
+def test_synchronize_all_users():
+    cache = pretend.stub(stats=lambda: {'hits': 3, 'misses': 1})
+    delay = pretend.call_recorder(lambda user_id: None)
+    request = pretend.stub(
+        db=pretend.stub(
+            query=lambda column: pretend.stub(yield_per=lambda count: iter([(1,), (2,)]))
+        ),
+        task=pretend.call_recorder(lambda func: pretend.stub(delay=delay)),
+        find_service=lambda iface, context: cache,
+        log=pretend.stub(info=pretend.call_recorder(lambda *args, **kwargs: None))
+    )
+
+    synchronize_all_users(request)
+
+    assert request.task.calls == [pretend.call(synchronize_user)] * 2
+    assert delay.calls == [pretend.call(1), pretend.call(2)]
+    assert request.log.info.calls == [
+        pretend.call('Synchronizing all users',
+                     **{'github.users': 2,
+                        'github.cache.hits': 3,
+                        'github.cache.misses': 1})
+    ]
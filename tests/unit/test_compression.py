@@ -12,11 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import gzip
+import brotli
 import pytest
 import pretend
 from pyramid.response import Response
 from webob.acceptparse import Accept, NoAccept
 from webob.response import gzip_app_iter
+from armonaut import compression
+from armonaut.cache.lru import LRUCache
 from armonaut.compression import (
     _compressor as compressor,
     compression_tween_factory
@@ -25,14 +30,22 @@ from armonaut.compression import (
 
 @pytest.mark.parametrize('vary', [['Cookie'], ['Authorization'], ['Cookie', 'Authorization']])
 def test_compression_stops_on_vary(vary):
-    request = pretend.stub()
+    request = pretend.stub(response_vary=set())
     response = pretend.stub(vary=vary)
 
     compressor(request, response)
 
 
+@pytest.mark.parametrize('vary', [{'Cookie'}, {'Authorization'}])
+def test_compression_stops_on_pending_vary(vary):
+    request = pretend.stub(response_vary=vary)
+    response = pretend.stub(vary=None)
+
+    compressor(request, response)
+
+
 def test_compression_stops_if_content_encoded():
-    request = pretend.stub()
+    request = pretend.stub(response_vary=set())
     response = pretend.stub(
         headers={'Content-Encoding': 'anything'},
         vary=None
@@ -44,25 +57,25 @@ def test_compression_stops_if_content_encoded():
 @pytest.mark.parametrize(
     ['vary', 'expected'],
     [
-        (None, {'Accept-Encoding'}),
-        (['Another-Header'], {'Accept-Encoding', 'Another-Header'})
+        (set(), {'Accept-Encoding'}),
+        ({'Another-Header'}, {'Accept-Encoding', 'Another-Header'})
     ]
 )
 def test_sets_vary_accept_encoding(vary, expected):
-    request = pretend.stub(accept_encoding=NoAccept())
+    request = pretend.stub(accept_encoding=NoAccept(), response_vary=vary)
     response = Response(body=b'foo')
-    response.vary = vary
 
     compressor(request, response)
 
-    assert set(response.vary) == expected
+    assert request.response_vary == expected
+    assert response.vary is None
 
 
 def test_compresses_non_streaming():
     body = b'x' * 100
     compressed = b''.join(list(gzip_app_iter([body])))
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
     response = Response(body=body)
     response.md5_etag()
 
@@ -80,7 +93,7 @@ def test_compresses_streaming():
     body = b'x' * 100
     compressed = b''.join(list(gzip_app_iter([body])))
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
     response = Response(app_iter=iter([body]))
 
     compressor(request, response)
@@ -94,7 +107,7 @@ def test_compresses_streaming_with_etag():
     body = b'x' * 100
     compressed = b''.join(list(gzip_app_iter([body])))
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
     response = Response(app_iter=iter([body]))
     response.etag = 'foo'
 
@@ -110,7 +123,7 @@ def test_buffers_small_streaming():
     body = b'x' * 100
     compressed = b''.join(list(gzip_app_iter([body])))
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
     response = Response(app_iter=iter([body]),
                         content_length=len(body))
 
@@ -124,7 +137,7 @@ def test_buffers_small_streaming():
 def test_does_not_compress_small_bodies():
     body = b'foo'
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
     response = Response(body=body)
 
     compressor(request, response)
@@ -135,7 +148,13 @@ def test_does_not_compress_small_bodies():
 
 
 def test_compression_tween_factory():
-    registry = pretend.stub()
+    registry = pretend.stub(settings={
+        'compression.levels': {
+            'text/css': {'gzip': 1},
+            'application/json': {'br': 4}
+        },
+        'compression.cache_maxbytes': 1024
+    })
     request = pretend.stub(add_response_callback=pretend.call_recorder(lambda *args, **kwargs: None))
     response = pretend.stub()
 
@@ -146,4 +165,181 @@ def test_compression_tween_factory():
     tween = compression_tween_factory(handler, registry)
 
     assert tween(request) is response
-    assert request.add_response_callback.calls == [pretend.call(compressor)]
+    assert len(request.add_response_callback.calls) == 1
+    callback, = request.add_response_callback.calls[0].args
+    assert callback.func is compressor
+    assert callback.keywords['levels'] == {
+        'application/json': {'br': 4, 'zstd': 3, 'gzip': 6},
+        'text/css': {'gzip': 1}
+    }
+    assert callback.keywords['cache'].maxweight == 1024
+
+
+def test_does_not_encode_identity():
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('identity'))
+    response = Response(app_iter=iter([b'x' * 100]))
+    response.etag = 'foo'
+
+    compressor(request, response)
+
+    assert response.content_encoding is None
+    assert response.etag == 'foo'
+
+
+@pytest.mark.parametrize(
+    ['content_type', 'levels', 'expected'],
+    [('text/html', None, [6, 9]),
+     ('application/json', None, [6]),
+     ('application/json', {'application/json': {'gzip': 1}}, [1])]
+)
+def test_compression_level_per_content_type(monkeypatch, content_type, levels, expected):
+    encoder = pretend.call_recorder(compression._gzip_app_iter)
+    monkeypatch.setitem(compression._ENCODERS, 'gzip', encoder)
+    cache = LRUCache()
+
+    for _ in range(3):
+        request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
+        response = Response(body=b'x' * 100, content_type=content_type)
+        compressor(request, response, cache=cache, levels=levels)
+
+        assert gzip.decompress(response.body) == b'x' * 100
+
+    assert encoder.calls == [pretend.call([b'x' * 100], level) for level in expected]
+
+
+def test_unique_bodies_use_streaming_levels(monkeypatch):
+    """Bodies which are never seen again aren't worth the
+    time that compressing them with the highest levels takes.
+    """
+    encoder = pretend.call_recorder(compression._brotli_app_iter)
+    monkeypatch.setitem(compression._ENCODERS, 'br', encoder)
+    cache = LRUCache()
+
+    for i, cache in enumerate([None, cache, cache]):
+        request = pretend.stub(response_vary=set(), accept_encoding=Accept('br'))
+        response = Response(body=b'<html>%d</html>' % i + b'x' * 100)
+        compressor(request, response, cache=cache)
+
+    assert [call.args[1] for call in encoder.calls] == [
+        compression.STREAMING_LEVELS['br']
+    ] * 3
+
+
+def test_cache_reuses_compressed_body(monkeypatch):
+    """Rendering the same body repeatedly compresses it once
+    quickly and then once more with the highest level.
+    """
+    encoder = pretend.call_recorder(compression._gzip_app_iter)
+    monkeypatch.setitem(compression._ENCODERS, 'gzip', encoder)
+    cache = LRUCache()
+    compress = functools.partial(compressor, cache=cache)
+
+    responses = []
+    for _ in range(4):
+        request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
+        response = Response(body=b'<html>' + b'x' * 100 + b'</html>')
+        compress(request, response)
+        responses.append(response)
+
+    assert [call.args[1] for call in encoder.calls] == [6, 9]
+    assert cache.stats()['hits'] == 3
+    assert len({response.body for response in responses[1:]}) == 1
+    assert len({response.etag for response in responses[1:]}) == 1
+    assert responses[0].content_encoding == 'gzip'
+    assert gzip.decompress(responses[0].body) == gzip.decompress(responses[1].body)
+
+
+def test_cache_keyed_by_body(monkeypatch):
+    cache = LRUCache()
+
+    for body in [b'x' * 100, b'y' * 100]:
+        request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
+        response = Response(body=body)
+        compressor(request, response, cache=cache)
+
+        assert gzip.decompress(response.body) == body
+
+    assert len(cache) == 2
+
+
+def test_cache_remembers_incompressible_body(monkeypatch):
+    encoder = pretend.call_recorder(compression._gzip_app_iter)
+    monkeypatch.setitem(compression._ENCODERS, 'gzip', encoder)
+    cache = LRUCache()
+
+    for _ in range(2):
+        request = pretend.stub(response_vary=set(), accept_encoding=Accept('gzip'))
+        response = Response(body=b'foo')
+        compressor(request, response, cache=cache)
+
+        assert response.content_encoding is None
+        assert response.body == b'foo'
+
+    assert len(encoder.calls) == 1
+
+
+@pytest.mark.parametrize(
+    ['accept_encoding', 'expected'],
+    [('gzip, deflate, br', 'br'),
+     ('gzip;q=1.0, br;q=0.5', 'gzip'),
+     ('deflate', None)]
+)
+def test_negotiates_encoding(accept_encoding, expected):
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept(accept_encoding))
+    response = Response(body=b'x' * 100)
+
+    compressor(request, response)
+
+    assert response.content_encoding == expected
+
+
+def test_compresses_brotli():
+    body = b'{"key": "value"}' * 100
+
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('br'))
+    response = Response(body=body, content_type='application/json')
+
+    compressor(request, response)
+
+    assert response.content_encoding == 'br'
+    assert response.content_length == len(response.body)
+    assert brotli.decompress(response.body) == body
+
+
+def test_compresses_brotli_streaming():
+    body = [b'x' * 100, b'y' * 100]
+
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('br'))
+    response = Response(app_iter=iter(body))
+    response.etag = 'foo'
+
+    compressor(request, response)
+
+    assert response.content_encoding == 'br'
+    assert response.content_length is None
+    assert response.etag != 'foo'
+    assert brotli.decompress(response.body) == b''.join(body)
+
+
+def test_compresses_zstd():
+    zstandard = pytest.importorskip('zstandard')
+    body = b'x' * 100
+
+    request = pretend.stub(response_vary=set(), accept_encoding=Accept('zstd'))
+    response = Response(body=body)
+
+    compressor(request, response)
+
+    assert response.content_encoding == 'zstd'
+    assert zstandard.ZstdDecompressor().decompress(response.body) == body
+
+
+@pytest.mark.parametrize(
+    ['content_type', 'size', 'expected'],
+    [('text/html', 100, 11),
+     ('application/json', 100, 5),
+     ('text/html', compression.STREAMING_SIZE + 1, 5),
+     ('text/html', None, 5)]
+)
+def test_level_policy(content_type, size, expected):
+    assert compression._level('br', content_type, size, compression.LEVELS) == expected
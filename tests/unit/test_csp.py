@@ -0,0 +1,89 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+from armonaut.cache.lru import LRUCache
+from armonaut.csp import (
+    ContentSecurityPolicy,
+    SELF,
+    NONE,
+    csp_factory,
+    policy_header
+)
+
+SETTINGS = {
+    'csp': {
+        'default-src': [NONE],
+        'script-src': [SELF]
+    }
+}
+
+
+def test_csp_factory_copies_default_policy():
+    registry = pretend.stub(settings=SETTINGS)
+    request = pretend.stub(registry=registry, environ={})
+
+    policy = csp_factory(None, request)
+    assert request.environ == {'armonaut.csp': policy}
+    policy.merge({'script-src': ['example.com']})
+
+    assert policy['script-src'] == (SELF, 'example.com')
+    assert csp_factory(None, request)['script-src'] == (SELF,)
+    assert SETTINGS['csp']['script-src'] == [SELF]
+
+
+def test_policy_frozen_form_follows_changes():
+    policy = ContentSecurityPolicy({'script-src': [SELF]})
+    frozen = policy.freeze()
+
+    assert policy.copy().freeze() is frozen
+
+    policy.merge({'img-src': ['example.com']})
+
+    assert policy.freeze() == (
+        ('img-src', ('example.com',)),
+        ('script-src', (SELF,))
+    )
+
+
+def test_policy_header_serializes_each_variant_once(monkeypatch):
+    import armonaut.csp
+    serialize = pretend.call_recorder(armonaut.csp._serialize_policy)
+    monkeypatch.setattr(armonaut.csp, '_serialize_policy', serialize)
+    cache = LRUCache()
+    registry = pretend.stub(settings=SETTINGS)
+
+    for _ in range(3):
+        policy = csp_factory(None, pretend.stub(registry=registry, environ={}))
+        assert policy_header(policy, cache) == (
+            'default-src \'none\'; script-src \'self\'', False
+        )
+
+    for _ in range(3):
+        policy = csp_factory(None, pretend.stub(registry=registry, environ={}))
+        policy.merge({'img-src': ['example.com']})
+        assert policy_header(policy, cache) == (
+            'default-src \'none\'; img-src example.com; script-src \'self\'',
+            False
+        )
+
+    assert len(serialize.calls) == 2
+
+
+def test_policy_header_templated():
+    policy = ContentSecurityPolicy({'connect-src': ['{request.host}']})
+
+    assert policy_header(policy, LRUCache()) == (
+        'connect-src {request.host}', True
+    )
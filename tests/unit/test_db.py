@@ -0,0 +1,327 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import pretend
+import psycopg2.extensions
+import pytest
+import sqlalchemy.exc
+import transaction
+from armonaut import db
+from armonaut.db import (
+    ReplicaSet,
+    StatementStats,
+    _create_session,
+    _after_cursor_execute,
+    _before_cursor_execute,
+    _handle_error,
+    _log_statements,
+    _statement_count,
+    fingerprint
+)
+
+
+def test_fingerprint():
+    assert fingerprint(
+        "SELECT projects.id FROM projects\n"
+        "WHERE projects.owner = %(owner_1)s AND projects.name = 'name' "
+        "AND projects.id IN (%(id_1)s, %(id_2)s, %(id_3)s) LIMIT 10"
+    ) == (
+        "SELECT projects.id FROM projects "
+        "WHERE projects.owner = ? AND projects.name = ? "
+        "AND projects.id IN (?) LIMIT ?"
+    )
+
+
+def test_record_statements(monkeypatch):
+    times = iter([1.0, 1.5, 2.0, 2.25])
+    monkeypatch.setattr(db.time, 'perf_counter', lambda: next(times))
+    stats = StatementStats()
+    conn = pretend.stub(info={'armonaut.statements': stats})
+
+    for project_id in range(2):
+        statement = f'SELECT * FROM projects WHERE id = {project_id}'
+        _before_cursor_execute(conn, None, statement, {}, None, False)
+        _after_cursor_execute(conn, None, statement, {}, None, False)
+
+    assert stats.count == 2
+    assert stats.duration == 0.75
+    assert stats.fingerprints == {'SELECT * FROM projects WHERE id = ?': 2}
+
+
+def test_record_statements_not_instrumented():
+    conn = pretend.stub(info={})
+
+    _before_cursor_execute(conn, None, 'SELECT 1', {}, None, False)
+    _after_cursor_execute(conn, None, 'SELECT 1', {}, None, False)
+
+    assert conn.info == {}
+
+
+def test_handle_error_discards_start():
+    stats = StatementStats()
+    conn = pretend.stub(info={'armonaut.statements': stats})
+
+    _before_cursor_execute(conn, None, 'SELECT 1', {}, None, False)
+    _handle_error(pretend.stub(connection=conn))
+
+    assert conn.info['armonaut.statement_start'] == []
+    assert stats.count == 0
+
+
+def test_repeated_statements():
+    stats = StatementStats()
+    for _ in range(3):
+        stats.record('SELECT 1', 0.0)
+    stats.record('SELECT 2', 0.0)
+
+    assert stats.repeated(2) == [('SELECT ?', 4)]
+    assert stats.repeated(4) == []
+
+
+def test_log_statements():
+    stats = StatementStats()
+    for _ in range(3):
+        stats.record('SELECT 1', 0.001)
+
+    bound = pretend.stub(
+        info=pretend.call_recorder(lambda event, **kw: None),
+        warning=pretend.call_recorder(lambda event, **kw: None)
+    )
+    request = pretend.stub(
+        log=pretend.stub(bind=pretend.call_recorder(lambda **kw: bound)),
+        registry=pretend.stub(settings={
+            'database.repeated_statement_threshold': 2
+        })
+    )
+
+    _log_statements(request, stats)
+
+    assert request.log is bound
+    assert bound.info.calls == [pretend.call('Database statements')]
+    assert bound.warning.calls == [
+        pretend.call('Repeated database statement', **{
+            'db.fingerprint': 'SELECT ?',
+            'db.repeats': 3
+        })
+    ]
+
+
+def test_statement_count_without_session():
+    request = pretend.stub()
+
+    assert _statement_count(request) == 0
+
+
+def test_statement_count():
+    stats = StatementStats()
+    stats.record('SELECT 1', 0.0)
+    connection = pretend.stub(info={'armonaut.statements': stats})
+    request = pretend.stub(db=pretend.stub(connection=lambda: connection))
+
+    assert _statement_count(request) == 1
+
+
+class FakeEngine(object):
+    def __init__(self, lag=0, down=False, checkedout=0, version=(10, 4)):
+        self.lag = lag
+        self.down = down
+        self.connections = []
+        self.dialect = pretend.stub(server_version_info=version)
+        self.pool = pretend.stub(checkedout=lambda: checkedout)
+
+    def connect(self):
+        if self.down:
+            raise sqlalchemy.exc.OperationalError('SELECT 1', {}, Exception())
+        connection = pretend.stub(
+            scalar=pretend.call_recorder(lambda query: self.lag),
+            close=pretend.call_recorder(lambda: None)
+        )
+        self.connections.append(connection)
+        return connection
+
+
+def test_replica_set_round_robin():
+    engines = [FakeEngine(), FakeEngine()]
+    replicas = ReplicaSet(engines)
+
+    connections = [replicas.connect() for _ in range(4)]
+
+    assert connections == [
+        engines[0].connections[0], engines[1].connections[0],
+        engines[0].connections[1], engines[1].connections[1]
+    ]
+
+
+def test_replica_set_least_connections():
+    engines = [FakeEngine(checkedout=5), FakeEngine(checkedout=1)]
+    replicas = ReplicaSet(engines, selection='least_connections')
+
+    assert replicas.connect() is engines[1].connections[0]
+
+
+def test_replica_set_unknown_selection():
+    with pytest.raises(ValueError):
+        ReplicaSet([], selection='random')
+
+
+def test_replica_set_checks_lag_once_per_interval(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(db.time, 'monotonic', lambda: now[0])
+    engine = FakeEngine(lag=None, version=(9, 6))
+    replicas = ReplicaSet([engine], check_interval=5.0)
+
+    replicas.connect()
+    replicas.connect()
+    now[0] += 5.0
+    replicas.connect()
+
+    queries = [
+        call.args[0] for connection in engine.connections
+        for call in connection.scalar.calls
+    ]
+    assert len(queries) == 2
+    assert 'pg_last_xlog_replay_location()' in queries[0]
+
+
+def test_replica_set_skips_lagging_replicas(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(db.time, 'monotonic', lambda: now[0])
+    lagging, healthy = FakeEngine(lag=30.0), FakeEngine(lag=0.5)
+    replicas = ReplicaSet([lagging, healthy], max_lag=5.0)
+
+    assert replicas.connect() is healthy.connections[0]
+    assert lagging.connections[0].close.calls == [pretend.call()]
+
+    # The lagging replica isn't connected to again until it's rechecked.
+    assert replicas.connect() is healthy.connections[1]
+    assert len(lagging.connections) == 1
+
+    lagging.lag = 0.0
+    now[0] += 5.0
+    connections = {replicas.connect() for _ in range(2)}
+
+    assert lagging.connections[1] in connections
+
+
+def test_replica_set_lag_checked_by_one_thread():
+    """A thread which found the replica usable before another one started
+    checking its lag for the first time uses the primary instead.
+    """
+    connecting, checking, checked = threading.Event(), threading.Event(), threading.Event()
+    engine = FakeEngine()
+    connect = engine.connect
+
+    def scalar(query):
+        checking.set()
+        assert checked.wait(5.0)
+        return 0.5
+
+    def connect_blocking():
+        connection = connect()
+        connection.scalar = pretend.call_recorder(scalar)
+        if len(engine.connections) == 1:
+            connecting.set()
+            assert checking.wait(5.0)
+        return connection
+    engine.connect = connect_blocking
+    replicas = ReplicaSet([engine])
+
+    waiting, results = [], []
+    threads = [
+        threading.Thread(target=lambda: waiting.append(replicas.connect())),
+        threading.Thread(target=lambda: results.append(replicas.connect()))
+    ]
+    threads[0].start()
+    assert connecting.wait(5.0)
+    threads[1].start()
+    threads[0].join(5.0)
+    checked.set()
+    threads[1].join(5.0)
+
+    assert waiting == [None]
+    assert engine.connections[0].close.calls == [pretend.call()]
+    assert results == [engine.connections[1]]
+    assert sum(len(c.scalar.calls) for c in engine.connections) == 1
+    assert replicas.connect() is engine.connections[2]
+
+
+def test_replica_set_falls_back_when_down():
+    engine = FakeEngine(down=True)
+    replicas = ReplicaSet([engine])
+
+    assert replicas.connect() is None
+    assert replicas.connect() is None
+    assert replicas.replicas[0].lag is None
+
+
+def _db_request(read_only, replica_connection=None):
+    def _connection():
+        return pretend.stub(
+            info={},
+            connection=pretend.stub(
+                get_transaction_status=lambda: (
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                ),
+                set_session=pretend.call_recorder(lambda **kw: None)
+            )
+        )
+
+    primary = _connection()
+    replicas = pretend.stub(connect=lambda: replica_connection)
+    request = pretend.stub(
+        read_only=read_only,
+        tm=transaction.TransactionManager(explicit=True),
+        registry={
+            'sqlalchemy.engine': pretend.stub(connect=lambda: primary),
+            'sqlalchemy.replicas': replicas
+        },
+        add_finished_callback=lambda callback: callback
+    )
+    return request, primary, _connection
+
+
+def test_create_session_uses_primary_for_writes():
+    request, primary, _ = _db_request(read_only=False)
+
+    session = _create_session(request)
+
+    assert session.bind is primary
+    assert primary.connection.set_session.calls == []
+
+
+def test_create_session_routes_read_only_to_replica():
+    replica = _db_request(False)[2]()
+    request, primary, _ = _db_request(True, replica)
+
+    session = _create_session(request)
+
+    assert session.bind is replica
+    assert replica.info['armonaut.needs_reset']
+    assert replica.connection.set_session.calls == [
+        pretend.call(isolation_level='REPEATABLE READ', readonly=True,
+                     deferrable=False)
+    ]
+
+
+def test_create_session_read_only_falls_back_to_primary():
+    request, primary, _ = _db_request(True)
+
+    session = _create_session(request)
+
+    assert session.bind is primary
+    assert primary.connection.set_session.calls == [
+        pretend.call(isolation_level='SERIALIZABLE', readonly=True,
+                     deferrable=True)
+    ]
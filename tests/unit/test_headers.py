@@ -0,0 +1,170 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+from pyramid.registry import Registry
+from pyramid.response import Response
+from armonaut.csp import SELF, csp_factory
+from armonaut.headers import add_route_headers, security_headers_tween_factory
+
+SECURITY_HEADERS = {
+    'X-Frame-Options': 'deny',
+    'X-XSS-Protection': '1; mode=block',
+    'X-Content-Type-Options': 'nosniff',
+    'X-Permitted-Cross-Domain-Policies': 'none'
+}
+
+
+def _registry(settings=None, route_headers=None):
+    registry = Registry()
+    registry.settings = settings or {}
+    if route_headers is not None:
+        registry['headers.routes'] = route_headers
+    return registry
+
+
+def _finalize(registry, response, policy=None, path='/', route_name=None,
+              vary=()):
+    callbacks = []
+    request = pretend.stub(
+        path=path,
+        host='example.com',
+        registry=registry,
+        matched_route=(
+            pretend.stub(name=route_name) if route_name is not None else None
+        ),
+        response_vary=set(vary),
+        environ={'armonaut.csp': policy} if policy is not None else {},
+        add_response_callback=callbacks.append
+    )
+    tween = security_headers_tween_factory(lambda request: response, registry)
+
+    assert tween(request) is response
+    assert len(callbacks) == 1
+    callbacks[0](request, response)
+    return response
+
+
+def _headers(response):
+    return {
+        name: value for name, value in response.headerlist
+        if name not in {'Content-Type', 'Content-Length'}
+    }
+
+
+def test_adds_security_headers():
+    response = _finalize(_registry(), Response())
+
+    assert _headers(response) == SECURITY_HEADERS
+
+
+def test_adds_default_policy_without_csp_service():
+    registry = _registry({'csp': {'script-src': [SELF]}})
+
+    response = _finalize(registry, Response())
+
+    assert response.headers['Content-Security-Policy'] == 'script-src \'self\''
+
+
+def test_overrides_existing_headers():
+    response = Response()
+    response.headers['X-Frame-Options'] = 'sameorigin'
+
+    _finalize(_registry(), response)
+
+    assert response.headers.getall('X-Frame-Options') == ['deny']
+
+
+def test_adds_content_security_policy():
+    registry = _registry({'csp': {'script-src': [SELF]}})
+    policy = csp_factory(None, pretend.stub(registry=registry, environ={}))
+
+    response = _finalize(registry, Response(), policy)
+
+    assert response.headers['Content-Security-Policy'] == 'script-src \'self\''
+
+    policy = csp_factory(None, pretend.stub(registry=registry, environ={}))
+    policy.merge({'script-src': ['example.com']})
+
+    response = _finalize(registry, Response(), policy)
+
+    assert response.headers['Content-Security-Policy'] == (
+        'script-src \'self\' example.com'
+    )
+
+
+def test_formats_templated_policy():
+    registry = _registry({'csp': {'connect-src': ['{request.host}']}})
+    policy = csp_factory(None, pretend.stub(registry=registry, environ={}))
+
+    response = _finalize(registry, Response(), policy)
+
+    assert response.headers['Content-Security-Policy'] == (
+        'connect-src example.com'
+    )
+
+
+def test_skips_policy_for_debug_toolbar():
+    registry = _registry({'csp': {'script-src': [SELF]}})
+    policy = csp_factory(None, pretend.stub(registry=registry, environ={}))
+
+    response = _finalize(
+        registry, Response(), policy, path='/_debug_toolbar/static/'
+    )
+
+    assert _headers(response) == SECURITY_HEADERS
+
+
+def test_route_headers():
+    registry = _registry(route_headers={
+        'embed': {'X-Frame-Options': None, 'X-Robots-Tag': 'noindex'}
+    })
+
+    response = _finalize(registry, Response(), route_name='embed')
+
+    expected = dict(SECURITY_HEADERS, **{'X-Robots-Tag': 'noindex'})
+    del expected['X-Frame-Options']
+    assert _headers(response) == expected
+
+    response = _finalize(registry, Response(), route_name='other')
+
+    assert _headers(response) == SECURITY_HEADERS
+
+
+def test_merges_vary_once():
+    response = Response()
+    response.vary = ('Origin',)
+
+    _finalize(_registry(), response, vary=['Cookie', 'Accept-Encoding'])
+
+    assert response.headers.getall('Vary') == [
+        'Accept-Encoding, Cookie, Origin'
+    ]
+
+
+def test_add_route_headers():
+    config = pretend.stub(
+        registry=_registry(),
+        action=pretend.call_recorder(lambda discriminator, callable: None)
+    )
+
+    add_route_headers(config, 'embed', {'X-Frame-Options': None})
+    add_route_headers(config, 'embed', {'X-Robots-Tag': 'noindex'})
+
+    for call in config.action.calls:
+        call.args[1]()
+
+    assert config.registry['headers.routes'] == {
+        'embed': {'X-Frame-Options': None, 'X-Robots-Tag': 'noindex'}
+    }
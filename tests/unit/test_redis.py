@@ -0,0 +1,37 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import redis
+from armonaut.redis import connection_pool
+
+
+def test_connection_pool_shared(monkeypatch):
+    pools = iter([pretend.stub(), pretend.stub()])
+    from_url = pretend.call_recorder(lambda url, **kwargs: next(pools))
+    monkeypatch.setattr(redis.BlockingConnectionPool, 'from_url', from_url)
+
+    class Registry(dict):
+        settings = {'redis.max_connections': 10, 'redis.pool_timeout': 5}
+
+    registry = Registry()
+
+    pool = connection_pool(registry, 'redis://localhost:6379/0')
+
+    assert connection_pool(registry, 'redis://localhost:6379/0') is pool
+    assert connection_pool(registry, 'redis://localhost:6379/1') is not pool
+    assert from_url.calls == [
+        pretend.call('redis://localhost:6379/0', max_connections=10, timeout=5),
+        pretend.call('redis://localhost:6379/1', max_connections=10, timeout=5)
+    ]
@@ -12,12 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import pytest
 import time
 import pretend
 import redis
 from armonaut.utils import crypto
-from armonaut.sessions import InvalidSession, Session, RedisSessionFactory
+from armonaut import sessions
+from armonaut.sessions import (
+    InvalidSession, Session, RedisSessionFactory, RedisHashSessionFactory,
+    LocalSessionCache, CookieSessionFactory
+)
 from armonaut.cache import http
 
 
@@ -141,6 +146,16 @@ def test_session_changed(func, args, changed, expected):
     assert session == expected
 
 
+def test_session_mutated_value_assigned_again():
+    session = Session({'foo': ['bar']})
+    values = session['foo']
+    values.append('bel')
+    session['foo'] = values
+
+    assert session.should_save()
+    assert session.dirty == {'foo'}
+
+
 def test_session_invalidated(monkeypatch):
     sids = iter(['1', '2'])
     monkeypatch.setattr(crypto, 'random_token', pretend.call_recorder(func=lambda: next(sids)))
@@ -344,3 +359,533 @@ def test_invalid_session_id(pyramid_request):
     assert isinstance(session, Session)
     assert session._sid is None
     assert session.new
+
+
+class FakeRedis(object):
+    """Records the commands sent to Redis along with
+    how many round trips were needed to send them.
+    """
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = []
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.command_stack = []
+
+    def delete(self, *keys):
+        self.command_stack.append(('DEL',) + keys)
+
+    def setex(self, key, seconds, value):
+        self.command_stack.append(('SETEX', key, seconds))
+
+    def expire(self, key, seconds):
+        self.command_stack.append(('EXPIRE', key, seconds))
+
+    def hset(self, key, mapping):
+        self.command_stack.append(('HSET', key) + tuple(sorted(mapping)))
+
+    def hdel(self, key, *fields):
+        self.command_stack.append(('HDEL', key) + tuple(sorted(fields)))
+
+    def publish(self, channel, message):
+        self.command_stack.append(('PUBLISH', channel, message))
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def execute(self):
+        self.redis.round_trips += 1
+        self.redis.commands.extend(self.command_stack)
+
+
+def _process_response(session, factory_cls=RedisSessionFactory, **kwargs):
+    session_factory = factory_cls(
+        'secret', 'redis://localhost:6379/0', **kwargs
+    )
+    session_factory.redis = FakeRedis()
+    request = pretend.stub(session=session, scheme='https')
+    response = pretend.stub(
+        set_cookie=pretend.call_recorder(lambda *args, **kwargs: None),
+        delete_cookie=pretend.call_recorder(lambda *args, **kwargs: None)
+    )
+    session_factory._process_response(request, response)
+    return session_factory.redis, response
+
+
+def test_process_response_unchanged_session():
+    redis, response = _process_response(Session({'foo': 'bar'}, 'sid', False))
+
+    assert redis.round_trips == 0
+    assert response.set_cookie.calls == []
+
+
+def test_process_response_login_single_round_trip(monkeypatch):
+    """Logging in invalidates the old session and saves a new one
+    which should only require a single round trip to Redis.
+    """
+    monkeypatch.setattr(crypto, 'random_token', lambda: 'new')
+    session = Session({'foo': 'bar'}, 'old1', False)
+    session.invalidate()
+    session.invalidated.add('old2')
+    session['user.id'] = 1
+
+    redis, response = _process_response(session)
+
+    assert redis.round_trips == 1
+    assert redis.commands[0][0] == 'DEL'
+    assert set(redis.commands[0][1:]) == {
+        'armonaut/session/data/old1', 'armonaut/session/data/old2'
+    }
+    assert redis.commands[1] == (
+        'SETEX', 'armonaut/session/data/new', RedisSessionFactory.max_age
+    )
+    assert len(response.set_cookie.calls) == 1
+
+
+def test_process_response_logout_single_round_trip():
+    session = Session({'user.id': 1}, 'old', False)
+    session.invalidate()
+
+    redis, response = _process_response(session)
+
+    assert redis.round_trips == 1
+    assert redis.commands == [('DEL', 'armonaut/session/data/old')]
+    assert response.delete_cookie.calls == [pretend.call('session_id')]
+
+
+def test_session_pop_missing_key_not_changed():
+    session = Session({'foo': 'bar'})
+    session.pop('bar', None)
+
+    assert not session.should_save()
+
+
+def test_session_flash_existing_queue_changed():
+    session = Session({'_flash_messages': ['foo']})
+    session.flash('bar')
+
+    assert session.should_save()
+    assert session.dirty == {'_flash_messages'}
+
+
+@pytest.mark.parametrize(
+    ('func', 'args', 'expected'),
+    [('__setitem__', ('foo', 'bel'), {'foo'}),
+     ('__delitem__', ('foo',), {'foo'}),
+     ('pop', ('foo',), {'foo'}),
+     ('setdefault', ('bar', 'foo'), {'bar'}),
+     ('update', ({'foo': 'bel'},), None),
+     ('clear', (), None)]
+)
+def test_session_dirty_keys(func, args, expected):
+    session = Session({'foo': 'bar'})
+    getattr(session, func)(*args)
+
+    assert session.dirty == expected
+
+
+def test_process_request_renewed_from_cookie(monkeypatch):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory._load = lambda session_id, version: {'foo': 'bar'}
+
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    request = pretend.stub(
+        cookies={
+            'session_id': session_factory.signer.sign(b'sid').decode('utf-8')
+        },
+        add_response_callback=lambda callback: None
+    )
+    session = session_factory(request)
+
+    assert session.sid == 'sid'
+    assert session.renewed == 1000
+    assert not session.new
+
+
+@pytest.mark.parametrize(
+    ('touch_interval', 'renewed', 'touched'),
+    [(None, 0, False),
+     (300, None, False),
+     (300, 1000 - 299, False),
+     (300, 1000 - 300, True)]
+)
+def test_process_response_touch(monkeypatch, touch_interval, renewed, touched):
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    session = Session({'foo': 'bar'}, 'sid', False, renewed=renewed)
+
+    redis, response = _process_response(
+        session, touch_interval=touch_interval
+    )
+
+    if touched:
+        assert redis.round_trips == 1
+        assert redis.commands == [
+            ('EXPIRE', 'armonaut/session/data/sid',
+             RedisSessionFactory.max_age)
+        ]
+        assert len(response.set_cookie.calls) == 1
+    else:
+        assert redis.round_trips == 0
+        assert response.set_cookie.calls == []
+
+
+def test_process_response_touch_new_session():
+    session = Session({'foo': 'bar'}, 'sid', True, renewed=0)
+
+    redis, response = _process_response(session, touch_interval=300)
+
+    assert redis.round_trips == 0
+
+
+def test_hash_session_writes_dirty_keys_only():
+    session = Session({'foo': 'bar', 'bar': 'baz', 'baz': 'foo'}, 'sid', False)
+    session['foo'] = 'bel'
+    del session['bar']
+
+    redis, response = _process_response(
+        session, factory_cls=RedisHashSessionFactory
+    )
+
+    assert redis.round_trips == 1
+    assert redis.commands == [
+        ('HSET', 'armonaut/session/hash/sid', 'foo'),
+        ('HDEL', 'armonaut/session/hash/sid', 'bar'),
+        ('EXPIRE', 'armonaut/session/hash/sid', RedisSessionFactory.max_age)
+    ]
+    assert len(response.set_cookie.calls) == 1
+
+
+def test_hash_session_rewrites_untracked_changes():
+    session = Session({'foo': 'bar', 'bar': 'baz'}, 'sid', False)
+    session.update({'baz': 'foo'})
+
+    redis, response = _process_response(
+        session, factory_cls=RedisHashSessionFactory
+    )
+
+    assert redis.commands == [
+        ('DEL', 'armonaut/session/hash/sid'),
+        ('HSET', 'armonaut/session/hash/sid', 'bar', 'baz', 'foo'),
+        ('EXPIRE', 'armonaut/session/hash/sid', RedisSessionFactory.max_age)
+    ]
+
+
+def test_hash_session_new_session(monkeypatch):
+    monkeypatch.setattr(crypto, 'random_token', lambda: 'new')
+    session = Session()
+    session['user.id'] = 1
+
+    redis, response = _process_response(
+        session, factory_cls=RedisHashSessionFactory
+    )
+
+    assert redis.commands == [
+        ('HSET', 'armonaut/session/hash/new', 'user.id'),
+        ('EXPIRE', 'armonaut/session/hash/new', RedisSessionFactory.max_age)
+    ]
+
+
+def test_hash_session_load():
+    session_factory = RedisHashSessionFactory(
+        'secret', 'redis://localhost:6379/0'
+    )
+    session_factory.redis = pretend.stub(
+        hgetall=pretend.call_recorder(lambda key: {
+            b'foo': RedisSessionFactory._pack('bar'),
+            b'bar': RedisSessionFactory._pack([1, 2])
+        })
+    )
+
+    assert session_factory._load('sid') == {'foo': 'bar', 'bar': [1, 2]}
+    assert session_factory.redis.hgetall.calls == [
+        pretend.call('armonaut/session/hash/sid')
+    ]
+
+
+@pytest.mark.parametrize('data', [{}, {b'foo': b'\xc1'}])
+def test_hash_session_load_missing_or_invalid(data):
+    session_factory = RedisHashSessionFactory(
+        'secret', 'redis://localhost:6379/0'
+    )
+    session_factory.redis = pretend.stub(hgetall=lambda key: data)
+
+    assert session_factory._load('sid') is None
+
+
+class FakeListener(object):
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+def _local_cache(monkeypatch, **kwargs):
+    listener = FakeListener()
+    pubsub = pretend.stub(
+        subscribe=pretend.call_recorder(lambda **handlers: None),
+        run_in_thread=pretend.call_recorder(
+            lambda sleep_time, daemon: listener
+        )
+    )
+    redis = pretend.stub(
+        pubsub=pretend.call_recorder(lambda **kwargs: pubsub)
+    )
+    monkeypatch.setattr(sessions.os, 'getpid', lambda: 1)
+    return LocalSessionCache(redis, **kwargs), pubsub, listener
+
+
+def test_local_cache_get_set(monkeypatch):
+    cache, pubsub, _ = _local_cache(monkeypatch)
+
+    assert cache.get('sid', 1) is None
+    cache.set('sid', 1, b'data', weight=4)
+    assert cache.get('sid', 1) == b'data'
+
+    assert cache.stats() == {
+        'hits': 1, 'misses': 1, 'size': 1, 'weight': 4, 'hit_rate': 0.5
+    }
+    assert pubsub.subscribe.calls == [
+        pretend.call(**{LocalSessionCache.channel: cache._on_message})
+    ]
+    assert pubsub.run_in_thread.calls == [
+        pretend.call(sleep_time=1.0, daemon=True)
+    ]
+
+
+def test_local_cache_stale_version(monkeypatch):
+    cache, _, _ = _local_cache(monkeypatch)
+    cache.set('sid', 1, b'data')
+
+    assert cache.get('sid', 2) is None
+    assert cache.get('sid', 1) is None
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['misses'] == 2
+
+
+def test_local_cache_expired(monkeypatch):
+    cache, _, _ = _local_cache(monkeypatch, ttl=60)
+    monkeypatch.setattr(time, 'monotonic', lambda: 1000)
+    cache.set('sid', 1, b'data')
+
+    monkeypatch.setattr(time, 'monotonic', lambda: 1060)
+    assert cache.get('sid', 1) is None
+
+
+def test_local_cache_invalidation_message(monkeypatch):
+    cache, _, _ = _local_cache(monkeypatch)
+    cache.get('sid', 1)
+    cache.set('sid', 1, b'data')
+
+    cache._on_message({'channel': LocalSessionCache.channel, 'data': b'sid'})
+
+    assert cache.get('sid', 1) is None
+
+
+def test_local_cache_resubscribes(monkeypatch):
+    cache, pubsub, listener = _local_cache(monkeypatch)
+    cache.get('sid', 1)
+    cache.set('sid', 1, b'data')
+
+    # A lost connection means invalidations may have been missed.
+    listener.alive = False
+    assert cache.get('sid', 1) is None
+    assert len(pubsub.run_in_thread.calls) == 2
+
+    # So does forking into a new worker process.
+    cache.set('sid', 1, b'data')
+    monkeypatch.setattr(sessions.os, 'getpid', lambda: 2)
+    assert cache.get('sid', 1) is None
+    assert len(pubsub.run_in_thread.calls) == 3
+
+
+def test_load_from_local_cache(monkeypatch):
+    cache, _, _ = _local_cache(monkeypatch)
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', local_cache=cache
+    )
+    session_factory.redis = pretend.stub(
+        get=pretend.call_recorder(
+            lambda key: RedisSessionFactory._pack({'foo': 'bar'})
+        )
+    )
+
+    assert session_factory._load('sid', 1) == {'foo': 'bar'}
+    assert session_factory._load('sid', 1) == {'foo': 'bar'}
+    assert len(session_factory.redis.get.calls) == 1
+
+    # A newer cookie means the session was written since.
+    assert session_factory._load('sid', 2) == {'foo': 'bar'}
+    assert len(session_factory.redis.get.calls) == 2
+
+
+def test_process_response_publishes_invalidation(monkeypatch):
+    monkeypatch.setattr(crypto, 'random_token', lambda: 'new')
+    cache, _, _ = _local_cache(monkeypatch)
+    session = Session({'foo': 'bar'}, 'old', False)
+    session.invalidate()
+    session['user.id'] = 1
+
+    redis, response = _process_response(session, local_cache=cache)
+
+    assert redis.round_trips == 1
+    assert set(redis.commands[2:]) == {
+        ('PUBLISH', LocalSessionCache.channel, 'old'),
+        ('PUBLISH', LocalSessionCache.channel, 'new')
+    }
+
+
+def _cookie_session_factory(factory_cls=RedisSessionFactory, **kwargs):
+    fallback = factory_cls(
+        'secret', 'redis://localhost:6379/0', **kwargs
+    )
+    fallback.redis = FakeRedis()
+    return CookieSessionFactory('secret', fallback, max_size=256)
+
+
+def _cookie_request(session_factory, cookies):
+    request = pretend.stub(
+        cookies=cookies,
+        scheme='https',
+        add_response_callback=pretend.call_recorder(lambda callback: None)
+    )
+    request.session = session_factory(request)
+    response = pretend.stub(
+        set_cookie=pretend.call_recorder(lambda *args, **kwargs: None),
+        delete_cookie=pretend.call_recorder(lambda *args, **kwargs: None)
+    )
+    return request, response
+
+
+def test_cookie_session_round_trip(monkeypatch):
+    session_factory = _cookie_session_factory()
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    request, response = _cookie_request(session_factory, {})
+    request.session['user.id'] = 1
+    request.session.get_csrf_token()
+
+    session_factory._process_response(request, response)
+
+    assert session_factory.fallback.redis.round_trips == 0
+    assert len(response.set_cookie.calls) == 1
+    name, value = response.set_cookie.calls[0].args
+    assert name == 'session'
+    assert response.set_cookie.calls[0].kwargs == {
+        'max_age': RedisSessionFactory.max_age,
+        'httponly': True,
+        'secure': True
+    }
+
+    request, response = _cookie_request(session_factory, {'session': value})
+
+    assert request.session == {
+        'user.id': 1, '_csrf_token': request.session.get_csrf_token()
+    }
+    assert request.session.renewed == 1000
+    assert not request.session.new
+    assert request.add_response_callback.calls == [
+        pretend.call(session_factory._process_response)
+    ]
+
+
+def test_cookie_session_tampered():
+    session_factory = _cookie_session_factory()
+    value = session_factory._dump({'user.id': 1})
+    request, response = _cookie_request(
+        session_factory, {'session': value.replace('.', 'x', 1)}
+    )
+
+    assert request.session == {}
+    assert request.session.new
+
+    session_factory._process_response(request, response)
+    assert response.delete_cookie.calls == [pretend.call('session')]
+
+
+def test_cookie_session_falls_back_to_redis(monkeypatch):
+    monkeypatch.setattr(crypto, 'random_token', lambda: 'sid')
+    session_factory = _cookie_session_factory()
+    value = session_factory._dump({'user.id': 1})
+    request, response = _cookie_request(session_factory, {'session': value})
+    # Random data so that the payload doesn't compress.
+    request.session['data'] = os.urandom(512).hex()
+
+    session_factory._process_response(request, response)
+
+    assert session_factory.fallback.redis.commands == [
+        ('SETEX', 'armonaut/session/data/sid', RedisSessionFactory.max_age)
+    ]
+    assert response.delete_cookie.calls == [pretend.call('session')]
+    assert response.set_cookie.calls[0].args[0] == 'session_id'
+
+
+def test_cookie_session_falls_back_to_redis_hash(monkeypatch):
+    monkeypatch.setattr(crypto, 'random_token', lambda: 'sid')
+    session_factory = _cookie_session_factory(factory_cls=RedisHashSessionFactory)
+    value = session_factory._dump({'user.id': 1, '_csrf_token': 'token'})
+    request, response = _cookie_request(session_factory, {'session': value})
+    request.session['data'] = os.urandom(512).hex()
+
+    session_factory._process_response(request, response)
+
+    # Every key is written, not only the one changed by the request.
+    assert session_factory.fallback.redis.commands == [
+        ('HSET', 'armonaut/session/hash/sid', '_csrf_token', 'data', 'user.id'),
+        ('EXPIRE', 'armonaut/session/hash/sid', RedisSessionFactory.max_age)
+    ]
+    assert response.delete_cookie.calls == [pretend.call('session')]
+    assert response.set_cookie.calls[0].args[0] == 'session_id'
+
+
+def test_cookie_session_moves_out_of_redis():
+    session_factory = _cookie_session_factory()
+    session_factory.fallback._load = lambda session_id, version: {
+        'data': 'x' * 1024
+    }
+    signed = session_factory.fallback.signer.sign(b'sid').decode('utf-8')
+    request, response = _cookie_request(
+        session_factory, {'session_id': signed}
+    )
+    del request.session['data']
+    request.session['user.id'] = 1
+
+    session_factory._process_response(request, response)
+
+    assert session_factory.fallback.redis.commands == [
+        ('DEL', 'armonaut/session/data/sid')
+    ]
+    assert response.delete_cookie.calls == [pretend.call('session_id')]
+    assert response.set_cookie.calls[0].args[0] == 'session'
+
+
+def test_cookie_session_logout():
+    session_factory = _cookie_session_factory()
+    value = session_factory._dump({'user.id': 1})
+    request, response = _cookie_request(session_factory, {'session': value})
+    request.session.invalidate()
+
+    session_factory._process_response(request, response)
+
+    assert session_factory.fallback.redis.round_trips == 0
+    assert response.delete_cookie.calls == [pretend.call('session')]
+    assert response.set_cookie.calls == []
+
+
+@pytest.mark.parametrize(('elapsed', 'touched'), [(299, False), (300, True)])
+def test_cookie_session_touch(monkeypatch, elapsed, touched):
+    session_factory = _cookie_session_factory(touch_interval=300)
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    value = session_factory._dump({'user.id': 1})
+
+    monkeypatch.setattr(time, 'time', lambda: 1000 + elapsed)
+    request, response = _cookie_request(session_factory, {'session': value})
+    session_factory._process_response(request, response)
+
+    assert session_factory.fallback.redis.round_trips == 0
+    assert len(response.set_cookie.calls) == (1 if touched else 0)
@@ -0,0 +1,349 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import brotli
+import pretend
+import pytest
+from wsgiref.util import FileWrapper
+from pyramid.request import Request
+from armonaut import static
+from armonaut.static import (
+    WhiteNoise, StaticIndex, SendfileResponse, whitenoise_tween_factory
+)
+
+
+CSS = b'body { color: red; }\n' * 50
+
+
+@pytest.fixture
+def static_root(tmpdir):
+    tmpdir.mkdir('css').join('app.css').write_binary(CSS)
+    tmpdir.join('logo.png').write_binary(b'\x89PNG' + bytes(range(256)))
+    return tmpdir
+
+
+@pytest.fixture
+def index(static_root):
+    index = StaticIndex(WhiteNoise(None, max_age=60))
+    index.add_files(str(static_root), prefix='static')
+    return index
+
+
+def _tween(index, autorefresh=False):
+    registry = pretend.stub(
+        whitenoise=pretend.stub(autorefresh=autorefresh),
+        static_index=index
+    )
+    handler = pretend.call_recorder(lambda request: 'handled')
+    return whitenoise_tween_factory(handler, registry), registry, handler
+
+
+def _get(tween, registry, path, **headers):
+    request = Request.blank(path, headers=headers)
+    request.registry = registry
+    response = tween(request)
+    return request, response
+
+
+def test_index_precomputes_variants(index):
+    asset = index.get('/static/css/app.css')
+
+    assert asset.encodings == ['br', 'gzip', 'identity']
+    assert brotli.decompress(asset.variants['br'].body) == CSS
+    assert gzip.decompress(asset.variants['gzip'].body) == CSS
+    assert asset.variants['identity'].etag == hashlib.md5(CSS).hexdigest()
+    assert ('Cache-Control', 'max-age=60, public') in asset.headers
+
+    # Images aren't worth compressing.
+    assert index.get('/static/logo.png').encodings == ['identity']
+    assert index.get('/static/missing.css') is None
+
+
+def test_index_uses_compressed_siblings(static_root):
+    static_root.join('css', 'app.css.gz').write_binary(gzip.compress(CSS))
+    index = StaticIndex(WhiteNoise(None))
+    index.add_files(str(static_root), prefix='/static/')
+
+    assert '/static/css/app.css.gz' not in index.assets
+    variant = index.get('/static/css/app.css').variants['gzip']
+    assert variant.path == str(static_root.join('css', 'app.css.gz'))
+
+
+def test_index_large_files_served_from_disk(monkeypatch, static_root):
+    monkeypatch.setattr(static, 'BODY_MAX', 16)
+    index = StaticIndex(WhiteNoise(None))
+    index.add_files(str(static_root), prefix='/static/')
+
+    variant = index.get('/static/logo.png').variants['identity']
+    assert variant.body is None
+    assert variant.size == 260
+
+    tween, registry, _ = _tween(index)
+    _, response = _get(tween, registry, '/static/logo.png')
+    assert response.body == b'\x89PNG' + bytes(range(256))
+
+
+@pytest.mark.parametrize(
+    ['accept_encoding', 'encoding', 'decompress'],
+    [('gzip, br', 'br', brotli.decompress),
+     ('gzip', 'gzip', gzip.decompress),
+     ('identity', None, lambda body: body)]
+)
+def test_tween_serves_from_index(index, accept_encoding, encoding, decompress):
+    tween, registry, handler = _tween(index)
+    _, response = _get(tween, registry, '/static/css/app.css',
+                       **{'Accept-Encoding': accept_encoding})
+
+    assert handler.calls == []
+    assert response.status_code == 200
+    assert response.content_encoding == encoding
+    assert response.content_type == 'text/css'
+    assert response.cache_control.max_age == 60
+    assert response.vary == ('Accept-Encoding',)
+    assert decompress(response.body) == CSS
+
+
+def test_tween_not_modified(index):
+    tween, registry, _ = _tween(index)
+    request, response = _get(tween, registry, '/static/css/app.css')
+
+    etag = response.headers['ETag']
+    request, response = _get(tween, registry, '/static/css/app.css',
+                             **{'If-None-Match': etag})
+
+    assert request.get_response(response).status_code == 304
+
+
+def test_tween_passes_through(index):
+    tween, registry, handler = _tween(index)
+    request, response = _get(tween, registry, '/not-static')
+
+    assert response == 'handled'
+    assert handler.calls == [pretend.call(request)]
+
+
+def test_tween_method_not_allowed(index):
+    tween, registry, _ = _tween(index)
+    request = Request.blank('/static/css/app.css', method='POST')
+    request.registry = registry
+
+    assert tween(request).status_code == 405
+
+
+@pytest.fixture
+def large_file(tmpdir):
+    path = tmpdir.join('app.js')
+    path.write_binary(bytes(range(256)) * 4)
+    return str(path)
+
+
+def _sendfile_request(path, file_wrapper=FileWrapper, **headers):
+    request = Request.blank('/static/app.js', headers=headers)
+    if file_wrapper is not None:
+        request.environ['wsgi.file_wrapper'] = file_wrapper
+    response = SendfileResponse(path, request=request, block_size=100)
+    app_iter = response(request.environ, lambda *args: None)
+    return response, app_iter
+
+
+def test_sendfile_uses_file_wrapper(large_file):
+    response, app_iter = _sendfile_request(large_file)
+
+    assert isinstance(app_iter, FileWrapper)
+    assert response.content_type == mimetypes.guess_type(large_file)[0]
+    assert response.content_length == 1024
+    assert response.last_modified is not None
+    assert b''.join(app_iter) == bytes(range(256)) * 4
+
+
+@pytest.mark.parametrize('file_wrapper', [FileWrapper, None])
+def test_sendfile_range(large_file, file_wrapper):
+    response, app_iter = _sendfile_request(
+        large_file, file_wrapper=file_wrapper, Range='bytes=300-499'
+    )
+
+    if file_wrapper is not None:
+        # Servers using os.sendfile() start at the file's offset.
+        assert isinstance(app_iter, FileWrapper)
+        assert app_iter.filelike.tell() == 300
+    assert b''.join(app_iter) == (bytes(range(256)) * 4)[300:500]
+
+
+def test_sendfile_unknown_file_wrapper(large_file):
+    file_wrapper = pretend.call_recorder(lambda f, block_size: iter([f.read()]))
+    response, app_iter = _sendfile_request(large_file, file_wrapper=file_wrapper)
+
+    assert len(file_wrapper.calls) == 1
+    assert b''.join(app_iter) == bytes(range(256)) * 4
+
+
+def test_index_large_files_sent_with_file_wrapper(monkeypatch, static_root):
+    monkeypatch.setattr(static, 'BODY_MAX', 16)
+    index = StaticIndex(WhiteNoise(None))
+    index.add_files(str(static_root), prefix='/static/')
+    tween, registry, _ = _tween(index)
+
+    request = Request.blank('/static/logo.png')
+    request.environ['wsgi.file_wrapper'] = FileWrapper
+    request.registry = registry
+    response = tween(request)
+
+    assert isinstance(response, SendfileResponse)
+    assert isinstance(response.app_iter, FileWrapper)
+    assert response.content_type == 'image/png'
+
+
+@pytest.fixture
+def manifest(tmpdir):
+    path = tmpdir.join('manifest.json')
+    path.write_text(json.dumps({'app.js': 'app.123.js'}), 'utf-8')
+    return path
+
+
+@pytest.mark.parametrize('autorefresh', [False, True])
+def test_manifest_loaded_once(monkeypatch, manifest, autorefresh):
+    wh = WhiteNoise(None, manifest=str(manifest), autorefresh=autorefresh)
+    load = pretend.call_recorder(json.load)
+    monkeypatch.setattr(static.json, 'load', load)
+    immutable = str(manifest.dirpath('app.123.js'))
+
+    for _ in range(3):
+        assert wh.is_immutable_file(immutable, '/static/app.123.js')
+        assert not wh.is_immutable_file(
+            str(manifest.dirpath('app.js')), '/static/app.js'
+        )
+
+    assert wh.manifest == {'app.123.js'}
+    assert len(load.calls) == 1
+
+
+@pytest.mark.parametrize(['autorefresh', 'reloaded'], [(False, False), (True, True)])
+def test_manifest_reloaded_on_change(manifest, autorefresh, reloaded):
+    wh = WhiteNoise(None, manifest=str(manifest), autorefresh=autorefresh)
+    assert wh.manifest == {'app.123.js'}
+
+    manifest.write_text(json.dumps({'app.js': 'app.456.js'}), 'utf-8')
+    manifest.setmtime(manifest.mtime() + 10)
+
+    immutable = str(manifest.dirpath('app.456.js'))
+    assert wh.is_immutable_file(immutable, '/static/app.456.js') == reloaded
+
+
+def test_index_refresh(static_root):
+    index = StaticIndex(WhiteNoise(None), compress=False)
+    index.add_files(str(static_root), prefix='/static/')
+    etag = index.get('/static/css/app.css').variants['identity'].etag
+    png = index.get('/static/logo.png')
+
+    css = static_root.join('css', 'app.css')
+    css.write_binary(b'body {}')
+    css.setmtime(css.mtime() + 10)
+    static_root.join('logo.png').remove()
+    static_root.join('new.css').write_binary(b'')
+
+    index.refresh()
+
+    assert index.get('/static/css/app.css').variants['identity'].etag != etag
+    assert index.get('/static/css/app.css').encodings == ['identity']
+    assert index.get('/static/logo.png') is None
+    assert index.get('/static/new.css') is not None
+    assert png is not None
+
+
+def test_index_unchanged_files_not_reindexed(monkeypatch, index):
+    monkeypatch.setattr(
+        index, '_index_file', pretend.call_recorder(lambda path, url: None)
+    )
+    index.refresh()
+
+    assert index._index_file.calls == []
+
+
+def test_tween_autorefresh_watches_index(monkeypatch, index):
+    threads = []
+    monkeypatch.setattr(
+        static.threading, 'Thread',
+        lambda **kwargs: threads.append(kwargs) or pretend.stub(
+            start=lambda: None, is_alive=lambda: True
+        )
+    )
+    tween, registry, _ = _tween(index, autorefresh=True)
+
+    for _ in range(2):
+        _, response = _get(tween, registry, '/static/css/app.css')
+        assert response.status_code == 200
+
+    assert len(threads) == 1
+    assert threads[0]['daemon']
+
+
+class FakeWatcher(object):
+    def __init__(self, target, name, daemon):
+        self.target = target
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+class StopWatching(BaseException):
+    pass
+
+
+def test_index_watch_restarts_dead_watcher(monkeypatch, index):
+    watchers = []
+    monkeypatch.setattr(
+        static.threading, 'Thread',
+        lambda **kwargs: watchers.append(FakeWatcher(**kwargs)) or watchers[-1]
+    )
+
+    index.watch()
+    index.watch()
+    assert len(watchers) == 1
+
+    watchers[0].alive = False
+    index.watch()
+    assert len(watchers) == 2
+
+
+def test_index_watcher_survives_errors(monkeypatch, index):
+    watchers = []
+    monkeypatch.setattr(
+        static.threading, 'Thread',
+        lambda **kwargs: watchers.append(FakeWatcher(**kwargs)) or watchers[-1]
+    )
+    sleeps = []
+
+    def sleep(interval):
+        if len(sleeps) == 3:
+            raise StopWatching()
+        sleeps.append(interval)
+
+    monkeypatch.setattr(static.time, 'sleep', sleep)
+    refresh = pretend.call_recorder(lambda: json.loads('{'))
+    monkeypatch.setattr(index, 'refresh', refresh)
+
+    index.watch(interval=0.5)
+    with pytest.raises(StopWatching):
+        watchers[0].target()
+
+    assert sleeps == [0.5, 0.5, 0.5]
+    assert len(refresh.calls) == 3
@@ -0,0 +1,93 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import redis
+from pyramid.events import ApplicationCreated
+from armonaut import webhooks
+from armonaut.cache.lru import LRUCache
+from armonaut.webhooks import includeme, _warm_secret_cache
+from armonaut.webhooks.interfaces import (
+    IWebhookSecretService, IWebhookDeliveryService
+)
+from armonaut.webhooks.services import (
+    CachedWebhookSecretService,
+    webhook_secret_service_factory,
+    webhook_delivery_service_factory
+)
+
+
+def test_includeme():
+    config = pretend.stub(
+        registry=pretend.stub(
+            settings={'webhooks.secret_cache_size': 10},
+            __setitem__=pretend.call_recorder(lambda key, value: None)
+        ),
+        register_service_factory=pretend.call_recorder(lambda *args: None),
+        add_subscriber=pretend.call_recorder(lambda *args: None)
+    )
+
+    includeme(config)
+
+    key, cache = config.registry.__setitem__.calls[0].args
+    assert key == 'webhooks.secret_cache'
+    assert isinstance(cache, LRUCache)
+    assert cache.maxsize == 10
+    assert config.register_service_factory.calls == [
+        pretend.call(webhook_secret_service_factory, IWebhookSecretService),
+        pretend.call(webhook_delivery_service_factory, IWebhookDeliveryService)
+    ]
+    assert config.add_subscriber.calls == [
+        pretend.call(_warm_secret_cache, ApplicationCreated)
+    ]
+
+
+def _event(settings):
+    registry = pretend.stub(
+        settings=dict({'webhooks.url': 'redis://localhost:0/'}, **settings),
+        __getitem__=lambda key: LRUCache()
+    )
+    return pretend.stub(app=pretend.stub(registry=registry))
+
+
+def test_warm_secret_cache(monkeypatch):
+    session = pretend.stub(close=pretend.call_recorder(lambda: None))
+    monkeypatch.setattr(webhooks, 'Session', lambda bind: session)
+    warm = pretend.call_recorder(lambda self: None)
+    monkeypatch.setattr(CachedWebhookSecretService, 'warm', warm)
+
+    _warm_secret_cache(_event({}))
+
+    assert len(warm.calls) == 1
+    assert session.close.calls == [pretend.call()]
+
+
+def test_warm_secret_cache_failure(monkeypatch):
+    session = pretend.stub(close=pretend.call_recorder(lambda: None))
+    monkeypatch.setattr(webhooks, 'Session', lambda bind: session)
+
+    def warm(self):
+        raise redis.ConnectionError()
+
+    monkeypatch.setattr(CachedWebhookSecretService, 'warm', warm)
+
+    _warm_secret_cache(_event({}))
+
+    assert session.close.calls == [pretend.call()]
+
+
+def test_warm_secret_cache_disabled(monkeypatch):
+    monkeypatch.setattr(webhooks, 'Session', pretend.raiser(AssertionError))
+
+    _warm_secret_cache(_event({'webhooks.warm_secret_cache': False}))
@@ -0,0 +1,344 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import redis
+from zope.interface.verify import verifyClass
+from armonaut.webhooks.interfaces import (
+    IWebhookSecretService, IWebhookDeliveryService
+)
+from armonaut.webhooks import services
+from armonaut.cache.lru import LRUCache
+from armonaut.webhooks.services import (
+    CachedWebhookSecretService, RedisWebhookDeliveryService, WebhookSecret,
+    webhook_secret_service_factory, webhook_delivery_service_factory,
+    _changed_project, _discard_webhook_secrets, _invalidate_webhook_secrets
+)
+
+
+class FakeRedis(object):
+    """In-memory stand-in for the Redis commands used by the services."""
+    def __init__(self):
+        self.keys = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        value = self.keys.get(key)
+        return value[0] if value is not None else None
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = (value, ex)
+        return True
+
+    def setex(self, key, ex, value):
+        self.keys[key] = (value, ex)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.keys.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return pretend.stub(setex=self.setex, execute=lambda: None)
+
+
+class FakeQuery(object):
+    def __init__(self, db, rows):
+        self.db = db
+        self.rows = rows
+
+    def filter(self, criterion):
+        self.db.filters.append(criterion)
+        return self
+
+    def limit(self, limit):
+        return self.rows
+
+    def first(self):
+        self.db.queries += 1
+        return self.rows[0] if self.rows else None
+
+
+class FakeDB(object):
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.queries = 0
+        self.filters = []
+
+    def query(self, *columns):
+        return FakeQuery(self, self.rows)
+
+
+def test_services_verify():
+    assert verifyClass(IWebhookSecretService, CachedWebhookSecretService)
+    assert verifyClass(IWebhookDeliveryService, RedisWebhookDeliveryService)
+
+
+def _secret_service(rows=(), local_max_age=60):
+    service = CachedWebhookSecretService(
+        'redis://localhost:0/', FakeDB(rows), LRUCache(),
+        local_max_age=local_max_age
+    )
+    service.redis = FakeRedis()
+    return service
+
+
+ROW = pretend.stub(id=1, webhook_id=10, github_id=100, webhook_secret='secret')
+
+
+def test_secret_lookup_hits_postgres_once():
+    service = _secret_service([ROW])
+
+    assert service.get('10') == WebhookSecret(1, 'secret')
+    assert service.get('10') == WebhookSecret(1, 'secret')
+    assert service.db.queries == 1
+    assert service.redis.gets == 1
+    assert service.redis.keys['armonaut/webhooks/secret/hook/10'][1] == (
+        CachedWebhookSecretService.max_age
+    )
+
+
+def test_secret_lookup_from_redis():
+    service = _secret_service([ROW])
+    service.get('10')
+    service.local_cache.clear()
+
+    assert service.get('10') == WebhookSecret(1, 'secret')
+    assert service.db.queries == 1
+    assert service.redis.gets == 2
+
+
+def test_secret_lookup_skips_local_cache():
+    service = _secret_service([ROW])
+    service.get('10')
+
+    assert service.get('10', cached=False) == WebhookSecret(1, 'secret')
+    assert service.redis.gets == 2
+    assert service.db.queries == 2
+    assert service.redis.keys['armonaut/webhooks/secret/hook/10/refresh'] == (
+        b'1', CachedWebhookSecretService.refresh_interval
+    )
+
+
+def test_secret_refreshed_once_per_interval():
+    service = _secret_service([ROW])
+    service.get('10')
+
+    for _ in range(5):
+        assert service.get('10', cached=False) == WebhookSecret(1, 'secret')
+    assert service.db.queries == 2
+
+    # Changing the project allows reading it again straight away.
+    service.invalidate({10}, set())
+    service.get('10', cached=False)
+    service.get('10', cached=False)
+    assert service.db.queries == 4
+
+
+def test_stale_secret_in_redis_is_replaced():
+    service = _secret_service([ROW])
+
+    # Stored by a lookup that read the secret before it was changed.
+    service.redis.setex(
+        'armonaut/webhooks/secret/hook/10', CachedWebhookSecretService.max_age,
+        service._pack(WebhookSecret(1, 'old'))
+    )
+    assert service.get('10') == WebhookSecret(1, 'old')
+
+    assert service.get('10', cached=False) == WebhookSecret(1, 'secret')
+    service.local_cache.clear()
+    assert service.get('10') == WebhookSecret(1, 'secret')
+    assert service.db.queries == 1
+
+
+def test_local_secrets_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(services.time, 'monotonic', lambda: now[0])
+    service = _secret_service([ROW], local_max_age=60)
+    service.get('10')
+
+    now[0] += 60
+    service.get('10')
+
+    assert service.redis.gets == 2
+
+
+def test_unknown_secret_is_remembered_briefly():
+    service = _secret_service([])
+
+    assert service.get('10') is None
+    assert service.get_for_repository('100', cached=False) is None
+    assert service.get('10', cached=False) is None
+    assert service.db.queries == 2
+    assert service.redis.keys['armonaut/webhooks/secret/hook/10'] == (
+        b'', CachedWebhookSecretService.missing_max_age
+    )
+
+
+def test_secret_without_webhook_secret():
+    service = _secret_service([pretend.stub(id=1, webhook_secret=None)])
+
+    assert service.get('10') is None
+
+
+def test_invalid_id():
+    service = _secret_service([ROW])
+
+    assert service.get('not-a-number') is None
+    assert service.get(None) is None
+    assert service.db.queries == 0
+
+
+def test_invalidate():
+    service = _secret_service([ROW])
+    service.get('10')
+    service.get_for_repository('100')
+
+    service.invalidate({10}, {100})
+
+    assert service.redis.keys == {}
+    assert len(service.local_cache) == 0
+
+    service.invalidate(set(), set())
+
+
+def test_warm():
+    service = _secret_service([ROW])
+
+    service.warm()
+
+    assert service.get('10') == WebhookSecret(1, 'secret')
+    assert service.get_for_repository('100') == WebhookSecret(1, 'secret')
+    assert service.db.queries == 0
+    assert service.redis.gets == 0
+    assert set(service.redis.keys) == {
+        'armonaut/webhooks/secret/hook/10',
+        'armonaut/webhooks/secret/repository/100'
+    }
+
+
+def test_secret_service_factory(monkeypatch):
+    pool = pretend.stub()
+    monkeypatch.setattr(services, 'connection_pool', lambda registry, url: pool)
+    cache = LRUCache()
+    request = pretend.stub(
+        db=pretend.stub(),
+        registry=pretend.stub(
+            settings={'webhooks.url': 'redis://localhost:0/'},
+            __getitem__=lambda key: cache
+        )
+    )
+
+    service = webhook_secret_service_factory(None, request)
+
+    assert service.db is request.db
+    assert service.local_cache is cache
+
+
+def test_changed_project_invalidated_after_commit(monkeypatch):
+    session = pretend.stub(info={})
+    monkeypatch.setattr(services, 'object_session', lambda target: session)
+    history = {
+        'webhook_id': pretend.stub(history=pretend.stub(sum=lambda: [11, 10])),
+        'github_id': pretend.stub(history=pretend.stub(sum=lambda: [100]))
+    }
+    monkeypatch.setattr(
+        services, 'inspect', lambda target: pretend.stub(attrs=history)
+    )
+
+    _changed_project(None, None, None, pretend.stub())
+
+    assert session.info == {'armonaut.webhook_secrets': ({10, 11}, {100})}
+
+    invalidated = []
+    monkeypatch.setattr(
+        CachedWebhookSecretService, 'invalidate',
+        lambda self, hook_ids, repository_ids: invalidated.append(
+            (hook_ids, repository_ids)
+        )
+    )
+    monkeypatch.setattr(services, 'connection_pool', lambda registry, url: None)
+    monkeypatch.setattr(redis.StrictRedis, 'from_url', lambda url: None)
+    config = pretend.stub(registry=pretend.stub(
+        settings={'webhooks.url': 'redis://localhost:0/'},
+        __getitem__=lambda key: LRUCache()
+    ))
+
+    _invalidate_webhook_secrets(config, session)
+    _invalidate_webhook_secrets(config, session)
+
+    assert invalidated == [({10, 11}, {100})]
+
+
+def test_rolled_back_changes_are_discarded():
+    session = pretend.stub(info={'armonaut.webhook_secrets': ({10}, set())})
+
+    _discard_webhook_secrets(None, session)
+
+    assert session.info == {}
+
+
+def _delivery_service():
+    service = RedisWebhookDeliveryService('redis://localhost:0/', max_age=60)
+    service.redis = FakeRedis()
+    return service
+
+
+def test_accept_delivery_once():
+    service = _delivery_service()
+
+    assert service.accept('abc')
+    assert not service.accept('abc')
+    assert service.redis.keys == {
+        'armonaut/webhooks/delivery/abc': (b'1', 60)
+    }
+
+
+def test_accepted_deliveries_forgotten_on_abort():
+    service = _delivery_service()
+    service.accept('abc')
+
+    service._after_commit_hook(False)
+
+    assert service.redis.keys == {}
+    assert service.accept('abc')
+
+
+def test_accepted_deliveries_kept_on_commit():
+    service = _delivery_service()
+    service.accept('abc')
+
+    service._after_commit_hook(True)
+
+    assert not service.accept('abc')
+
+
+def test_delivery_service_factory(monkeypatch):
+    pool = pretend.stub()
+    monkeypatch.setattr(services, 'connection_pool', lambda registry, url: pool)
+    strict_redis = pretend.call_recorder(lambda **kwargs: pretend.stub())
+    monkeypatch.setattr(redis, 'StrictRedis', strict_redis)
+    hooks = []
+    request = pretend.stub(
+        registry=pretend.stub(settings={'webhooks.url': 'redis://localhost:0/'}),
+        tm=pretend.stub(get=lambda: pretend.stub(addAfterCommitHook=hooks.append))
+    )
+
+    service = webhook_delivery_service_factory(None, request)
+
+    assert strict_redis.calls == [pretend.call(connection_pool=pool)]
+    assert service.max_age == RedisWebhookDeliveryService.max_age
+    assert hooks == [service._after_commit_hook]
@@ -0,0 +1,96 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+from armonaut.webhooks import tasks
+from armonaut.webhooks.tasks import process_github_webhook
+
+PAYLOAD = {
+    'event': 'push',
+    'delivery_id': 'abc',
+    'project_id': 1,
+    'ref': 'refs/heads/master',
+    'sha': 'a' * 40,
+    'before': 'b' * 40,
+    'message': 'x' * 300,
+    'author_name': 'Author',
+    'author_email': 'author@example.com'
+}
+
+
+def _request(project):
+    return pretend.stub(
+        db=pretend.stub(
+            query=lambda model: pretend.stub(get=lambda id: project),
+            add=pretend.call_recorder(lambda obj: None)
+        ),
+        log=pretend.stub(info=pretend.call_recorder(lambda *a, **kw: None)),
+        tm=pretend.stub(get=lambda: pretend.stub(
+            addAfterCommitHook=pretend.call_recorder(lambda hook: None)
+        ))
+    )
+
+
+def test_process_github_webhook_creates_build():
+    project = pretend.stub(id=1, active=True, auto_cancel=False)
+    request = _request(project)
+
+    process_github_webhook(request, PAYLOAD)
+
+    assert len(request.db.add.calls) == 1
+    build = request.db.add.calls[0].args[0]
+    assert build.project_id == 1
+    assert build.commit.hexsha == 'a' * 40
+    assert build.commit.ref == 'refs/heads/master'
+    assert build.commit.message == 'x' * 256
+
+
+def test_process_github_webhook_inactive_project():
+    request = _request(pretend.stub(id=1, active=False, auto_cancel=True))
+
+    process_github_webhook(request, PAYLOAD)
+
+    assert request.db.add.calls == []
+
+
+def test_process_github_webhook_unknown_project():
+    request = _request(None)
+
+    process_github_webhook(request, PAYLOAD)
+
+    assert request.db.add.calls == []
+
+
+def test_process_github_webhook_cancels_superseded(monkeypatch):
+    superseded = [pretend.stub(id=3)]
+    cancel_superseded = pretend.call_recorder(
+        lambda db, build, before: (superseded, ['task-1'])
+    )
+    monkeypatch.setattr(tasks, 'cancel_superseded', cancel_superseded)
+    revoke = pretend.call_recorder(lambda request, task_ids: None)
+    monkeypatch.setattr(tasks.tasks, 'revoke', revoke)
+    request = _request(pretend.stub(id=1, active=True, auto_cancel=True))
+
+    process_github_webhook(request, PAYLOAD)
+
+    build = request.db.add.calls[0].args[0]
+    assert cancel_superseded.calls == [pretend.call(request.db, build, 'b' * 40)]
+    assert revoke.calls == [pretend.call(request, ['task-1'])]
+    assert request.log.info.calls[0] == pretend.call(
+        'Cancelled superseded builds', **{
+            'project.id': 1,
+            'build.ids': [3],
+            'commit.ref': 'refs/heads/master'
+        }
+    )
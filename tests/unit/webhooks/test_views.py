@@ -0,0 +1,305 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+import pretend
+import pytest
+from webob.multidict import MultiDict
+from armonaut.webhooks import views
+from armonaut.webhooks.interfaces import (
+    IWebhookSecretService, IWebhookDeliveryService
+)
+from armonaut.webhooks.services import WebhookSecret
+from armonaut.webhooks.tasks import process_github_webhook
+from armonaut.webhooks.views import github_webhook
+
+SECRET = 'secret'
+
+PUSH = {
+    'ref': 'refs/heads/master',
+    'before': 'b' * 40,
+    'deleted': False,
+    'head_commit': {
+        'id': 'a' * 40,
+        'message': 'Fix the build',
+        'author': {'name': 'Author', 'email': 'author@example.com'}
+    },
+    'commits': [{'id': 'a' * 40}] * 20,
+    'repository': {'id': 1, 'full_name': 'owner/name'}
+}
+
+PULL_REQUEST = {
+    'action': 'synchronize',
+    'before': 'c' * 40,
+    'pull_request': {
+        'number': 7,
+        'title': 'Add a feature',
+        'head': {'sha': 'b' * 40},
+        'user': {'login': 'contributor'}
+    }
+}
+
+
+class FakeDeliveryService(object):
+    def __init__(self):
+        self.seen = set()
+
+    def accept(self, delivery_id):
+        if delivery_id in self.seen:
+            return False
+        self.seen.add(delivery_id)
+        return True
+
+
+def _signature(body, secret=SECRET, digestmod=hashlib.sha256):
+    return hmac.new(secret.encode('utf-8'), body, digestmod).hexdigest()
+
+
+def _request(event='push', data=PUSH, delivery_id=None, headers=None,
+             secrets=None, deliveries=None, delay=None):
+    body = json.dumps(data).encode('utf-8')
+    request_headers = {
+        'X-GitHub-Hook-ID': '10',
+        'X-GitHub-Delivery': delivery_id or str(uuid.uuid4()),
+        'X-GitHub-Event': event,
+        'X-Hub-Signature-256': 'sha256=' + _signature(body)
+    }
+    request_headers.update(headers or {})
+    request_headers = {
+        key: value for key, value in request_headers.items()
+        if value is not None
+    }
+
+    if secrets is None:
+        secrets = {'10': WebhookSecret(1, SECRET)}
+    if deliveries is None:
+        deliveries = FakeDeliveryService()
+    def get(id_, cached=True):
+        return secrets.get(id_)
+
+    services = {
+        IWebhookSecretService: pretend.stub(
+            get=get, get_for_repository=get
+        ),
+        IWebhookDeliveryService: deliveries
+    }
+    if delay is None:
+        delay = pretend.call_recorder(lambda payload: None)
+
+    def task(func):
+        assert func is process_github_webhook
+        return pretend.stub(delay=delay)
+
+    return pretend.stub(
+        body=body,
+        content_type='application/json',
+        headers=request_headers,
+        find_service=lambda iface, context: services[iface],
+        task=task
+    )
+
+
+def test_push_enqueues_compact_payload():
+    request = _request(delivery_id='abc')
+
+    assert github_webhook(request).status_code == 202
+
+    delay = request.task(process_github_webhook).delay
+    assert delay.calls == [pretend.call({
+        'event': 'push',
+        'delivery_id': 'abc',
+        'project_id': 1,
+        'ref': 'refs/heads/master',
+        'sha': 'a' * 40,
+        'before': 'b' * 40,
+        'message': 'Fix the build',
+        'author_name': 'Author',
+        'author_email': 'author@example.com'
+    })]
+
+
+def test_pull_request_enqueues_compact_payload():
+    request = _request('pull_request', PULL_REQUEST, delivery_id='abc')
+
+    assert github_webhook(request).status_code == 202
+
+    payload = request.task(process_github_webhook).delay.calls[0].args[0]
+    assert payload['ref'] == 'refs/pull/7/head'
+    assert payload['sha'] == 'b' * 40
+    assert payload['before'] == 'c' * 40
+
+
+def test_sha1_signature():
+    request = _request()
+    request.headers.pop('X-Hub-Signature-256')
+    request.headers['X-Hub-Signature'] = 'sha1=' + _signature(
+        request.body, digestmod=hashlib.sha1
+    )
+
+    assert github_webhook(request).status_code == 202
+    assert len(request.task(process_github_webhook).delay.calls) == 1
+
+
+def test_form_encoded_payload():
+    request = _request()
+    request.content_type = 'application/x-www-form-urlencoded'
+    request.POST = MultiDict(payload=request.body.decode('utf-8'))
+
+    assert github_webhook(request).status_code == 202
+    assert len(request.task(process_github_webhook).delay.calls) == 1
+
+
+@pytest.mark.parametrize(
+    'header', ['X-GitHub-Hook-ID', 'X-GitHub-Delivery', 'X-GitHub-Event']
+)
+def test_missing_headers(header):
+    request = _request(headers={header: None})
+
+    assert github_webhook(request).status_code == 400
+
+
+def test_repository_id_lookup():
+    request = _request(
+        secrets={'1': WebhookSecret(1, SECRET)},
+        headers={
+            'X-GitHub-Hook-ID': None,
+            'X-GitHub-Hook-Installation-Target-Type': 'repository',
+            'X-GitHub-Hook-Installation-Target-ID': '1'
+        }
+    )
+
+    assert github_webhook(request).status_code == 202
+    assert len(request.task(process_github_webhook).delay.calls) == 1
+
+
+def test_stale_cached_secret_is_refreshed():
+    request = _request()
+    lookups = []
+
+    def get(hook_id, cached=True):
+        lookups.append(cached)
+        return WebhookSecret(1, 'old' if cached else SECRET)
+
+    service = pretend.stub(get=get)
+    request.find_service = lambda iface, context: (
+        service if iface is IWebhookSecretService
+        else FakeDeliveryService()
+    )
+
+    assert github_webhook(request).status_code == 202
+    assert lookups == [True, False]
+
+
+def test_unknown_hook():
+    request = _request(secrets={})
+
+    assert github_webhook(request).status_code == 404
+
+
+@pytest.mark.parametrize(
+    'headers',
+    [{'X-Hub-Signature-256': None},
+     {'X-Hub-Signature-256': 'sha256=' + '0' * 64},
+     {'X-Hub-Signature-256': 'md5=' + '0' * 32}]
+)
+def test_invalid_signature(headers):
+    request = _request(headers=headers)
+
+    assert github_webhook(request).status_code == 403
+    assert request.task(process_github_webhook).delay.calls == []
+
+
+def test_wrong_secret():
+    request = _request(secrets={'10': WebhookSecret(1, 'other')})
+
+    assert github_webhook(request).status_code == 403
+
+
+@pytest.mark.parametrize(
+    ['event', 'data'],
+    [('ping', {'zen': 'Keep it logically awesome.'}),
+     ('push', dict(PUSH, deleted=True, head_commit=None)),
+     ('pull_request', dict(PULL_REQUEST, action='closed'))]
+)
+def test_ignored_events(event, data):
+    request = _request(event, data)
+
+    assert github_webhook(request).status_code == 202
+    assert request.task(process_github_webhook).delay.calls == []
+
+
+@pytest.mark.parametrize(
+    'data',
+    [{'ref': 'refs/heads/master', 'head_commit': {'id': 'a' * 40}},
+     ['not', 'an', 'object']]
+)
+def test_invalid_payload(data):
+    request = _request(data=data)
+
+    assert github_webhook(request).status_code == 400
+
+
+def test_malformed_json():
+    request = _request()
+    request.body = b'{'
+    request.headers['X-Hub-Signature-256'] = 'sha256=' + _signature(b'{')
+
+    assert github_webhook(request).status_code == 400
+
+
+def test_redelivery_is_not_enqueued():
+    deliveries = FakeDeliveryService()
+    first = _request(delivery_id='abc', deliveries=deliveries)
+    retry = _request(delivery_id='abc', deliveries=deliveries)
+
+    assert github_webhook(first).status_code == 202
+    assert github_webhook(retry).status_code == 202
+    assert len(first.task(process_github_webhook).delay.calls) == 1
+    assert retry.task(process_github_webhook).delay.calls == []
+
+
+def test_replay_burst_of_deliveries():
+    """Replays a push storm where GitHub retried a third of the
+    deliveries and asserts that each delivery is enqueued once.
+    """
+    rng = random.Random(0)
+    delivery_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(300)]
+    burst = delivery_ids + rng.sample(delivery_ids, 100)
+    rng.shuffle(burst)
+
+    deliveries = FakeDeliveryService()
+    delay = pretend.call_recorder(lambda payload: None)
+    requests = [
+        _request(delivery_id=delivery_id, deliveries=deliveries, delay=delay)
+        for delivery_id in burst
+    ]
+
+    durations = []
+    for request in requests:
+        start = time.perf_counter()
+        assert github_webhook(request).status_code == 202
+        durations.append(time.perf_counter() - start)
+
+    enqueued = [call.args[0]['delivery_id'] for call in delay.calls]
+    assert sorted(enqueued) == sorted(delivery_ids)
+    assert sorted(durations)[int(len(durations) * 0.99)] < 0.01
+
+
+def test_compact_push_without_head_commit():
+    assert views._compact_push(dict(PUSH, head_commit=None)) is None